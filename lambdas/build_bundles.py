@@ -0,0 +1,254 @@
+"""
+Builds minimal, self-contained deployment packages (lambda.zip) for the three lambdas
+(and the fused one, that runs all three steps).
+
+Instead of zipping the whole "package" folder that pip installed, only the
+modules that are really imported are packed. For that we import the lambda's
+dependencies in a separate python process and record which modules were loaded.
+The NLTK data the lambda needs is copied into the zip (nltk_data/), so the
+handlers don't have to call nltk.download() on every cold start.
+All python files are compiled to bytecode, because /var/task is read-only
+and the runtime would otherwise compile them again on every cold start.
+
+Run it from the repository root after the dependencies were installed into
+lambdas/<name>/package (see setup.ps1):
+    python -m lambdas.build_bundles [preprocessing] [profanity_check] [sentiment_analysis] [fused]
+"""
+import compileall
+import json
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import zipfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# With the lemma table the preprocessing doesn't import nltk at all (see preprocessing/handler.py)
+HAS_LEMMA_TABLE = os.path.exists(os.path.join(REPO_ROOT, "lambdas/preprocessing/lemmas.tsv.gz"))
+WORDNET_IMPORTS = "" if HAS_LEMMA_TABLE else "\nimport nltk\nfrom nltk.stem import WordNetLemmatizer\nWordNetLemmatizer()"
+
+# Python version of the lambda runtime (setup.ps1 uses python3.11)
+RUNTIME_VERSION = (3, 11)
+
+# Shared files every lambda needs, relative to the repository root
+COMMON_FILES = ["lambdas/__init__.py", "lambdas/common"]
+# Not packed: the in-memory AWS of the tests and benchmarks (common/memory_aws.py) has no use in a lambda
+NOT_BUNDLED = shutil.ignore_patterns("__pycache__", "*.pyc", "memory_aws.py")
+
+FUNCTIONS = {
+    "preprocessing": {
+        # Files from the lambda folder that go to the root of the zip
+        "files": ["handler.py", "stopwords.txt"],
+        # Files that keep their path relative to the repository root
+        "repo_files": [
+            "lambdas/preprocessing/__init__.py",
+            "lambdas/preprocessing/lemma_table.py",
+            "lambdas/preprocessing/lemmas.tsv.gz",
+        ],
+        # NLTK data (resource id, folder in nltk_data). WordNet is only the fallback
+        # if the lemma table was not built, so it is only packed in that case.
+        "nltk_data": [] if HAS_LEMMA_TABLE else [("wordnet", "corpora"), ("omw-1.4", "corpora")],
+        # Code that uses the dependencies the same way the handler does
+        "imports": "import lambdas.common.codec\nimport lambdas.common.compression" + WORDNET_IMPORTS,
+    },
+    "profanity_check": {
+        "files": ["handler.py"],
+        "repo_files": [
+            "lambdas/profanity_check/__init__.py",
+            "lambdas/profanity_check/checks.py",
+            "lambdas/profanity_check/scanner.py",
+            "lambdas/profanity_check/bad-words.txt",
+            "lambdas/profanity_check/badwords_profanityfilter.txt",
+            # The scanner removes the same stopwords from the phrases
+            "lambdas/preprocessing/stopwords.txt",
+        ],
+        "nltk_data": [],
+        "imports": "import lambdas.common.codec\nimport lambdas.common.compression",
+    },
+    "sentiment_analysis": {
+        "files": ["handler.py"],
+        "repo_files": [
+            "lambdas/sentiment_analysis/__init__.py",
+            "lambdas/sentiment_analysis/classify.py",
+            "lambdas/sentiment_analysis/engine.py",
+        ],
+        "nltk_data": [("vader_lexicon", "sentiment")],
+        "imports": "import lambdas.common.codec\nimport lambdas.common.compression\nimport numpy\nimport nltk\n"
+        "from nltk.sentiment.vader import SentimentIntensityAnalyzer\n"
+        "SentimentIntensityAnalyzer().polarity_scores('not a bad product')",
+    },
+    "fused": {
+        "files": ["handler.py"],
+        # The handlers of the three stages are imported as modules, with their data files
+        "repo_files": [
+            "lambdas/preprocessing/__init__.py",
+            "lambdas/preprocessing/handler.py",
+            "lambdas/preprocessing/lemma_table.py",
+            "lambdas/preprocessing/lemmas.tsv.gz",
+            "lambdas/preprocessing/stopwords.txt",
+            "lambdas/profanity_check/__init__.py",
+            "lambdas/profanity_check/handler.py",
+            "lambdas/profanity_check/checks.py",
+            "lambdas/profanity_check/scanner.py",
+            "lambdas/profanity_check/bad-words.txt",
+            "lambdas/profanity_check/badwords_profanityfilter.txt",
+            "lambdas/sentiment_analysis/__init__.py",
+            "lambdas/sentiment_analysis/handler.py",
+            "lambdas/sentiment_analysis/classify.py",
+            "lambdas/sentiment_analysis/engine.py",
+        ],
+        "nltk_data": [("vader_lexicon", "sentiment")]
+        + ([] if HAS_LEMMA_TABLE else [("wordnet", "corpora"), ("omw-1.4", "corpora")]),
+        "imports": "import lambdas.common.codec\nimport lambdas.common.compression\nimport numpy" + WORDNET_IMPORTS + "\n"
+        "import nltk\nfrom nltk.sentiment.vader import SentimentIntensityAnalyzer\n"
+        "SentimentIntensityAnalyzer().polarity_scores('not a bad product')",
+    },
+}
+
+
+def find_nltk_data(resource, folder):
+    """Returns the path of an NLTK resource (zip or folder), downloads it once if it is missing"""
+    import nltk
+
+    for name in (f"{folder}/{resource}.zip", f"{folder}/{resource}"):
+        for path in nltk.data.path:
+            candidate = os.path.join(path, name)
+            if os.path.exists(candidate):
+                return candidate
+    # Only happens at build time, never in the lambda itself
+    nltk.download(resource, quiet=True)
+    return find_nltk_data(resource, folder)
+
+
+def trace_imports(data_dir, statement):
+    """Runs the statement in a new process and returns the names of all modules it imported"""
+    code = (
+        "import json, sys\n"
+        f"{statement}\n"
+        "print(json.dumps(sorted(sys.modules)))\n"
+    )
+    env = dict(os.environ, NLTK_DATA=data_dir)
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=REPO_ROOT, env=env)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def dependency_files(package_dir, modules):
+    """
+    Maps the imported modules to the files in package_dir that we copy.
+
+    We go by module name and not by file, so this also works on Windows with the
+    linux packages that pip installed for the lambda. For nltk only the imported
+    modules are copied (and the data files next to them, e.g. nltk/VERSION),
+    for every other dependency the whole top level package, since it may load
+    compiled extensions.
+    """
+    files = set()
+    for module in modules:
+        parts = module.split(".")
+        top = parts[0]
+        if top == "nltk":
+            base = os.path.join(*parts)
+            for rel in (base + ".py", os.path.join(base, "__init__.py")):
+                if os.path.isfile(os.path.join(package_dir, rel)):
+                    files.add(rel)
+                    folder = os.path.dirname(rel)
+                    for name in os.listdir(os.path.join(package_dir, folder)):
+                        if os.path.isfile(os.path.join(package_dir, folder, name)) and not name.endswith((".py", ".pyc")):
+                            files.add(os.path.join(folder, name))
+        elif os.path.isdir(os.path.join(package_dir, top)):
+            for root, dirs, names in os.walk(os.path.join(package_dir, top)):
+                dirs[:] = [d for d in dirs if d not in ("__pycache__", "test", "tests")]
+                files.update(
+                    os.path.relpath(os.path.join(root, n), package_dir)
+                    for n in names
+                    if not n.endswith(".pyc") and not n.startswith("test_")
+                )
+        elif os.path.isfile(os.path.join(package_dir, top + ".py")):
+            files.add(top + ".py")
+    return sorted(files)
+
+
+def copy(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True, ignore=NOT_BUNDLED)
+    else:
+        shutil.copy2(src, dst)
+
+
+def time_import(bundle_dir, statement):
+    """
+    Import time of the bundled dependencies in a fresh process (seconds).
+    Without site-packages (-S), so this also fails if something is missing in the bundle.
+    """
+    code = (
+        "import sys, time\n"
+        f"sys.path.insert(0, {bundle_dir!r})\n"
+        "t = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - t)\n"
+    )
+    env = dict(os.environ, NLTK_DATA=os.path.join(bundle_dir, "nltk_data"))
+    out = subprocess.run([sys.executable, "-S", "-c", code], capture_output=True, text=True, check=True, cwd=bundle_dir, env=env)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def build(name):
+    spec = FUNCTIONS[name]
+    function_dir = os.path.join(REPO_ROOT, "lambdas", name)
+    package_dir = os.path.join(function_dir, "package")
+    bundle_dir = os.path.join(function_dir, "build")
+    zip_path = os.path.join(function_dir, "lambda.zip")
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.makedirs(bundle_dir)
+
+    # Handler and its data files
+    for file in spec["files"]:
+        copy(os.path.join(function_dir, file), os.path.join(bundle_dir, file))
+    for file in COMMON_FILES + spec["repo_files"]:
+        copy(os.path.join(REPO_ROOT, file), os.path.join(bundle_dir, file))
+
+    # NLTK data
+    data_dir = os.path.join(bundle_dir, "nltk_data")
+    os.makedirs(data_dir)
+    for resource, folder in spec["nltk_data"]:
+        src = find_nltk_data(resource, folder)
+        copy(src, os.path.join(data_dir, folder, os.path.basename(src)))
+
+    # Only the dependency modules that are really imported (e.g. orjson only if it is installed)
+    modules = trace_imports(data_dir, spec["imports"])
+    dependencies = dependency_files(package_dir, modules)
+    for rel in dependencies:
+        copy(os.path.join(package_dir, rel), os.path.join(bundle_dir, rel))
+
+    # Precompile, the hash based pycs are used without checking the source files
+    if sys.version_info[:2] == RUNTIME_VERSION:
+        compileall.compile_dir(
+            bundle_dir, quiet=1, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
+        )
+    else:
+        print(f"Warning: not precompiling {name}, the bytecode of python "
+              f"{sys.version_info[0]}.{sys.version_info[1]} would not be used by the python "
+              f"{RUNTIME_VERSION[0]}.{RUNTIME_VERSION[1]} runtime")
+
+    # Zip everything (sorted, so the same input gives the same zip)
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, names in os.walk(bundle_dir):
+            dirs.sort()
+            for n in sorted(names):
+                path = os.path.join(root, n)
+                zf.write(path, os.path.relpath(path, bundle_dir))
+
+    import_time = time_import(bundle_dir, spec["imports"])
+    print(f"{name}: {os.path.getsize(zip_path) / 1024 / 1024:.2f} MB zip, "
+          f"{len(dependencies)} dependency files, import time {import_time:.2f} s")
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or FUNCTIONS:
+        build(name)
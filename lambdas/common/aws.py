@@ -0,0 +1,101 @@
+"""
+The AWS clients of the lambdas and tools, made in one place.
+
+By default they are boto3 clients for LocalStack (AWS_ENDPOINT_URL, or port 4566 of
+LOCALSTACK_HOSTNAME like inside the LocalStack lambdas). With AWS_BACKEND=memory, or
+after set_backend(MemoryAWS(...)), they are the in-memory stand-ins of common/memory_aws.py,
+e.g. for the tests and the benchmarks without LocalStack. Nothing else changes in the
+handlers. They create their clients when they are imported, so the backend has to be
+chosen before that.
+
+Making a boto3 client takes 20-200 ms (the first one loads the service models), so
+client(service) and resource(service) make one per service and container and return
+it again to every module and invocation that asks (the fused lambda imports three
+handlers). Clients with other arguments (e.g. the config of a DynamoWriter) are new
+ones. All of them get a connection pool of AWS_MAX_POOL_CONNECTIONS with TCP keep-alive,
+so the connections stay open between the calls and the warm invocations.
+
+boto3 itself takes about 200 ms to import, so it is only imported with the first
+client. Modules that don't make a client at import (the preprocessing handler, the
+local batch runner, the in-memory tests) don't pay for it.
+"""
+import os
+import threading
+import time
+
+MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "50"))
+CONNECT_TIMEOUT = float(os.environ.get("AWS_CONNECT_TIMEOUT", "5"))
+
+_backend = None
+_clients = {}
+_lock = threading.Lock()
+
+# Clients made by this container and the seconds it took (logged with the cold start, see bootstrap.py)
+stats = {"clients": 0, "client_seconds": 0.0}
+
+
+def endpoint_url():
+    return os.environ.get("AWS_ENDPOINT_URL") or (
+        "http://" + os.environ.get("LOCALSTACK_HOSTNAME", "localhost") + ":4566")
+
+
+def client_config(config=None):
+    """The pool and keep-alive settings, with the settings of config on top"""
+    from botocore.config import Config
+
+    default = Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=True, connect_timeout=CONNECT_TIMEOUT)
+    return default if config is None else default.merge(config)
+
+
+def set_backend(backend):
+    """Makes client() and resource() return the clients of backend (a MemoryAWS), None for boto3 again"""
+    global _backend
+    with _lock:
+        _backend = backend
+        _clients.clear()
+    return backend
+
+
+def backend():
+    """The in-memory backend that is used, None for boto3. With AWS_BACKEND=memory one is made on first use."""
+    global _backend
+    if _backend is None and os.environ.get("AWS_BACKEND", "").lower() == "memory":
+        from lambdas.common.memory_aws import Latency, MemoryAWS
+
+        _backend = MemoryAWS(Latency.from_env())
+    return _backend
+
+
+def _make(kind, service, kwargs):
+    if backend() is not None:
+        return getattr(backend(), kind)(service, **kwargs)
+    # The import of boto3 is part of the time of the first client
+    start = time.perf_counter()
+    import boto3
+
+    kwargs["config"] = client_config(kwargs.get("config"))
+    made = getattr(boto3, kind)(service, endpoint_url=endpoint_url(), **kwargs)
+    stats["clients"] += 1
+    stats["client_seconds"] += time.perf_counter() - start
+    return made
+
+
+def _shared(kind, service):
+    with _lock:
+        if (kind, service) not in _clients:
+            _clients[kind, service] = _make(kind, service, {})
+        return _clients[kind, service]
+
+
+def client(service, **kwargs):
+    """boto3.client(service, **kwargs) for LocalStack, or the in-memory client. Without kwargs always the same one."""
+    if not kwargs:
+        return _shared("client", service)
+    return _make("client", service, kwargs)
+
+
+def resource(service, **kwargs):
+    """boto3.resource(service, **kwargs) for LocalStack, or the in-memory resource. Without kwargs always the same one."""
+    if not kwargs:
+        return _shared("resource", service)
+    return _make("resource", service, kwargs)
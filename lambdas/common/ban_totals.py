@@ -0,0 +1,102 @@
+"""
+Running totals of the ban table, kept in one extra item of the table itself.
+
+The profanity lambda adds the profane reviews of every file to it and counts every
+user that gets banned in the same transaction as the ban (see apply_profane_counts),
+so total_counts.json only needs one get_item instead of a scan of the whole table.
+The item has no ban_status, so it's not in the banned-index.
+
+The profane reviews of a file are added in a transaction with a marker item of the
+file (reviewerID "#file#<bucket>/<key>/<eTag>"), a retry of the file doesn't add them twice.
+This is not the transaction of the reviewer updates: those fail their condition on purpose
+(that is how a ban is noticed), which would cancel all of them, and a transaction has at
+most 100 items. Until a crashed file is retried, its reviewers and the totals can differ.
+
+If the totals are missing or ever drift (e.g. a table from before), recompute them with a paginated scan:
+    python -m lambdas.common.ban_totals
+Best run while no files are processed, updates during the scan can get lost.
+"""
+import os
+import sys
+
+from lambdas.common import metrics
+
+# reviewerID of the totals item, no Amazon reviewer ID starts with "#"
+TOTALS_ID = "#totals"
+# reviewerID prefix of the marker items of the files whose profane reviews were added
+FILE_PREFIX = "#file#"
+
+
+def totals_key():
+    return {"reviewerID": TOTALS_ID}
+
+
+def add_profane_update(n):
+    """Arguments of update_item that add n profane reviews to the totals"""
+    return {
+        "Key": totals_key(),
+        "UpdateExpression": "ADD profane_total :n",
+        "ExpressionAttributeValues": {":n": n},
+    }
+
+
+def file_marker_update(file_id):
+    """Arguments of update_item that create the marker of a file, the condition fails if it exists"""
+    return {
+        "Key": {"reviewerID": FILE_PREFIX + file_id},
+        "UpdateExpression": "SET applied = :true",
+        "ConditionExpression": "attribute_not_exists(reviewerID)",
+        "ExpressionAttributeValues": {":true": True},
+    }
+
+
+def add_banned_update():
+    """Arguments of update_item that count one more banned user (part of the ban's transaction)"""
+    return {
+        "Key": totals_key(),
+        "UpdateExpression": "ADD banned_total :one",
+        "ExpressionAttributeValues": {":one": 1},
+    }
+
+
+def get_totals(table):
+    """(profane_total, banned_total) from the totals item, (0, 0) if there is none yet"""
+    item = table.get_item(Key=totals_key(), ConsistentRead=True).get("Item", {})
+    metrics.count("dynamodb_reads")
+    return int(item.get("profane_total", 0)), int(item.get("banned_total", 0))
+
+
+def scan_totals(table):
+    """(profane_total, banned_total) counted from every reviewer of the table, all pages"""
+    profane_total = 0
+    banned_total = 0
+    kwargs = {"ProjectionExpression": "reviewerID, profane_count, banned"}
+    while True:
+        resp = table.scan(**kwargs)
+        for item in resp.get("Items", []):
+            # The totals and the file markers
+            if item["reviewerID"].startswith("#"):
+                continue
+            profane_total += int(item.get("profane_count", 0))
+            if item.get("banned", False):
+                banned_total += 1
+        if "LastEvaluatedKey" not in resp:
+            return profane_total, banned_total
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def reconcile(table):
+    """Recomputes the totals item from a scan, returns (old totals, new totals)"""
+    old = get_totals(table)
+    profane_total, banned_total = scan_totals(table)
+    table.put_item(Item={"reviewerID": TOTALS_ID, "profane_total": profane_total, "banned_total": banned_total})
+    return old, (profane_total, banned_total)
+
+
+if __name__ == "__main__":
+    from lambdas.common import aws
+
+    table_name = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("BAN_TABLE", "ban-table")
+    table = aws.resource("dynamodb").Table(table_name)
+    old, new = reconcile(table)
+    print(f"{table_name}: profane reviews {old[0]} -> {new[0]}, banned users {old[1]} -> {new[1]}")
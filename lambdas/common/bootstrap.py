@@ -0,0 +1,91 @@
+"""
+What a lambda container needs before its first invocation, made once and kept for
+the warm ones:
+
+    from lambdas.common import bootstrap   # first import of the handler, it starts the clock
+    ...
+    output_bucket = bootstrap.parameter("output_bucket")
+    ...
+    bootstrap.init_done()                  # last line of the handler module
+
+- parameter(name) is the SSM parameter /dic/<name>. All parameters under CONFIG_PATH
+  come with one get_parameters_by_path call (instead of one get_parameter per name and
+  module) and are kept for CONFIG_TTL seconds, the handlers read them in every
+  invocation, so a changed bucket name is picked up after that. If the refresh
+  fails, the old values are used.
+- The clients are made once per service and reused, with a connection pool and keep-alive (aws.py).
+- The heavy modules are only imported where they are needed (e.g. nltk in the
+  preprocessing only without the lemma table).
+- init_done() records how long the import of the handler took, how much of it were the
+  config and the clients, and the first invocation logs it with its metrics
+  (cold_start, init_ms, config_ms, clients_ms, see metrics.py).
+"""
+import os
+import threading
+import time
+
+START = time.perf_counter()
+
+from lambdas.common import aws, metrics
+
+CONFIG_PATH = os.environ.get("CONFIG_PATH", "/dic")
+CONFIG_TTL = float(os.environ.get("CONFIG_TTL", "300"))
+
+_lock = threading.Lock()
+# The parameters, when and from which backend they were fetched (a new backend in the tests fetches them again)
+_config = {"values": None, "fetched": 0.0, "backend": None}
+_init = {"config_seconds": 0.0}
+
+
+def fetch_config(path=CONFIG_PATH):
+    """{name: value} of all SSM parameters under path (the name without the path)"""
+    prefix = path.rstrip("/") + "/"
+    values = {}
+    paginator = aws.client("ssm").get_paginator("get_parameters_by_path")
+    for page in paginator.paginate(Path=path, Recursive=True):
+        for parameter in page["Parameters"]:
+            values[parameter["Name"][len(prefix):]] = parameter["Value"]
+    return values
+
+
+def config():
+    """All parameters under CONFIG_PATH, fetched again when they are older than CONFIG_TTL seconds"""
+    with _lock:
+        now = time.monotonic()
+        same_backend = _config["backend"] is aws.backend()
+        if _config["values"] is None or not same_backend or now - _config["fetched"] > CONFIG_TTL:
+            start = time.perf_counter()
+            try:
+                values = fetch_config()
+            except Exception as e:
+                if _config["values"] is None or not same_backend:
+                    raise
+                print(f"Refreshing the config failed, using the cached values: {e}")
+                values = _config["values"]
+            finally:
+                _init["config_seconds"] += time.perf_counter() - start
+            _config.update(values=values, fetched=now, backend=aws.backend())
+        return _config["values"]
+
+
+def parameter(name):
+    """Value of the SSM parameter CONFIG_PATH/name"""
+    values = config()
+    if name not in values:
+        raise KeyError(f"SSM parameter {CONFIG_PATH.rstrip('/')}/{name} not found")
+    return values[name]
+
+
+def init_done():
+    """
+    Called at the end of the handler module: the time since this module was imported
+    is the init of the container. The fused handler calls it after the three stage
+    handlers, so its time counts.
+    """
+    metrics.set_cold_start({
+        "cold_start": 1,
+        "init_ms": round((time.perf_counter() - START) * 1000, 3),
+        "config_ms": round(_init["config_seconds"] * 1000, 3),
+        "clients_ms": round(aws.stats["client_seconds"] * 1000, 3),
+        "clients": aws.stats["clients"],
+    })
@@ -0,0 +1,59 @@
+import hashlib
+from collections import OrderedDict
+
+# Returned by ResultCache.get if the text is not cached (None could be a real result)
+MISSING = object()
+
+
+class ResultCache:
+    """
+    Bounded LRU cache for results computed from a text (e.g. the tokens of a summary).
+
+    The key is a 128 bit hash of the text instead of the text itself,
+    so long review texts don't stay in memory. It lives in the module,
+    so it is kept across warm invocations of the lambda.
+    Cached values are shared, don't modify them.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    @staticmethod
+    def key(text):
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get(self, key):
+        value = self._data.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_or_compute(self, text, compute):
+        """Returns the cached result for the text, or computes and caches it"""
+        key = self.key(text)
+        value = self.get(key)
+        if value is MISSING:
+            value = compute(text)
+            self.put(key, value)
+        return value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,185 @@
+"""
+Checkpoints for files that take longer than one lambda invocation.
+
+While a handler works through a file it saves its progress to CHECKPOINT_BUCKET every
+CHECKPOINT_INTERVAL seconds: the byte offset in the input (after the last line or
+block that is completely in the output), the open multipart upload of the output
+with the bytes that are not uploaded yet, and the counters of the handler.
+When less than CHECKPOINT_MARGIN_MS are left (context.get_remaining_time_in_millis()),
+it saves once more and invokes the lambda again (asynchronously) with the records
+that are not done, the new invocation continues exactly where this one stopped.
+
+The checkpoint belongs to the input object (stage, bucket, key and eTag), so an
+automatic retry after a crash or timeout continues from the last checkpoint as well,
+instead of writing the output again and counting the reviews twice.
+When the output is complete, the checkpoint is saved as "output_done" with the counters,
+then the handler updates DynamoDB and deletes the checkpoint.
+
+Without CHECKPOINT_BUCKET (e.g. in the tests) nothing is saved and files are
+processed in one go like before.
+"""
+import json
+import os
+import time
+
+from lambdas.common import aws, compression, formats, metrics
+
+CHECKPOINT_BUCKET = os.environ.get("CHECKPOINT_BUCKET", "")
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "30"))
+# Time that has to be left for the last checkpoint and the invoke of the continuation
+CHECKPOINT_MARGIN_MS = int(os.environ.get("CHECKPOINT_MARGIN_MS", "15000"))
+
+RUNNING = "running"
+OUTPUT_DONE = "output_done"
+
+_lambda_client = None
+
+
+def lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = aws.client("lambda")
+    return _lambda_client
+
+
+class Checkpointer:
+    """Progress of one stage on one input file (one S3 event record)"""
+
+    def __init__(self, s3, stage, record, context, bucket=CHECKPOINT_BUCKET,
+                 interval=CHECKPOINT_INTERVAL, margin_ms=CHECKPOINT_MARGIN_MS):
+        self.s3 = s3
+        self.context = context
+        self.bucket = bucket
+        self.interval = interval
+        self.margin_ms = margin_ms
+        self.input_bucket = record["s3"]["bucket"]["name"]
+        self.input_key = record["s3"]["object"]["key"]
+        # A new upload of the same key is a new file
+        etag = record["s3"]["object"].get("eTag")
+        self.key = f"{stage}/{self.input_bucket}/{self.input_key}/{etag or 'latest'}.json"
+        # Marks the DynamoDB updates of this file, so a retry doesn't apply them twice (None without eTag)
+        self.input_id = f"{self.input_bucket}/{self.input_key}/{etag}" if etag else None
+        self.state = None
+        self.pending = b""
+        self.saved = time.monotonic()
+
+    @property
+    def enabled(self):
+        return bool(self.bucket)
+
+    @property
+    def phase(self):
+        return self.state["phase"] if self.state else None
+
+    @property
+    def data(self):
+        """Counters etc. the handler saved with the checkpoint"""
+        return self.state["data"] if self.state else {}
+
+    def load(self):
+        """Loads the checkpoint of an earlier invocation, returns the state or None"""
+        if not self.enabled:
+            return None
+        from botocore.exceptions import ClientError
+
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        self.state = json.loads(obj["Body"].read())
+        if self.state.get("writer"):
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key + ".pending")
+            self.pending = obj["Body"].read()
+        print(f"Continuing {self.input_key} from checkpoint: phase {self.phase}, offset {self.state.get('offset')}")
+        return self.state
+
+    def open_input(self, decode=True):
+        """Returns (kind, records) of the input file from the offset of the checkpoint, see formats.open_input"""
+        state = self.state or {}
+        body, self.encoding = compression.open_object(
+            self.s3, self.input_bucket, self.input_key, state.get("offset", 0), state.get("encoding"))
+        self.kind, self.records = formats.open_input(body, decode, state.get("kind"), state.get("offset", 0))
+        return self.kind, self.records
+
+    def open_writer(self, bucket, key, encoding, **put_object_kwargs):
+        """compression.open_writer that continues the upload of the checkpoint"""
+        state = self.state or {}
+        return compression.open_writer(s3=self.s3, bucket=bucket, key=key, encoding=encoding,
+                                       resume=state.get("writer"), pending=self.pending, **put_object_kwargs)
+
+    def open_output(self, writer, fmt):
+        """formats.open_output with the rows of the checkpoint already counted"""
+        output = formats.open_output(writer, fmt)
+        if self.state and self.state.get("rows_written") is not None:
+            output.rows_written = self.state["rows_written"]
+        return output
+
+    def time_is_up(self):
+        return self.context is not None and self.context.get_remaining_time_in_millis() < self.margin_ms
+
+    def due(self):
+        """Whether a checkpoint should be saved now (only call it between two lines / blocks)"""
+        return self.enabled and (time.monotonic() - self.saved >= self.interval or self.time_is_up())
+
+    def save_progress(self, writer, output, **data):
+        """
+        Saves the progress after the last line / block of the input that was written to output
+        (None if the handler writes to the MultipartWriter itself). Returns True if the time is up,
+        the writer is then detached (the upload stays open) and the handler has to stop and
+        return hand_off(...).
+        """
+        with metrics.timer("checkpoint"):
+            return self._save_progress(writer, output, data)
+
+    def _save_progress(self, writer, output, data):
+        if output is not None:
+            output.flush()
+        writer_state, pending = writer.checkpoint()
+        self._save({
+            "phase": RUNNING,
+            "kind": self.kind,
+            "encoding": self.encoding,
+            "offset": self.records.offset,
+            "writer": writer_state,
+            "rows_written": output.rows_written if output is not None else None,
+            "data": data,
+        }, pending)
+        if self.time_is_up():
+            writer.detach()
+            return True
+        return False
+
+    def output_done(self, **data):
+        """Saves that the output is complete, with the counters that still have to go to DynamoDB"""
+        if self.enabled:
+            self._save({"phase": OUTPUT_DONE, "data": data})
+
+    def _save(self, state, pending=None):
+        if pending is not None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key + ".pending", Body=pending)
+        self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(state).encode("utf-8"),
+                           ContentType="application/json")
+        self.state = state
+        self.saved = time.monotonic()
+
+    def delete(self):
+        """Removes the checkpoint once the file is completely done"""
+        if self.enabled and self.state is not None:
+            self.s3.delete_object(Bucket=self.bucket, Key=self.key)
+            self.s3.delete_object(Bucket=self.bucket, Key=self.key + ".pending")
+            self.state = None
+
+    def hand_off(self, records, **carry):
+        """
+        Invokes the same lambda with the records that are not done yet (this one first).
+        carry goes into the event next to the records (e.g. counters of the records that are done).
+        """
+        print(f"Time is up at offset {self.state['offset']} of {self.input_key}, continuing in a new invocation")
+        lambda_client().invoke(
+            FunctionName=self.context.invoked_function_arn,
+            InvocationType="Event",
+            Payload=json.dumps({"Records": records, **carry}).encode("utf-8"),
+        )
+        return {"status": "CONTINUED", "offset": self.state["offset"]}
@@ -0,0 +1,110 @@
+"""
+JSON codec used by all handlers for the per-line json.loads / json.dumps.
+
+The backend is picked with the JSON_CODEC environment variable ("json" or "orjson"),
+by default orjson if it is installed and the standard library otherwise.
+Every backend has to give exactly the same output as json.dumps with the default
+settings, because the next stage (and the final output bucket) reads it.
+
+Microbenchmark (per-line cost of every backend):
+    python -m lambdas.common.codec reviews_sample.json
+"""
+import json
+import os
+import sys
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Same settings (and output) as json.dumps, but without the check for circular
+# references, our reviews come from json.loads so they can't have any
+_encode = json.JSONEncoder(check_circular=False).encode
+
+
+class StdlibCodec:
+    """The json module from the standard library"""
+
+    name = "json"
+
+    @staticmethod
+    def loads(line):
+        return json.loads(line)
+
+    dumps = staticmethod(_encode)
+
+
+class OrjsonCodec:
+    """
+    orjson for parsing. It gives the same python objects as json.loads, but it is
+    stricter (e.g. no NaN or lone surrogates), so for those lines we use json.loads.
+    orjson always writes compact JSON without ASCII escapes, which is not the same
+    as json.dumps, so we still write with the standard library.
+    """
+
+    name = "orjson"
+
+    @staticmethod
+    def loads(line):
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # Raises json.JSONDecodeError if the line is really broken
+            return json.loads(line)
+
+    dumps = StdlibCodec.dumps
+
+
+BACKENDS = {"json": StdlibCodec}
+if orjson is not None:
+    BACKENDS["orjson"] = OrjsonCodec
+
+
+def get_codec(name=None):
+    """Returns the codec with the given name, or the fastest installed one"""
+    if not name:
+        return OrjsonCodec if orjson is not None else StdlibCodec
+    if name not in BACKENDS:
+        raise ValueError(f"JSON codec {name!r} is not available, installed: {sorted(BACKENDS)}")
+    return BACKENDS[name]
+
+
+backend = get_codec(os.environ.get("JSON_CODEC"))
+loads = backend.loads
+dumps = backend.dumps
+
+
+def benchmark(path, repeat=20):
+    """Per-line decode and encode time of every installed backend (and of plain json.loads/json.dumps) in microseconds"""
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    expected = [json.dumps(json.loads(line)) for line in lines]
+    candidates = [("json.loads/dumps", json.loads, json.dumps)]
+    candidates += [(name, impl.loads, impl.dumps) for name, impl in BACKENDS.items()]
+    results = {}
+    for name, decode, encode in candidates:
+        # Has to be the same output as before
+        assert [encode(decode(line)) for line in lines] == expected, name
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in lines:
+                decode(line)
+        decode_time = time.perf_counter() - start
+        objs = [decode(line) for line in lines]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for obj in objs:
+                encode(obj)
+        encode_time = time.perf_counter() - start
+        n = repeat * len(lines)
+        results[name] = {"decode_us": decode_time / n * 1e6, "encode_us": encode_time / n * 1e6}
+    return results
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "reviews_sample.json"
+    for name, result in benchmark(path).items():
+        print(f"{name:16s} decode {result['decode_us']:.1f} us/line, encode {result['encode_us']:.1f} us/line")
@@ -0,0 +1,307 @@
+"""
+Compact columnar format for the intermediate buckets (reviews-bucket-cleaned and
+reviews-bucket-presentiment), used instead of JSON lines if INTERMEDIATE_FORMAT=columnar
+(see formats.py).
+
+A file is a sequence of blocks, so it can still be written and read in parts:
+
+    b"RVCB" | header length (uint32) | body length (uint64) | header (JSON) | body
+
+The header describes the columns, every column is one or two buffers in the body
+(little endian, 8 byte aligned), so they can be used as memoryviews without copying:
+
+    tokens  offsets (uint32) + token ids (uint32), lists of tokens like the cleaned reviewText
+    str     offsets (uint32) + UTF-8 bytes (lone surrogates kept, "surrogatepass")
+    int     int64
+    float   float64
+    bool    uint8
+    json    like str, every value written with json.dumps (anything else, e.g. "helpful")
+
+The token ids point into the vocabulary of the block (stored like a str column).
+Not every review has the same keys in the same order, so the block also stores
+the distinct key orders ("layouts") and the layout of every row. A column only
+has values for the rows that have the key, which keeps the final JSON lines exactly
+as they would have been without this format.
+"""
+import json
+import os
+import struct
+import sys
+from array import array
+
+from lambdas.common import metrics
+from lambdas.common.streaming import read_exact
+
+MAGIC = b"RVCB"
+VERSION = 1
+PREFIX = struct.Struct("<4sIQ")
+
+# Fields that hold lists of tokens after preprocessing
+TOKEN_FIELDS = ("reviewText", "summary")
+
+# Reviews per block, a block is the unit that is kept in memory
+BLOCK_ROWS = int(os.environ.get("COLUMNAR_BLOCK_ROWS", "10000"))
+
+CONTENT_TYPE = "application/x-review-columns"
+
+_TYPECODES = {"offsets": "I", "ids": "I", "int": "q", "float": "d", "bool": "B", "layout": "I"}
+
+
+def _pad(length):
+    return -length % 8
+
+
+class _BodyBuilder:
+    """Collects the buffers of a block body and remembers where each one starts"""
+
+    def __init__(self, start=0):
+        self.parts = []
+        self.length = start
+
+    def add(self, data):
+        if isinstance(data, array):
+            if sys.byteorder != "little":
+                data = array(data.typecode, data)
+                data.byteswap()
+            data = data.tobytes()
+        offset = self.length
+        self.parts.append(data)
+        self.parts.append(b"\0" * _pad(len(data)))
+        self.length += len(data) + _pad(len(data))
+        return [offset, len(data)]
+
+
+def _add_strings(builder, values):
+    # surrogatepass: a lone surrogate ("\ud800" in the JSON) is a valid str of a review too
+    encoded = [value.encode("utf-8", "surrogatepass") for value in values]
+    offsets = array("I", [0])
+    total = 0
+    for item in encoded:
+        total += len(item)
+        offsets.append(total)
+    return [builder.add(offsets), builder.add(b"".join(encoded))]
+
+
+def _column_type(name, values):
+    """Picks the most compact type that can store all values of a column exactly"""
+    if all(type(v) is str for v in values):
+        return "str"
+    if all(type(v) is bool for v in values):
+        return "bool"
+    if all(type(v) is int and -(2**63) <= v < 2**63 for v in values):
+        return "int"
+    if all(type(v) is float for v in values):
+        return "float"
+    if name in TOKEN_FIELDS and all(type(v) is list and all(type(t) is str for t in v) for v in values):
+        return "tokens"
+    return "json"
+
+
+def _add_column(builder, name, values, vocabulary):
+    column_type = _column_type(name, values)
+    if column_type == "str":
+        buffers = _add_strings(builder, values)
+    elif column_type == "json":
+        buffers = _add_strings(builder, [json.dumps(v) for v in values])
+    elif column_type == "tokens":
+        offsets = array("I", [0])
+        ids = array("I")
+        for tokens in values:
+            ids.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+            offsets.append(len(ids))
+        buffers = [builder.add(offsets), builder.add(ids)]
+    else:
+        buffers = [builder.add(array(_TYPECODES[column_type], values))]
+    return {"name": name, "type": column_type, "count": len(values), "buffers": buffers}
+
+
+def _pack(header, body_parts, body_length):
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return b"".join([PREFIX.pack(MAGIC, len(header_bytes), body_length), header_bytes] + body_parts)
+
+
+def encode_block(rows):
+    """Encodes a list of review dicts as one block (bytes)"""
+    layouts = {}
+    layout_ids = array("I")
+    columns = {}
+    for row in rows:
+        layout = tuple(row)
+        layout_ids.append(layouts.setdefault(layout, len(layouts)))
+        for key, value in row.items():
+            columns.setdefault(key, []).append(value)
+
+    builder = _BodyBuilder()
+    vocabulary = {}
+    header = {
+        "version": VERSION,
+        "rows": len(rows),
+        "layouts": [list(layout) for layout in layouts],
+        "layout_ids": builder.add(layout_ids),
+        "columns": [_add_column(builder, name, values, vocabulary) for name, values in columns.items()],
+    }
+    header["vocabulary"] = {"count": len(vocabulary), "buffers": _add_strings(builder, list(vocabulary))}
+    return _pack(header, builder.parts, builder.length)
+
+
+class Block:
+    """
+    One decoded block. Buffers are memoryviews into the bytes that were read,
+    values are only decoded when they are asked for.
+    """
+
+    def __init__(self, header, body):
+        if header.get("version") != VERSION:
+            raise ValueError(f"Unsupported columnar format version {header.get('version')}")
+        self.header = header
+        self.body = body
+        self.n_rows = header["rows"]
+        self.layouts = [tuple(layout) for layout in header["layouts"]]
+        self.layout_ids = self._view(header["layout_ids"], "layout")
+        self.columns = {column["name"]: column for column in header["columns"]}
+        self._vocabulary = None
+
+    def _view(self, buffer, kind):
+        offset, length = buffer
+        view = self.body[offset:offset + length]
+        if kind not in _TYPECODES:
+            return view
+        if sys.byteorder != "little":
+            values = array(_TYPECODES[kind], view.tobytes())
+            values.byteswap()
+            return memoryview(values)
+        return view.cast(_TYPECODES[kind])
+
+    def _strings(self, buffers):
+        offsets = self._view(buffers[0], "offsets")
+        data = self._view(buffers[1], "bytes").tobytes()
+        return [data[start:end].decode("utf-8", "surrogatepass") for start, end in zip(offsets, offsets[1:])]
+
+    def vocabulary(self):
+        """The tokens the ids of the token columns point to"""
+        if self._vocabulary is None:
+            self._vocabulary = self._strings(self.header["vocabulary"]["buffers"])
+        return self._vocabulary
+
+    def token_ids(self, name):
+        """Zero-copy (offsets, ids) of a tokens column, the ids of value i are ids[offsets[i]:offsets[i + 1]]"""
+        column = self.columns[name]
+        if column["type"] != "tokens":
+            raise TypeError(f"Column {name} is {column['type']}, not tokens")
+        return self._view(column["buffers"][0], "offsets"), self._view(column["buffers"][1], "ids")
+
+    def rows_with(self, name):
+        """Indexes of the rows that have the column (its values are in this order)"""
+        has_key = [name in layout for layout in self.layouts]
+        return [row for row, layout_id in enumerate(self.layout_ids) if has_key[layout_id]]
+
+    def values(self, name):
+        """Decoded values of a column (only for the rows that have it)"""
+        column = self.columns[name]
+        column_type = column["type"]
+        if column_type == "str":
+            return self._strings(column["buffers"])
+        if column_type == "json":
+            return [json.loads(value) for value in self._strings(column["buffers"])]
+        if column_type == "tokens":
+            vocabulary = self.vocabulary()
+            offsets, ids = self.token_ids(name)
+            return [[vocabulary[i] for i in ids[start:end]] for start, end in zip(offsets, offsets[1:])]
+        values = self._view(column["buffers"][0], column_type).tolist()
+        if column_type == "bool":
+            return [bool(v) for v in values]
+        return values
+
+    def rows(self):
+        """Yields the reviews as dicts, with the same keys in the same order as they were written"""
+        values = {name: iter(self.values(name)) for name in self.columns}
+        for layout_id in self.layout_ids:
+            yield {key: next(values[key]) for key in self.layouts[layout_id]}
+
+    def with_column(self, name, values):
+        """
+        Returns this block (bytes) with a new column that has a value for every row,
+        added as the last key. The other columns are copied as they are, without decoding them.
+        """
+        if name in self.columns:
+            rows = list(self.rows())
+            for row, value in zip(rows, values):
+                row[name] = value
+            return encode_block(rows)
+        builder = _BodyBuilder(start=len(self.body) + _pad(len(self.body)))
+        header = dict(self.header)
+        header["layouts"] = [list(layout) + [name] for layout in self.layouts]
+        header["columns"] = self.header["columns"] + [_add_column(builder, name, list(values), {})]
+        body = [self.body.tobytes(), b"\0" * _pad(len(self.body))] + builder.parts
+        return _pack(header, body, builder.length)
+
+
+class BlockReader:
+    """
+    Iterates over the blocks of a columnar file, one block is read at a time.
+    `offset` is the byte offset right after the last block that was returned, like streaming.LineReader.
+    """
+
+    def __init__(self, body, prefix=b"", start=0):
+        self.body = body
+        self.prefix = prefix
+        self.offset = start
+        self._items = self._read()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def _read(self):
+        while True:
+            start = self.prefix + read_exact(self.body, PREFIX.size - len(self.prefix))
+            self.prefix = b""
+            if not start:
+                return
+            if len(start) < PREFIX.size:
+                raise ValueError("Truncated columnar block")
+            magic, header_length, body_length = PREFIX.unpack(start)
+            if magic != MAGIC:
+                raise ValueError("Not a columnar block")
+            # The S3 reads inside are timed as s3_read, so this is the decompression
+            with metrics.timer("decompress"):
+                header = json.loads(read_exact(self.body, header_length))
+                data = read_exact(self.body, body_length)
+            if len(data) < body_length:
+                raise ValueError("Truncated columnar block")
+            self.offset += PREFIX.size + header_length + body_length
+            yield Block(header, memoryview(data))
+
+
+def iter_blocks(body, prefix=b"", start=0):
+    """Blocks of a columnar file, see BlockReader"""
+    return BlockReader(body, prefix, start)
+
+
+class ColumnarWriter:
+    """Collects reviews and writes them as blocks through a MultipartWriter"""
+
+    def __init__(self, writer, block_rows=BLOCK_ROWS):
+        self.writer = writer
+        self.block_rows = block_rows
+        self.rows_written = 0
+        self._rows = []
+
+    def write_row(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.block_rows:
+            self.flush()
+
+    def write_block(self, data, n_rows):
+        """Writes an already encoded block (e.g. from Block.with_column) with n_rows reviews"""
+        self.flush()
+        self.writer.write_record(data)
+        self.rows_written += n_rows
+
+    def flush(self):
+        if self._rows:
+            self.writer.write_record(encode_block(self._rows))
+            self.rows_written += len(self._rows)
+            self._rows = []
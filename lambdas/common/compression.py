@@ -0,0 +1,225 @@
+"""
+Compression of the files the lambdas write to S3 (gzip or zstd).
+
+Compressed objects get the Content-Encoding header, and readers decompress
+them while streaming, so the whole plaintext is never in memory.
+Set with COMPRESSION ("none", "gzip" or "zstd") for the intermediate buckets
+and OUTPUT_COMPRESSION for the output bucket (by default the same as COMPRESSION).
+zstd needs the zstandard package.
+
+Benchmark (bytes moved and time per stage file for every encoding):
+    python -m lambdas.common.compression reviews_sample.json [more stage files...]
+"""
+import gzip
+import io
+import os
+import sys
+import time
+import zlib
+
+from lambdas.common import metrics
+from lambdas.common.streaming import (
+    PIPELINED_IO, RANGE_SIZE, READ_CHUNK_SIZE, MultipartWriter, PrefixedBody, RangeReader, read_exact,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION = os.environ.get("COMPRESSION", "none")
+OUTPUT_COMPRESSION = os.environ.get("OUTPUT_COMPRESSION", COMPRESSION)
+
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+
+# First bytes of the compressed data, for objects without a Content-Encoding header
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+ENCODINGS = ["none", "gzip"] + (["zstd"] if zstandard is not None else [])
+
+
+def _check(encoding):
+    if encoding not in ("none", "gzip", "zstd"):
+        raise ValueError(f"Unknown compression {encoding!r}, use 'none', 'gzip' or 'zstd'")
+    if encoding == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+
+
+def compressor(encoding):
+    """Returns an object with compress(data) and flush(), or None for "none" """
+    _check(encoding)
+    if encoding == "gzip":
+        # wbits 31 writes the gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return None
+
+
+def put_kwargs(encoding):
+    """Extra arguments for put_object / create_multipart_upload"""
+    _check(encoding)
+    if encoding == "none":
+        return {}
+    return {"ContentEncoding": encoding}
+
+
+def open_body(obj):
+    """
+    Returns a file-like object with the decompressed content of an S3 get_object response.
+    Uses the Content-Encoding header, or the first bytes if it is missing.
+    """
+    return _decoder(obj)[0]
+
+
+def _decoder(obj):
+    """open_body, and the encoding that was found"""
+    body = obj["Body"]
+    encoding = obj.get("ContentEncoding")
+    if not encoding:
+        prefix = read_exact(body, len(ZSTD_MAGIC))
+        body = PrefixedBody(prefix, body)
+        if prefix.startswith(GZIP_MAGIC):
+            encoding = "gzip"
+        elif prefix.startswith(ZSTD_MAGIC):
+            encoding = "zstd"
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=body, mode="rb"), encoding
+    if encoding == "zstd":
+        _check(encoding)
+        # read_across_frames, so the result is the same as one frame for concatenated frames
+        return zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True), encoding
+    return body, "none"
+
+
+def open_object(s3, bucket, key, offset=0, encoding=None, end=None):
+    """
+    Gets an object and returns (body, encoding) like open_body, but starting at byte `offset`
+    of the decompressed content (to continue a file, see checkpoint.py). If we already know
+    the object is not compressed, only the rest is downloaded with a range request
+    (only up to byte `end` if it is given, for the shards of shards.py).
+    A compressed object has to be decompressed from the start up to the offset.
+
+    With PIPELINED_IO the object is downloaded in ranges, several of them in parallel
+    ahead of the reader (see streaming.RangeReader). An object of one range is one GET like before.
+    """
+    ranged = (offset or end is not None) and encoding == "none"
+    if ranged and end is not None and offset >= end:
+        return io.BytesIO(b""), encoding
+    start = offset if ranged else 0
+    obj = _get_object(s3, bucket, key, start, end if ranged else None)
+    if obj is None:
+        # The offset is the end of the object, nothing left
+        return io.BytesIO(b""), encoding
+    # The reads of the body are timed as well (see metrics.py), the decompression is not part of them
+    obj["Body"] = metrics.timed_body(obj["Body"])
+    if ranged:
+        return obj["Body"], encoding
+    body, encoding = _decoder(obj)
+    while offset > 0:
+        skipped = len(body.read(min(offset, READ_CHUNK_SIZE)))
+        if not skipped:
+            break
+        offset -= skipped
+    return body, encoding
+
+
+def _get_object(s3, bucket, key, start=0, end=None):
+    """
+    get_object of the bytes from start (up to end), None if start is the end of the object.
+    With PIPELINED_IO the first GET is the first range, the Body is a RangeReader
+    that gets the others.
+    """
+    if not PIPELINED_IO and not start and end is None:
+        with metrics.timer("s3_read"):
+            return s3.get_object(Bucket=bucket, Key=key)
+    # Not at the top, botocore is only imported with the first client (see aws.py)
+    from botocore.exceptions import ClientError
+
+    stop = end
+    if PIPELINED_IO:
+        stop = start + RANGE_SIZE if end is None else min(end, start + RANGE_SIZE)
+    try:
+        with metrics.timer("s3_read"):
+            obj = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{'' if stop is None else stop - 1}")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise
+        if start:
+            return None
+        # An empty object doesn't even have byte 0
+        with metrics.timer("s3_read"):
+            return s3.get_object(Bucket=bucket, Key=key)
+    if PIPELINED_IO:
+        size = int(obj["ContentRange"].rsplit("/", 1)[1])
+        end = size if end is None else min(end, size)
+        if stop < end:
+            obj["Body"] = RangeReader(s3, bucket, key, obj["Body"], stop, end, etag=obj.get("ETag"))
+    return obj
+
+
+def open_writer(s3, bucket, key, encoding, resume=None, pending=b"", **put_object_kwargs):
+    """MultipartWriter that compresses with the given encoding (resume / pending see MultipartWriter)"""
+    make_compressor = None if encoding == "none" else lambda: compressor(encoding)
+    _check(encoding)
+    return MultipartWriter(s3, bucket, key, make_compressor=make_compressor, resume=resume, pending=pending,
+                           **put_kwargs(encoding), **put_object_kwargs)
+
+
+def compress(data, encoding):
+    """Compresses bytes at once (for the small summary files)"""
+    c = compressor(encoding)
+    if c is None:
+        return data
+    return c.compress(data) + c.flush()
+
+
+def benchmark(paths, repeat=3):
+    """
+    For every stage file and encoding: bytes that go over the network and the
+    time to compress and decompress it (in seconds), written and read in chunks
+    like the lambdas do.
+    """
+    results = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        for encoding in ENCODINGS:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                c = compressor(encoding)
+                if c is None:
+                    packed = data
+                else:
+                    chunks = [c.compress(data[i:i + READ_CHUNK_SIZE]) for i in range(0, len(data), READ_CHUNK_SIZE)]
+                    packed = b"".join(chunks) + c.flush()
+            write_time = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                body = open_body({"Body": io.BytesIO(packed), "ContentEncoding": encoding})
+                out = []
+                while True:
+                    chunk = body.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.append(chunk)
+            read_time = (time.perf_counter() - start) / repeat
+            assert b"".join(out) == data, encoding
+            results.append({
+                "file": os.path.basename(path), "encoding": encoding, "bytes": len(packed),
+                "ratio": len(packed) / len(data) if data else 1.0, "write_s": write_time, "read_s": read_time,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    # Network speed between the lambda and S3 used for the estimate, in MB/s
+    bandwidth = float(os.environ.get("BENCHMARK_MBPS", "50"))
+    for r in benchmark(sys.argv[1:] or ["reviews_sample.json"]):
+        transfer = r["bytes"] / bandwidth / 1e6
+        print(f"{r['file']:28s} {r['encoding']:5s} {r['bytes']:>10d} bytes ({r['ratio']:.0%}), "
+              f"compress {r['write_s'] * 1000:.1f} ms, decompress {r['read_s'] * 1000:.1f} ms, "
+              f"upload + download at {bandwidth:g} MB/s {2 * transfer * 1000:.1f} ms, "
+              f"total {(r['write_s'] + r['read_s'] + 2 * transfer) * 1000:.1f} ms")
@@ -0,0 +1,182 @@
+"""
+Write-sharded counters in DynamoDB (the sentiment counts).
+
+Every invocation used to update the same three items ("positive", "neutral",
+"negative") with three requests, so parallel files all waited on the same hot keys.
+Now a counter is spread over COUNTER_SHARDS items ("counts#0", "counts#1", ...),
+each of them has all the counts as attributes. A file adds all its counts to one
+shard with a single update, the shard is chosen at random or by a hash of the
+file key (COUNTER_SHARDING "random" or "hash"). Reading sums all shards with one
+BatchGetItem.
+
+With the file (bucket/key/eTag) the update is a transaction with a marker item of the
+file ("counts#file#<bucket>/<key>/<eTag>") that must not exist yet, so a retry of the
+file, or of the request by the DynamoWriter, doesn't add its counts twice.
+
+Update latency with parallel writers, sharded vs the old three hot keys (LocalStack,
+or in memory with AWS_BACKEND=memory, see common/aws.py):
+    python -m lambdas.common.counters [table] [writers] [updates per writer]
+"""
+import os
+import random
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+from lambdas.common import dynamo, metrics
+
+COUNTER_SHARDS = int(os.environ.get("COUNTER_SHARDS", "8"))
+COUNTER_SHARDING = os.environ.get("COUNTER_SHARDING", "random")
+
+# BatchGetItem reads at most 100 keys
+MAX_BATCH_KEYS = 100
+
+
+class ShardedCounter:
+    """
+    Counts (name -> number) spread over `shards` items of a table whose hash key is key_name.
+    Writes go through a DynamoWriter, reads through the boto3 resource.
+    """
+
+    def __init__(self, dynamodb, writer, key_name, prefix="counts", shards=COUNTER_SHARDS, sharding=COUNTER_SHARDING):
+        if sharding not in ("random", "hash"):
+            raise ValueError(f"Unknown sharding {sharding!r}, use 'random' or 'hash'")
+        self.dynamodb = dynamodb
+        self.writer = writer
+        self.key_name = key_name
+        self.prefix = prefix
+        self.shards = max(1, shards)
+        self.sharding = sharding
+
+    def shard_key(self, shard):
+        return {self.key_name: f"{self.prefix}#{shard}"}
+
+    def choose_shard(self, hint=None):
+        """Random shard, or the one the hint (e.g. the file key) hashes to"""
+        if self.sharding == "hash" and hint is not None:
+            return zlib.crc32(hint.encode("utf-8")) % self.shards
+        return random.randrange(self.shards)
+
+    def add(self, counts, hint=None, file_id=None):
+        """
+        Adds all counts to one shard in one update, returns the Future of the update.
+        With file_id (checkpoint.Checkpointer.input_id) only once per file, see added().
+        """
+        names = {f"#c{i}": name for i, name in enumerate(counts)}
+        values = {f":c{i}": n for i, n in enumerate(counts.values())}
+        update = {
+            "Key": self.shard_key(self.choose_shard(hint)),
+            "UpdateExpression": "ADD " + ", ".join(f"{name} {value}" for name, value in zip(names, values)),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        }
+        if file_id is None:
+            return self.writer.update_item(**update)
+        marker = {
+            "Key": {self.key_name: f"{self.prefix}#file#{file_id}"},
+            "UpdateExpression": "SET applied = :true",
+            "ConditionExpression": "attribute_not_exists(#key)",
+            "ExpressionAttributeNames": {"#key": self.key_name},
+            "ExpressionAttributeValues": {":true": True},
+        }
+        return self.writer.transact_update(marker, update)
+
+    @staticmethod
+    def added(update):
+        """Waits for the Future of add(), False if the counts of the file were already added before"""
+        from botocore.exceptions import ClientError
+
+        try:
+            update.result()
+        except ClientError as e:
+            if not dynamo.condition_failed(e):
+                raise
+            return False
+        return True
+
+    def totals(self):
+        """The counts summed over all shards (ints)"""
+        totals = {}
+        table_name = self.writer.table_name
+        keys = [self.shard_key(shard) for shard in range(self.shards)]
+        for start in range(0, len(keys), MAX_BATCH_KEYS):
+            request = {table_name: {"Keys": keys[start:start + MAX_BATCH_KEYS], "ConsistentRead": True}}
+            # Keys that were not read because of throttling or size come back in UnprocessedKeys
+            while request:
+                resp = self.dynamodb.batch_get_item(RequestItems=request)
+                metrics.count("dynamodb_reads")
+                for item in resp.get("Responses", {}).get(table_name, []):
+                    for name, value in item.items():
+                        if name != self.key_name:
+                            totals[name] = totals.get(name, 0) + int(value)
+                request = resp.get("UnprocessedKeys") or None
+        return totals
+
+
+def benchmark(dynamodb, writer, writers=16, updates=50, shards=8):
+    """
+    Time per file (ms, p50 / p99) for `writers` parallel invocations that each add
+    counts `updates` times: the old way (one update per sentiment on the three hot items)
+    and one update on one of `shards` shards. Returns {mode: (p50, p99, total seconds)}.
+    """
+    counts = {"positive": 3, "neutral": 1, "negative": 2}
+    counter = ShardedCounter(dynamodb, writer, "sentiment", prefix="bench", shards=shards)
+
+    def old():
+        futures = [
+            writer.update_item(
+                Key={"sentiment": f"bench-{sentiment}"},
+                UpdateExpression="ADD c :n",
+                ExpressionAttributeValues={":n": n},
+            )
+            for sentiment, n in counts.items()
+        ]
+        for future in futures:
+            future.result()
+
+    def sharded():
+        counter.add(counts).result()
+
+    results = {}
+    for name, add in (("three hot items", old), (f"{shards} shards, one update", sharded)):
+        def run(_):
+            latencies = []
+            for _ in range(updates):
+                start = time.perf_counter()
+                add()
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=writers) as pool:
+            latencies = sorted(l for ls in pool.map(run, range(writers)) for l in ls)
+        total = time.perf_counter() - start
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        results[name] = (p50, p99, total)
+    return results
+
+
+if __name__ == "__main__":
+    from lambdas.common import aws
+
+    table_name = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("SENTIMENT_TABLE", "sentiment-table")
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    updates = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    client = aws.client("dynamodb", config=dynamo.client_config(writers * 3))
+    if aws.backend() is not None:
+        # The in-memory account starts empty
+        client.create_table(
+            TableName=table_name,
+            KeySchema=[{"AttributeName": "sentiment", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "sentiment", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+    writer = dynamo.DynamoWriter(client, table_name, max_workers=writers * 3, rate=None)
+    results = benchmark(aws.resource("dynamodb"), writer, writers, updates)
+    for name, (p50, p99, total) in results.items():
+        print(f"{name:28s} p50 {p50:.1f} ms, p99 {p99:.1f} ms per file, "
+              f"{writers * updates / total:.0f} files/s ({writers} writers)")
+    print(f"Writer: {writer.metrics()}")
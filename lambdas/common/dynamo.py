@@ -0,0 +1,301 @@
+"""
+Writer for the DynamoDB updates of the lambdas (ban_table and sentiment_table).
+
+Updates run on a small thread pool instead of one after the other on the handler
+thread. Every update gets a Future (the ack for that item), which returns the
+response or raises the error once all retries failed.
+
+- Rate limit: token bucket with the write capacity of the table (DYNAMODB_WRITE_RATE
+  in updates per second, "auto" reads it from the table, on-demand tables have none).
+  On throttling the rate is halved and then slowly raised again.
+- Retries: throttling and server errors are retried with exponential backoff and
+  full jitter. botocore's own retries are switched off (client_config), so they
+  don't add up with ours.
+- Metrics: in-flight requests, retries and p50/p99 latency of the requests.
+
+It uses the low-level client because boto3 resources are not thread safe, values
+are converted like Table.update_item does.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+MAX_WORKERS = int(os.environ.get("DYNAMODB_WORKERS", "8"))
+WRITE_RATE = os.environ.get("DYNAMODB_WRITE_RATE", "auto")
+MAX_RETRIES = int(os.environ.get("DYNAMODB_MAX_RETRIES", "8"))
+BASE_DELAY = 0.05
+MAX_DELAY = 5.0
+
+THROTTLING_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {
+    "InternalServerError",
+    "ServiceUnavailable",
+    "TransactionInProgressException",
+}
+
+# Cancellation reasons of a transaction that are retried
+RETRYABLE_REASONS = {"TransactionConflict", "ThrottlingError", "ProvisionedThroughputExceeded"}
+
+_serializer = None
+_deserializer = None
+
+
+def _converters():
+    """boto3's TypeSerializer and TypeDeserializer, made with the first update (boto3 is imported late, see aws.py)"""
+    global _serializer, _deserializer
+    if _serializer is None:
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+        _serializer, _deserializer = TypeSerializer(), TypeDeserializer()
+    return _serializer, _deserializer
+
+
+def client_config(max_workers=MAX_WORKERS):
+    """botocore config for the writer's client: no own retries, a connection per worker"""
+    from botocore.config import Config
+
+    return Config(retries={"mode": "standard", "max_attempts": 1}, max_pool_connections=max(max_workers, 10))
+
+
+def error_code(error):
+    """The DynamoDB error code of a ClientError (e.g. "ConditionalCheckFailedException")"""
+    from botocore.exceptions import ClientError
+
+    return error.response.get("Error", {}).get("Code") if isinstance(error, ClientError) else None
+
+
+def cancellation_reasons(error):
+    """The reason codes of a cancelled transaction, one per item ("None" for the items that were fine)"""
+    if error_code(error) != "TransactionCanceledException":
+        return []
+    return [reason.get("Code", "None") for reason in error.response.get("CancellationReasons", [])]
+
+
+def condition_failed(error):
+    """Whether an update or a transaction failed because of its ConditionExpression"""
+    return (error_code(error) == "ConditionalCheckFailedException"
+            or "ConditionalCheckFailed" in cancellation_reasons(error))
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average (bursts up to one second of requests).
+    The rate goes down by half on every throttle and back up by 5% of the maximum on every success.
+    """
+
+    def __init__(self, rate, min_fraction=0.1):
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate * min_fraction
+        self.rate = self.max_rate
+        self.capacity = max(self.max_rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def table_write_rate(client, table_name):
+    """The provisioned write capacity of the table, None for on-demand tables"""
+    table = client.describe_table(TableName=table_name)["Table"]
+    units = table.get("ProvisionedThroughput", {}).get("WriteCapacityUnits", 0)
+    return units or None
+
+
+class DynamoWriter:
+    """Runs update_item calls for one table on a bounded thread pool, see the module docstring"""
+
+    def __init__(self, client, table_name, max_workers=MAX_WORKERS, rate=WRITE_RATE,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.client = client
+        self.table_name = table_name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rate = rate
+        self._limiter = None
+        self._limiter_ready = False
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"dynamo-{table_name}")
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._limiter_lock = threading.Lock()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        with self._lock:
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.requests = 0
+            self.retries = 0
+            self.throttles = 0
+            self.acked = 0
+            self.conditions_failed = 0
+            self.failed = 0
+            self.latencies = deque(maxlen=100000)
+
+    def _get_limiter(self):
+        # Looked up on the first update, so creating the writer at import costs nothing
+        with self._limiter_lock:
+            if not self._limiter_ready:
+                self._limiter = self._make_limiter()
+                self._limiter_ready = True
+        return self._limiter
+
+    def _make_limiter(self):
+        from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError
+
+        rate = self._rate
+        if rate == "auto":
+            try:
+                rate = table_write_rate(self.client, self.table_name)
+            except (ClientError, BotocoreConnectionError):
+                rate = None
+        elif rate in (None, "", "0", "none"):
+            rate = None
+        return TokenBucket(float(rate)) if rate else None
+
+    def _serialize(self, kwargs):
+        serializer, _ = _converters()
+        request = {"TableName": self.table_name}
+        for name, value in kwargs.items():
+            if name in ("Key", "ExpressionAttributeValues"):
+                value = {k: serializer.serialize(v) for k, v in value.items()}
+            request[name] = value
+        return request
+
+    def update_item(self, **kwargs):
+        """
+        Same arguments as Table.update_item (python values), returns a Future with the
+        response (Attributes as python values). TableName is added.
+        """
+        return self._submit("update_item", self._serialize(kwargs))
+
+    def transact_update(self, *updates):
+        """
+        Runs several updates (dicts with the arguments of update_item) in one transaction,
+        all of them are applied or none. Returns a Future, a failed condition of any of
+        them raises TransactionCanceledException (see condition_failed).
+        """
+        items = [{"Update": self._serialize(update)} for update in updates]
+        return self._submit("transact_write_items", {"TransactItems": items})
+
+    def _submit(self, method, request):
+        future = self._pool.submit(self._call, method, request)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            error = future.exception()
+            if error is None:
+                self.acked += 1
+            elif condition_failed(error):
+                # Expected by the caller (e.g. the ban threshold), not an error of the writer
+                self.conditions_failed += 1
+            else:
+                self.failed += 1
+
+    def _call(self, method, request):
+        from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError
+
+        limiter = self._get_limiter()
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            with self._lock:
+                self.in_flight += 1
+                self.requests += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            start = time.perf_counter()
+            try:
+                resp = getattr(self.client, method)(**request)
+            except (ClientError, BotocoreConnectionError) as e:
+                code = error_code(e)
+                retryable = code in RETRYABLE_ERRORS or isinstance(e, BotocoreConnectionError)
+                # A transaction that was cancelled by another one on the same item or by throttling
+                reasons = cancellation_reasons(e)
+                if RETRYABLE_REASONS.intersection(reasons) and "ConditionalCheckFailed" not in reasons:
+                    retryable = True
+                if code in THROTTLING_ERRORS:
+                    with self._lock:
+                        self.throttles += 1
+                    if limiter is not None:
+                        limiter.throttled()
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                # Full jitter: anything between 0 and the exponential delay
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                continue
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.latencies.append(time.perf_counter() - start)
+            if limiter is not None:
+                limiter.succeeded()
+            if "Attributes" in resp:
+                _, deserializer = _converters()
+                resp["Attributes"] = {k: deserializer.deserialize(v) for k, v in resp["Attributes"].items()}
+            return resp
+
+    def wait(self):
+        """Waits until every update that was submitted is done (acked or failed)"""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            wait(pending)
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+            return {
+                "requests": self.requests,
+                "acked": self.acked,
+                "conditions_failed": self.conditions_failed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "p50_ms": percentile(0.50),
+                "p99_ms": percentile(0.99),
+            }
@@ -0,0 +1,100 @@
+"""
+Reading and writing the files that go between the stages, either as JSON lines
+or in the columnar format (columnar.py). The format of the intermediate buckets
+is set with INTERMEDIATE_FORMAT ("jsonl" or "columnar"). Readers detect the
+format of a file themselves, the final output bucket always gets JSON lines.
+"""
+import json
+import os
+
+from lambdas.common import codec, columnar
+from lambdas.common.streaming import PrefixedBody, iter_lines, read_exact
+
+INTERMEDIATE_FORMAT = os.environ.get("INTERMEDIATE_FORMAT", "jsonl")
+
+
+def open_input(body, decode=True, kind=None, start=0):
+    """
+    Looks at the first bytes of an S3 body and returns ("columnar", blocks)
+    or ("jsonl", lines). The lines are bytes with decode=False.
+    Both have an `offset` (see LineReader). To continue in the middle of a file,
+    pass the kind it had and the offset the body starts at.
+    """
+    if kind == "columnar":
+        return kind, columnar.iter_blocks(body, start=start)
+    if kind == "jsonl":
+        return kind, iter_lines(body, decode=decode, start=start)
+    prefix = read_exact(body, len(columnar.MAGIC))
+    if prefix == columnar.MAGIC:
+        return "columnar", columnar.iter_blocks(body, prefix)
+    return "jsonl", iter_lines(PrefixedBody(prefix, body), decode=decode)
+
+
+def iter_json_reviews(lines):
+    """Decodes JSON lines, skipping empty and malformed lines"""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield codec.loads(line)
+        except json.JSONDecodeError:  # Just in case
+            continue
+
+
+def iter_reviews(body):
+    """Yields the reviews of a file in either format as dicts"""
+    kind, records = open_input(body)
+    if kind == "columnar":
+        for block in records:
+            yield from block.rows()
+    else:
+        yield from iter_json_reviews(records)
+
+
+def iter_review_groups(kind, records):
+    """
+    The reviews of open_input(...) in groups of one block or one line, after a group
+    records.offset is at the end of it (where a checkpoint can be made)
+    """
+    if kind == "columnar":
+        for block in records:
+            yield block.rows()
+    else:
+        for line in records:
+            yield iter_json_reviews((line,))
+
+
+class JsonLinesWriter:
+    """Same interface as columnar.ColumnarWriter, but writes one JSON line per review"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows_written = 0
+
+    def write_row(self, row):
+        self.writer.write_line(codec.dumps(row))
+        self.rows_written += 1
+
+    def write_raw(self, line):
+        """Writes a review that is already a JSON line (bytes)"""
+        self.writer.write_raw_line(line)
+        self.rows_written += 1
+
+    def flush(self):
+        pass
+
+
+def open_output(writer, fmt="jsonl"):
+    """Returns a writer for reviews in the given format on top of a MultipartWriter"""
+    if fmt == "columnar":
+        return columnar.ColumnarWriter(writer)
+    if fmt == "jsonl":
+        return JsonLinesWriter(writer)
+    raise ValueError(f"Unknown format {fmt!r}, use 'jsonl' or 'columnar'")
+
+
+def put_kwargs(fmt="jsonl"):
+    """Extra arguments for put_object / create_multipart_upload for files in the given format"""
+    if fmt == "columnar":
+        return {"ContentType": columnar.CONTENT_TYPE}
+    return {}
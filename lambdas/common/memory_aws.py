@@ -0,0 +1,1890 @@
+"""
+In-memory stand-ins for the AWS services of the pipeline (S3, DynamoDB, SSM and Lambda),
+so the tests and the benchmarks run in one process in seconds, without LocalStack.
+
+They take the same arguments and return the same shapes as the boto3 clients for the
+calls the lambdas and tools make, and fail the same way: a botocore ClientError with the
+same error code (NoSuchKey, InvalidRange, ConditionalCheckFailedException,
+TransactionCanceledException with its CancellationReasons, ParameterNotFound, ...),
+also available as client.exceptions.<Code>.
+
+- S3: objects with ETag and headers, ranged GETs, multipart uploads (parts below 5 MiB
+  but the last are refused like by S3), part copies, listing and bucket notifications,
+  which invoke the registered lambda functions.
+- DynamoDB: the low-level client and the resource (Table, batch_get_item). Update,
+  condition, key condition, filter and projection expressions are evaluated (SET, REMOVE,
+  ADD, DELETE, if_not_exists, list_append, attribute_exists, begins_with, BETWEEN, IN, ...),
+  sparse global secondary indexes, 1 MB pages for query and scan, atomic transactions.
+  Reserved words are not checked.
+- SSM: String/SecureString parameters, get_parameters_by_path with pages of 10.
+- Lambda: handlers registered with register_function run in this process.
+  RequestResponse invocations run right away, Event invocations and S3 notifications
+  are queued until drain() (like the asynchronous invocations of Lambda).
+
+Latency: every call can cost a fixed time plus a time per MB it moves (Latency). The cost
+is the same on every run, so benchmarks against the stand-ins compare like with like.
+With sleep=False nothing waits and the cost is only added up in stats["seconds"].
+
+The lambdas get these instead of boto3 clients through common/aws.py (AWS_BACKEND=memory,
+or aws.set_backend(MemoryAWS(...)) before the handlers are imported).
+"""
+import copy
+import hashlib
+import importlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from collections import Counter, deque
+from datetime import datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from urllib.parse import quote_plus
+
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+MB = 1024 * 1024
+REGION = "us-east-1"
+ACCOUNT_ID = "000000000000"
+
+# Limits of the real services that the lambdas have to respect
+MIN_PART_SIZE = 5 * MB
+MAX_PAGE_BYTES = MB
+MAX_ITEM_BYTES = 400 * 1024
+MAX_BATCH_GET_KEYS = 100
+MAX_BATCH_WRITE_ITEMS = 25
+MAX_TRANSACT_ITEMS = 100
+MAX_PARAMETERS_PER_PAGE = 10
+
+# Asynchronous invocations that fail are run again this often, like Lambda does
+ASYNC_RETRIES = 2
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+# --- Errors ----------------------------------------------------------------
+
+_error_classes = {}
+_error_lock = threading.Lock()
+
+
+def error_class(code):
+    """The ClientError subclass for an error code (one class per code, like client.exceptions)"""
+    with _error_lock:
+        if code not in _error_classes:
+            _error_classes[code] = type(code, (ClientError,), {}) if code.isidentifier() else ClientError
+        return _error_classes[code]
+
+
+def client_error(operation, code, message="", status=400, **response):
+    """The error a boto3 client raises when the service answers with this code"""
+    response.update({
+        "Error": {"Code": code, "Message": message},
+        "ResponseMetadata": {"HTTPStatusCode": status},
+    })
+    return error_class(code)(response, operation)
+
+
+class Exceptions:
+    """client.exceptions: the exception class of every error code of a service"""
+
+    def __init__(self, codes):
+        self.ClientError = ClientError
+        for code in codes:
+            setattr(self, code, error_class(code))
+
+
+class Waiter:
+    """Waiters return at once, the stand-ins have no eventual consistency"""
+
+    def __init__(self, check):
+        self.check = check
+
+    def wait(self, WaiterConfig=None, **kwargs):
+        self.check(**kwargs)
+
+
+def _ok(status=200, **response):
+    response["ResponseMetadata"] = {"HTTPStatusCode": status}
+    return response
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+# --- Latency ---------------------------------------------------------------
+
+class Latency:
+    """
+    Deterministic cost of a call: `ms` per call (or operations["s3.get_object"] etc. for
+    single operations) plus `ms_per_mb` for every MB the call sends or receives.
+    """
+
+    def __init__(self, ms=0.0, ms_per_mb=0.0, operations=None, sleep=True):
+        self.ms = float(ms)
+        self.ms_per_mb = float(ms_per_mb)
+        self.operations = dict(operations or {})
+        self.sleep = sleep
+
+    @classmethod
+    def from_env(cls):
+        """MEMORY_LATENCY_MS, MEMORY_LATENCY_MS_PER_MB and MEMORY_LATENCY_SLEEP (0 only counts the time)"""
+        return cls(
+            ms=os.environ.get("MEMORY_LATENCY_MS", "0"),
+            ms_per_mb=os.environ.get("MEMORY_LATENCY_MS_PER_MB", "0"),
+            sleep=os.environ.get("MEMORY_LATENCY_SLEEP", "1") not in ("0", "false", "no"),
+        )
+
+    def seconds(self, operation, nbytes=0):
+        return (self.operations.get(operation, self.ms) + self.ms_per_mb * nbytes / MB) / 1000
+
+
+# --- S3 --------------------------------------------------------------------
+
+class _Object:
+    __slots__ = ("data", "etag", "content_type", "content_encoding", "metadata", "last_modified")
+
+    def __init__(self, data, etag, content_type=None, content_encoding=None, metadata=None):
+        self.data = data
+        self.etag = etag
+        self.content_type = content_type or "binary/octet-stream"
+        self.content_encoding = content_encoding
+        self.metadata = dict(metadata or {})
+        self.last_modified = _now()
+
+    def headers(self):
+        headers = {
+            "ContentLength": len(self.data),
+            "ETag": self.etag,
+            "ContentType": self.content_type,
+            "LastModified": self.last_modified,
+            "Metadata": dict(self.metadata),
+            "AcceptRanges": "bytes",
+        }
+        if self.content_encoding:
+            headers["ContentEncoding"] = self.content_encoding
+        return headers
+
+
+def _read_body(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return bytes(body)
+    return body.read()
+
+
+def _md5_etag(data):
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+def _parse_range(value, size):
+    """(first, last) byte of a "bytes=a-b", "bytes=a-" or "bytes=-n" header, None if unsatisfiable"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        n = int(match.group(2))
+        return (max(0, size - n), size - 1) if n and size else None
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else size - 1
+    if first >= size or last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+class MemoryS3:
+    """The S3 client"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.buckets = {}
+        self.notifications = {}
+        self.uploads = {}
+        self._lock = threading.RLock()
+        self.meta = SimpleNamespace(region_name=REGION, endpoint_url="memory://s3")
+        self.exceptions = Exceptions([
+            "NoSuchBucket", "NoSuchKey", "NoSuchUpload", "BucketAlreadyOwnedByYou", "BucketNotEmpty",
+            "InvalidRange", "InvalidPart", "InvalidPartOrder", "EntityTooSmall", "PreconditionFailed",
+        ])
+
+    def _charge(self, operation, nbytes=0):
+        self.backend.charge("s3." + operation, nbytes)
+
+    def _bucket(self, operation, bucket):
+        if bucket not in self.buckets:
+            raise client_error(operation, "NoSuchBucket", "The specified bucket does not exist", 404,
+                               BucketName=bucket)
+        return self.buckets[bucket]
+
+    def _object(self, operation, bucket, key):
+        obj = self._bucket(operation, bucket).get(key)
+        if obj is None:
+            raise client_error(operation, "NoSuchKey", "The specified key does not exist.", 404, Key=key)
+        return obj
+
+    # Buckets
+
+    def create_bucket(self, Bucket, **kwargs):
+        self._charge("create_bucket")
+        with self._lock:
+            if Bucket in self.buckets:
+                raise client_error("CreateBucket", "BucketAlreadyOwnedByYou",
+                                   "Your previous request to create the named bucket succeeded and you already own it.",
+                                   409)
+            self.buckets[Bucket] = {}
+        return _ok(Location=f"/{Bucket}")
+
+    def delete_bucket(self, Bucket, **kwargs):
+        self._charge("delete_bucket")
+        with self._lock:
+            if self._bucket("DeleteBucket", Bucket):
+                raise client_error("DeleteBucket", "BucketNotEmpty", "The bucket you tried to delete is not empty", 409)
+            del self.buckets[Bucket]
+            self.notifications.pop(Bucket, None)
+        return _ok(204)
+
+    def head_bucket(self, Bucket, **kwargs):
+        self._charge("head_bucket")
+        if Bucket not in self.buckets:
+            raise client_error("HeadBucket", "404", "Not Found", 404)
+        return _ok()
+
+    def list_buckets(self, **kwargs):
+        self._charge("list_buckets")
+        with self._lock:
+            return _ok(Buckets=[{"Name": name, "CreationDate": _now()} for name in sorted(self.buckets)])
+
+    # Objects
+
+    def put_object(self, Bucket, Key, Body=b"", ContentType=None, ContentEncoding=None, Metadata=None, **kwargs):
+        data = _read_body(Body)
+        self._charge("put_object", len(data))
+        obj = _Object(data, _md5_etag(data), ContentType, ContentEncoding, Metadata)
+        with self._lock:
+            self._bucket("PutObject", Bucket)[Key] = obj
+        self._notify(Bucket, Key, obj, "ObjectCreated:Put")
+        return _ok(ETag=obj.etag)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        with self._lock:
+            obj = self._object("GetObject", Bucket, Key)
+        if IfMatch is not None and IfMatch.strip('"') != obj.etag.strip('"'):
+            raise client_error("GetObject", "PreconditionFailed",
+                               "At least one of the pre-conditions you specified did not hold", 412)
+        response = obj.headers()
+        data = obj.data
+        status = 200
+        if Range:
+            bounds = _parse_range(Range, len(data))
+            if bounds is None:
+                raise client_error("GetObject", "InvalidRange", "The requested range is not satisfiable", 416,
+                                   ActualObjectSize=str(len(data)), RangeRequested=Range)
+            first, last = bounds
+            response["ContentRange"] = f"bytes {first}-{last}/{len(data)}"
+            data = data[first:last + 1]
+            status = 206
+        self._charge("get_object", len(data))
+        response["ContentLength"] = len(data)
+        response["Body"] = StreamingBody(io.BytesIO(data), len(data))
+        return _ok(status, **response)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._charge("head_object")
+        with self._lock:
+            if Key not in self._bucket("HeadObject", Bucket):
+                # HEAD responses have no body, so boto3 only knows the status
+                raise client_error("HeadObject", "404", "Not Found", 404)
+            return _ok(**self.buckets[Bucket][Key].headers())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._charge("delete_object")
+        with self._lock:
+            self._bucket("DeleteObject", Bucket).pop(Key, None)
+        return _ok(204)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._charge("delete_objects")
+        with self._lock:
+            bucket = self._bucket("DeleteObjects", Bucket)
+            for obj in Delete["Objects"]:
+                bucket.pop(obj["Key"], None)
+        return _ok(Deleted=[{"Key": obj["Key"]} for obj in Delete["Objects"]])
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        source = self._copy_source("CopyObject", CopySource)
+        self._charge("copy_object")
+        obj = _Object(source.data, source.etag, kwargs.get("ContentType", source.content_type),
+                      kwargs.get("ContentEncoding", source.content_encoding), kwargs.get("Metadata", source.metadata))
+        with self._lock:
+            self._bucket("CopyObject", Bucket)[Key] = obj
+        self._notify(Bucket, Key, obj, "ObjectCreated:Copy")
+        return _ok(CopyObjectResult={"ETag": obj.etag, "LastModified": obj.last_modified})
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None, **kwargs):
+        self._charge("list_objects_v2")
+        with self._lock:
+            keys = sorted(key for key in self._bucket("ListObjectsV2", Bucket) if key.startswith(Prefix))
+            after = ContinuationToken or StartAfter
+            if after:
+                keys = [key for key in keys if key > after]
+            page = keys[:MaxKeys]
+            contents = [{"Key": key, "Size": len(self.buckets[Bucket][key].data),
+                         "ETag": self.buckets[Bucket][key].etag,
+                         "LastModified": self.buckets[Bucket][key].last_modified} for key in page]
+        response = _ok(Name=Bucket, Prefix=Prefix, KeyCount=len(page), MaxKeys=MaxKeys,
+                       IsTruncated=len(keys) > len(page))
+        if contents:
+            response["Contents"] = contents
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    # Multipart uploads
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, ContentEncoding=None, Metadata=None, **kwargs):
+        self._charge("create_multipart_upload")
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._bucket("CreateMultipartUpload", Bucket)
+            self.uploads[upload_id] = SimpleNamespace(bucket=Bucket, key=Key, parts={}, headers=(
+                ContentType, ContentEncoding, Metadata))
+        return _ok(Bucket=Bucket, Key=Key, UploadId=upload_id)
+
+    def _upload(self, operation, bucket, key, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None or (upload.bucket, upload.key) != (bucket, key):
+            raise client_error(operation, "NoSuchUpload", "The specified upload does not exist.", 404)
+        return upload
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = _read_body(Body)
+        self._charge("upload_part", len(data))
+        if not 1 <= PartNumber <= 10000:
+            raise client_error("UploadPart", "InvalidArgument", "Part number must be between 1 and 10000")
+        etag = _md5_etag(data)
+        with self._lock:
+            self._upload("UploadPart", Bucket, Key, UploadId).parts[PartNumber] = (data, etag)
+        return _ok(ETag=etag)
+
+    def _copy_source(self, operation, source):
+        if isinstance(source, str):
+            bucket, _, key = source.lstrip("/").partition("/")
+            source = {"Bucket": bucket, "Key": key}
+        with self._lock:
+            return self._object(operation, source["Bucket"], source["Key"])
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None, **kwargs):
+        data = self._copy_source("UploadPartCopy", CopySource).data
+        if CopySourceRange:
+            bounds = _parse_range(CopySourceRange, len(data))
+            if bounds is None:
+                raise client_error("UploadPartCopy", "InvalidRange", "The requested range is not satisfiable", 416)
+            data = data[bounds[0]:bounds[1] + 1]
+        # A copy on the server, nothing goes over the network
+        self._charge("upload_part_copy")
+        etag = _md5_etag(data)
+        with self._lock:
+            self._upload("UploadPartCopy", Bucket, Key, UploadId).parts[PartNumber] = (data, etag)
+        return _ok(CopyPartResult={"ETag": etag, "LastModified": _now()})
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload=None, **kwargs):
+        self._charge("complete_multipart_upload")
+        operation = "CompleteMultipartUpload"
+        with self._lock:
+            upload = self._upload(operation, Bucket, Key, UploadId)
+            parts = (MultipartUpload or {}).get("Parts", [])
+            if not parts:
+                raise client_error(operation, "MalformedXML", "The XML you provided was not well-formed")
+            numbers = [part["PartNumber"] for part in parts]
+            if numbers != sorted(set(numbers)):
+                raise client_error(operation, "InvalidPartOrder", "The list of parts was not in ascending order.")
+            chunks = []
+            for i, part in enumerate(parts):
+                uploaded = upload.parts.get(part["PartNumber"])
+                if uploaded is None or uploaded[1].strip('"') != part.get("ETag", "").strip('"'):
+                    raise client_error(operation, "InvalidPart", "One or more of the specified parts could not be found.")
+                if i < len(parts) - 1 and len(uploaded[0]) < MIN_PART_SIZE:
+                    raise client_error(operation, "EntityTooSmall",
+                                       "Your proposed upload is smaller than the minimum allowed size")
+                chunks.append(uploaded)
+            digest = hashlib.md5(b"".join(bytes.fromhex(etag.strip('"')) for _, etag in chunks)).hexdigest()
+            content_type, content_encoding, metadata = upload.headers
+            obj = _Object(b"".join(data for data, _ in chunks), f'"{digest}-{len(chunks)}"',
+                          content_type, content_encoding, metadata)
+            self._bucket(operation, Bucket)[Key] = obj
+            del self.uploads[UploadId]
+        self._notify(Bucket, Key, obj, "ObjectCreated:CompleteMultipartUpload")
+        return _ok(Bucket=Bucket, Key=Key, ETag=obj.etag, Location=f"memory://{Bucket}/{Key}")
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._charge("abort_multipart_upload")
+        with self._lock:
+            self._upload("AbortMultipartUpload", Bucket, Key, UploadId)
+            del self.uploads[UploadId]
+        return _ok(204)
+
+    # Notifications
+
+    def put_bucket_notification_configuration(self, Bucket, NotificationConfiguration, **kwargs):
+        self._charge("put_bucket_notification_configuration")
+        with self._lock:
+            self._bucket("PutBucketNotificationConfiguration", Bucket)
+            self.notifications[Bucket] = copy.deepcopy(NotificationConfiguration)
+        return _ok()
+
+    def get_bucket_notification_configuration(self, Bucket, **kwargs):
+        self._charge("get_bucket_notification_configuration")
+        with self._lock:
+            self._bucket("GetBucketNotificationConfiguration", Bucket)
+            return _ok(**copy.deepcopy(self.notifications.get(Bucket, {})))
+
+    def _notify(self, bucket, key, obj, event_name):
+        """Queues the S3 event for every lambda configuration of the bucket that matches"""
+        with self._lock:
+            configs = self.notifications.get(bucket, {}).get("LambdaFunctionConfigurations", [])
+        for config in configs:
+            if not any(event in ("s3:ObjectCreated:*", "s3:" + event_name) for event in config.get("Events", [])):
+                continue
+            rules = {rule["Name"].lower(): rule["Value"]
+                     for rule in config.get("Filter", {}).get("Key", {}).get("FilterRules", [])}
+            if not key.startswith(rules.get("prefix", "")) or not key.endswith(rules.get("suffix", "")):
+                continue
+            record = {
+                "eventVersion": "2.1",
+                "eventSource": "aws:s3",
+                "awsRegion": REGION,
+                "eventTime": _now().isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+                "eventName": event_name,
+                "s3": {
+                    "s3SchemaVersion": "1.0",
+                    "configurationId": config.get("Id", "notification"),
+                    "bucket": {"name": bucket, "arn": f"arn:aws:s3:::{bucket}"},
+                    # Keys are URL encoded in the events, like in S3
+                    "object": {"key": quote_plus(key, safe="/"), "size": len(obj.data),
+                               "eTag": obj.etag.strip('"'), "sequencer": f"{time.time_ns():016X}"},
+                },
+            }
+            self.backend.lambda_.enqueue(config["LambdaFunctionArn"], {"Records": [record]})
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+# --- DynamoDB expressions ----------------------------------------------------
+
+_MISSING = object()
+
+_TOKEN = re.compile(r"\s*(?:(<>|<=|>=|[=<>(),.\[\]+\-])|(:\w+)|(#\w+)|(\d+)|([A-Za-z_]\w*))")
+
+CONDITION_FUNCTIONS = {"attribute_exists", "attribute_not_exists", "attribute_type", "begins_with", "contains"}
+OPERAND_FUNCTIONS = {"size", "if_not_exists", "list_append"}
+
+
+def dynamo_type(value):
+    """The DynamoDB type of a python value (as TypeDeserializer returns them)"""
+    if isinstance(value, bool):
+        return "BOOL"
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "S"
+    if isinstance(value, (Decimal, int, float)):
+        return "N"
+    if isinstance(value, (bytes, bytearray, Binary)):
+        return "B"
+    if isinstance(value, dict):
+        return "M"
+    if isinstance(value, (list, tuple)):
+        return "L"
+    if isinstance(value, (set, frozenset)):
+        element = next(iter(value), "")
+        return {"S": "SS", "N": "NS", "B": "BS"}.get(dynamo_type(element), "SS")
+    raise TypeError(f"Unsupported type {type(value).__name__}")
+
+
+def _sort_key(value):
+    """Order of key values: numbers by value, strings by their UTF-8 bytes, binary by bytes"""
+    kind = dynamo_type(value)
+    if kind == "N":
+        return (0, Decimal(value))
+    if kind == "S":
+        return (1, value.encode("utf-8"))
+    return (2, bytes(value.value if isinstance(value, Binary) else value))
+
+
+def value_size(value):
+    """About the size DynamoDB counts for a value"""
+    kind = dynamo_type(value)
+    if kind == "S":
+        return len(value.encode("utf-8"))
+    if kind == "N":
+        return len(str(value)) // 2 + 2
+    if kind == "B":
+        return len(value.value if isinstance(value, Binary) else value)
+    if kind in ("BOOL", "NULL"):
+        return 1
+    if kind == "M":
+        return 3 + sum(len(name.encode("utf-8")) + value_size(v) + 1 for name, v in value.items())
+    if kind == "L":
+        return 3 + sum(value_size(v) + 1 for v in value)
+    return sum(value_size(v) for v in value)
+
+
+def item_size(item):
+    return sum(len(name.encode("utf-8")) + value_size(value) for name, value in item.items())
+
+
+def _get_path(item, path):
+    value = item
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(value, list) or part >= len(value):
+                return _MISSING
+        elif not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set_path(operation, item, path, value):
+    parent = _get_path(item, path[:-1])
+    last = path[-1]
+    if isinstance(last, int) and isinstance(parent, list):
+        if last < len(parent):
+            parent[last] = value
+        else:
+            parent.append(value)
+    elif isinstance(last, str) and isinstance(parent, dict):
+        parent[last] = value
+    else:
+        raise client_error(operation, "ValidationException",
+                           "The document path provided in the update expression is invalid for update")
+
+
+def _remove_path(item, path):
+    parent = _get_path(item, path[:-1])
+    last = path[-1]
+    if isinstance(last, int) and isinstance(parent, list) and last < len(parent):
+        del parent[last]
+    elif isinstance(last, str) and isinstance(parent, dict):
+        parent.pop(last, None)
+
+
+def _compare(op, a, b):
+    if a is _MISSING or b is _MISSING:
+        return op == "<>" and (a is not _MISSING or b is not _MISSING)
+    same_type = dynamo_type(a) == dynamo_type(b)
+    if op == "=":
+        return same_type and a == b
+    if op == "<>":
+        return not same_type or a != b
+    if not same_type or dynamo_type(a) not in ("S", "N", "B"):
+        return False
+    a, b = _sort_key(a), _sort_key(b)
+    return {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op]
+
+
+def _contains(container, value):
+    if isinstance(container, str):
+        return isinstance(value, str) and value in container
+    if isinstance(container, (set, frozenset, list)):
+        return value in container
+    return False
+
+
+class Expression:
+    """
+    Parses one expression of a request. The placeholders (#name, :value) are looked up in
+    the request's ExpressionAttributeNames/Values, the ones that were used are remembered,
+    so unused ones can be refused like DynamoDB does.
+    """
+
+    def __init__(self, operation, text, names, values, kind):
+        self.operation = operation
+        self.text = text
+        self.kind = kind
+        self.names = names
+        self.values = values
+        self.used_names = set()
+        self.used_values = set()
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if not match:
+                self.error(f"Syntax error; token: \"{text[position:].split()[0]}\"")
+            self.tokens.append(next((i, group) for i, group in enumerate(match.groups()) if group is not None))
+            position = match.end()
+        self.pos = 0
+
+    def error(self, message):
+        raise client_error(self.operation, "ValidationException", f"Invalid {self.kind}: {message}")
+
+    # Tokens
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            self.error("Syntax error; token: <EOF>")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def accept(self, symbol):
+        if self.peek() == (0, symbol):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, symbol):
+        if not self.accept(symbol):
+            self.error(f"Syntax error; token: \"{self.peek()[1] or '<EOF>'}\", expected \"{symbol}\"")
+
+    def accept_word(self, word):
+        kind, text = self.peek()
+        if kind == 4 and text.upper() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def at_end(self):
+        return self.pos >= len(self.tokens)
+
+    def done(self):
+        if not self.at_end():
+            self.error(f"Syntax error; token: \"{self.peek()[1]}\"")
+
+    # Operands
+
+    def name(self, token):
+        kind, text = token
+        if kind == 2:
+            if text not in self.names:
+                self.error(f"An expression attribute name used in the document path is not defined; "
+                           f"attribute name: {text}")
+            self.used_names.add(text)
+            return self.names[text]
+        if kind == 4:
+            return text
+        self.error(f"Syntax error; token: \"{text}\"")
+
+    def path(self):
+        path = [self.name(self.next())]
+        while True:
+            if self.accept("."):
+                path.append(self.name(self.next()))
+            elif self.accept("["):
+                kind, text = self.next()
+                if kind != 3:
+                    self.error(f"Syntax error; token: \"{text}\"")
+                path.append(int(text))
+                self.expect("]")
+            else:
+                return tuple(path)
+
+    def value(self, token):
+        text = token[1]
+        if text not in self.values:
+            self.error(f"An expression attribute value used in expression is not defined; attribute value: {text}")
+        self.used_values.add(text)
+        value = self.values[text]
+        return lambda item: value
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 1:
+            return self.value(self.next())
+        if kind == 4 and text.lower() in OPERAND_FUNCTIONS and self.peek(1) == (0, "("):
+            self.next()
+            self.expect("(")
+            function = text.lower()
+            if function == "size":
+                path = self.path()
+                self.expect(")")
+
+                def size(item):
+                    value = _get_path(item, path)
+                    if value is _MISSING:
+                        return _MISSING
+                    return Decimal(len(value.encode("utf-8") if isinstance(value, str) else value))
+                return size
+            if function == "if_not_exists":
+                path = self.path()
+                self.expect(",")
+                default = self.operand()
+                self.expect(")")
+
+                def if_not_exists(item):
+                    value = _get_path(item, path)
+                    return default(item) if value is _MISSING else value
+                return if_not_exists
+            first = self.operand()
+            self.expect(",")
+            second = self.operand()
+            self.expect(")")
+
+            def list_append(item):
+                a, b = first(item), second(item)
+                if not isinstance(a, list) or not isinstance(b, list):
+                    self.error("Incorrect operand type for operator or function; operator or function: list_append")
+                return a + b
+            return list_append
+        path = self.path()
+        return lambda item: _get_path(item, path)
+
+    # Conditions (key conditions, filters and ConditionExpression)
+
+    def condition(self):
+        left = self.conjunction()
+        while self.accept_word("OR"):
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept_word("AND"):
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.accept_word("NOT"):
+            inner = self.negation()
+            return lambda item: not inner(item)
+        return self.primary()
+
+    def primary(self):
+        if self.accept("("):
+            inner = self.condition()
+            self.expect(")")
+            return inner
+        kind, text = self.peek()
+        if kind == 4 and text.lower() in CONDITION_FUNCTIONS and self.peek(1) == (0, "("):
+            return self.function()
+        left = self.operand()
+        kind, op = self.peek()
+        if kind == 0 and op in ("=", "<>", "<", "<=", ">", ">="):
+            self.next()
+            right = self.operand()
+            return lambda item: _compare(op, left(item), right(item))
+        if self.accept_word("BETWEEN"):
+            low = self.operand()
+            if not self.accept_word("AND"):
+                self.error("Syntax error; BETWEEN needs AND")
+            high = self.operand()
+            return lambda item: _compare(">=", left(item), low(item)) and _compare("<=", left(item), high(item))
+        if self.accept_word("IN"):
+            self.expect("(")
+            options = [self.operand()]
+            while self.accept(","):
+                options.append(self.operand())
+            self.expect(")")
+            return lambda item: any(_compare("=", left(item), option(item)) for option in options)
+        self.error(f"Syntax error; token: \"{op or '<EOF>'}\"")
+
+    def function(self):
+        function = self.next()[1].lower()
+        self.expect("(")
+        path = self.path()
+        if function == "attribute_exists":
+            self.expect(")")
+            return lambda item: _get_path(item, path) is not _MISSING
+        if function == "attribute_not_exists":
+            self.expect(")")
+            return lambda item: _get_path(item, path) is _MISSING
+        self.expect(",")
+        argument = self.operand()
+        self.expect(")")
+        if function == "attribute_type":
+            return lambda item: (_get_path(item, path) is not _MISSING
+                                 and dynamo_type(_get_path(item, path)) == argument(item))
+        if function == "begins_with":
+            def begins_with(item):
+                value, prefix = _get_path(item, path), argument(item)
+                if isinstance(value, str) and isinstance(prefix, str):
+                    return value.startswith(prefix)
+                if value is not _MISSING and dynamo_type(value) == dynamo_type(prefix) == "B":
+                    return _sort_key(value)[1].startswith(_sort_key(prefix)[1])
+                return False
+            return begins_with
+        return lambda item: _get_path(item, path) is not _MISSING and _contains(_get_path(item, path), argument(item))
+
+    def parse_condition(self):
+        condition = self.condition()
+        self.done()
+        return condition
+
+    # Updates
+
+    def parse_update(self):
+        """[(action, path, value function)] of an UpdateExpression"""
+        actions = []
+        clauses = set()
+        while not self.at_end():
+            kind, clause = self.next()
+            clause = clause.upper()
+            if kind != 4 or clause not in ("SET", "REMOVE", "ADD", "DELETE"):
+                self.error(f"Syntax error; token: \"{clause}\"")
+            if clause in clauses:
+                self.error(f"The \"{clause}\" section can only be used once in an update expression")
+            clauses.add(clause)
+            while True:
+                path = self.path()
+                if clause == "SET":
+                    self.expect("=")
+                    value = self.operand()
+                    if self.peek() in ((0, "+"), (0, "-")):
+                        value = self.arithmetic(value, self.next()[1], self.operand())
+                elif clause == "REMOVE":
+                    value = None
+                else:
+                    value = self.operand()
+                actions.append((clause, path, value))
+                if not self.accept(","):
+                    break
+        if not actions:
+            self.error("The expression can not be empty")
+        return actions
+
+    def arithmetic(self, left, op, right):
+        def apply(item):
+            a, b = left(item), right(item)
+            if a is _MISSING or b is _MISSING:
+                self.error("The provided expression refers to an attribute that does not exist in the item")
+            if dynamo_type(a) != "N" or dynamo_type(b) != "N":
+                self.error(f"Incorrect operand type for operator or function; operator: {op}")
+            return Decimal(a) + Decimal(b) if op == "+" else Decimal(a) - Decimal(b)
+        return apply
+
+    def parse_projection(self):
+        paths = [self.path()]
+        while self.accept(","):
+            paths.append(self.path())
+        self.done()
+        return paths
+
+
+def _project(item, paths):
+    """The attributes of the item that are in the projection (nested maps are kept as maps)"""
+    result = {}
+    for path in paths:
+        value = _get_path(item, path)
+        if value is _MISSING:
+            continue
+        target = result
+        for i, part in enumerate(path[:-1]):
+            if isinstance(path[i + 1], int):
+                # Elements of a list are put together in order, like DynamoDB does
+                target = target.setdefault(part, [])
+                break
+            target = target.setdefault(part, {})
+        if isinstance(target, list):
+            target.append(copy.deepcopy(value))
+        else:
+            target[path[-1]] = copy.deepcopy(value)
+    return result
+
+
+class Request:
+    """The expressions of one request, and the check that every placeholder was used"""
+
+    def __init__(self, operation, kwargs):
+        self.operation = operation
+        self.names = kwargs.get("ExpressionAttributeNames") or {}
+        self.values = {name: _deserializer.deserialize(value)
+                       for name, value in (kwargs.get("ExpressionAttributeValues") or {}).items()}
+        self.expressions = []
+
+    def parse(self, text, kind):
+        expression = Expression(self.operation, text, self.names, self.values, kind)
+        self.expressions.append(expression)
+        return expression
+
+    def condition(self, text, kind="ConditionExpression"):
+        return self.parse(text, kind).parse_condition() if text else None
+
+    def projection(self, text):
+        return self.parse(text, "ProjectionExpression").parse_projection() if text else None
+
+    def update(self, text):
+        return self.parse(text, "UpdateExpression").parse_update()
+
+    def check_unused(self):
+        used_names = set().union(*(e.used_names for e in self.expressions)) if self.expressions else set()
+        used_values = set().union(*(e.used_values for e in self.expressions)) if self.expressions else set()
+        unused = sorted(set(self.names) - used_names)
+        if unused:
+            raise client_error(self.operation, "ValidationException",
+                               f"Value provided in ExpressionAttributeNames unused in expressions: keys: {{{', '.join(unused)}}}")
+        unused = sorted(set(self.values) - used_values)
+        if unused:
+            raise client_error(self.operation, "ValidationException",
+                               f"Value provided in ExpressionAttributeValues unused in expressions: keys: {{{', '.join(unused)}}}")
+
+
+# --- DynamoDB tables ---------------------------------------------------------
+
+def _serialize_item(item):
+    return {name: _serializer.serialize(value) for name, value in item.items()}
+
+
+def _deserialize_item(item):
+    return {name: _deserializer.deserialize(value) for name, value in item.items()}
+
+
+class _Table:
+    def __init__(self, kwargs):
+        self.name = kwargs["TableName"]
+        self.key_schema = kwargs["KeySchema"]
+        self.attribute_definitions = kwargs.get("AttributeDefinitions", [])
+        self.hash_key, self.range_key = self._keys(self.key_schema)
+        self.billing_mode = kwargs.get("BillingMode", "PROVISIONED")
+        self.throughput = kwargs.get("ProvisionedThroughput") or {"ReadCapacityUnits": 0, "WriteCapacityUnits": 0}
+        self.indexes = {}
+        for index in kwargs.get("GlobalSecondaryIndexes", []) + kwargs.get("LocalSecondaryIndexes", []):
+            hash_key, range_key = self._keys(index["KeySchema"])
+            self.indexes[index["IndexName"]] = SimpleNamespace(
+                schema=index, hash_key=hash_key, range_key=range_key, projection=index.get("Projection", {}))
+        self.items = {}
+        self.created = _now()
+
+    @staticmethod
+    def _keys(schema):
+        keys = {key["KeyType"]: key["AttributeName"] for key in schema}
+        return keys["HASH"], keys.get("RANGE")
+
+    @property
+    def key_names(self):
+        return [self.hash_key] + ([self.range_key] if self.range_key else [])
+
+    def key_of(self, operation, item, full_item=False):
+        """The key (tuple) of an item or a Key argument, with the checks of DynamoDB"""
+        if not full_item and set(item) != set(self.key_names):
+            raise client_error(operation, "ValidationException", "The provided key element does not match the schema")
+        key = []
+        for name in self.key_names:
+            value = item.get(name, _MISSING)
+            if value is _MISSING:
+                raise client_error(operation, "ValidationException",
+                                   f"One or more parameter values were invalid: Missing the key {name} in the item")
+            if dynamo_type(value) not in ("S", "N", "B") or value == "":
+                raise client_error(operation, "ValidationException",
+                                   "One or more parameter values were invalid: Type mismatch for key")
+            key.append(value)
+        return tuple(key)
+
+    def key_item(self, item, index=None):
+        names = list(self.key_names)
+        if index is not None:
+            names += [name for name in (index.hash_key, index.range_key) if name and name not in names]
+        return {name: item[name] for name in names}
+
+    def description(self):
+        description = {
+            "TableName": self.name,
+            "TableArn": f"arn:aws:dynamodb:{REGION}:{ACCOUNT_ID}:table/{self.name}",
+            "TableStatus": "ACTIVE",
+            "KeySchema": self.key_schema,
+            "AttributeDefinitions": self.attribute_definitions,
+            "CreationDateTime": self.created,
+            "ItemCount": len(self.items),
+            "TableSizeBytes": sum(item_size(item) for item in self.items.values()),
+            "ProvisionedThroughput": dict(self.throughput, NumberOfDecreasesToday=0),
+            "BillingModeSummary": {"BillingMode": self.billing_mode},
+        }
+        if self.indexes:
+            description["GlobalSecondaryIndexes"] = [
+                dict(index.schema, IndexStatus="ACTIVE") for index in self.indexes.values()]
+        return description
+
+    def ordered(self, index=None):
+        """Items in the order of a scan: by a hash of the partition key, then by sort key"""
+        hash_key, range_key = (index.hash_key, index.range_key) if index else (self.hash_key, self.range_key)
+        items = [item for item in self.items.values()
+                 if hash_key in item and (range_key is None or range_key in item)]
+
+        def order(item):
+            partition = zlib.crc32(repr(_sort_key(item[hash_key])).encode("utf-8"))
+            return (partition, _sort_key(item[range_key]) if range_key else (0, 0))
+        return sorted(items, key=order)
+
+    def project_index(self, item, index):
+        if index is None or index.projection.get("ProjectionType", "ALL") == "ALL":
+            return item
+        projected = self.key_item(item, index)
+        if index.projection.get("ProjectionType") == "INCLUDE":
+            for name in index.projection.get("NonKeyAttributes", []):
+                if name in item:
+                    projected[name] = item[name]
+        return projected
+
+
+class MemoryDynamoDB:
+    """The DynamoDB client (AttributeValues like {"S": "..."} in and out)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.tables = {}
+        self._lock = threading.RLock()
+        self.meta = SimpleNamespace(region_name=REGION, endpoint_url="memory://dynamodb")
+        self.exceptions = Exceptions([
+            "ResourceNotFoundException", "ResourceInUseException", "ValidationException",
+            "ConditionalCheckFailedException", "TransactionCanceledException",
+            "ProvisionedThroughputExceededException", "ThrottlingException",
+        ])
+
+    def _charge(self, operation, nbytes=0):
+        self.backend.charge("dynamodb." + operation, nbytes)
+
+    def _table(self, operation, name):
+        table = self.tables.get(name)
+        if table is None:
+            raise client_error(operation, "ResourceNotFoundException", "Requested resource not found")
+        return table
+
+    # Tables
+
+    def create_table(self, **kwargs):
+        self._charge("create_table")
+        with self._lock:
+            if kwargs["TableName"] in self.tables:
+                raise client_error("CreateTable", "ResourceInUseException",
+                                   f"Table already exists: {kwargs['TableName']}")
+            table = self.tables[kwargs["TableName"]] = _Table(kwargs)
+            return _ok(TableDescription=table.description())
+
+    def delete_table(self, TableName, **kwargs):
+        self._charge("delete_table")
+        with self._lock:
+            table = self._table("DeleteTable", TableName)
+            del self.tables[TableName]
+            return _ok(TableDescription=dict(table.description(), TableStatus="DELETING"))
+
+    def describe_table(self, TableName, **kwargs):
+        self._charge("describe_table")
+        with self._lock:
+            return _ok(Table=self._table("DescribeTable", TableName).description())
+
+    def list_tables(self, **kwargs):
+        self._charge("list_tables")
+        with self._lock:
+            return _ok(TableNames=sorted(self.tables))
+
+    def get_waiter(self, name):
+        def exists(TableName, **kwargs):
+            with self._lock:
+                self._table("DescribeTable", TableName)
+
+        def not_exists(TableName, **kwargs):
+            with self._lock:
+                if TableName in self.tables:
+                    raise client_error("DescribeTable", "ResourceInUseException", "Table still exists")
+        return Waiter({"table_exists": exists, "table_not_exists": not_exists}[name])
+
+    # Items
+
+    def _write(self, operation, table, item, key=None):
+        if item_size(item) > MAX_ITEM_BYTES:
+            raise client_error(operation, "ValidationException", "Item size has exceeded the maximum allowed size")
+        table.items[key or table.key_of(operation, item, full_item=True)] = item
+
+    @staticmethod
+    def _check_condition(operation, condition, item):
+        if condition is not None and not condition(item or {}):
+            raise client_error(operation, "ConditionalCheckFailedException", "The conditional request failed")
+
+    @staticmethod
+    def _return_values(kwargs, old, new, updated=()):
+        mode = kwargs.get("ReturnValues", "NONE")
+        if mode == "ALL_OLD" and old:
+            return {"Attributes": _serialize_item(old)}
+        if mode == "ALL_NEW" and new:
+            return {"Attributes": _serialize_item(new)}
+        if mode in ("UPDATED_OLD", "UPDATED_NEW"):
+            source = old if mode == "UPDATED_OLD" else new
+            attributes = {name: source[name] for name in updated if source and name in source}
+            return {"Attributes": _serialize_item(attributes)} if attributes else {}
+        return {}
+
+    def put_item(self, **kwargs):
+        self._charge("put_item")
+        request = Request("PutItem", kwargs)
+        condition = request.condition(kwargs.get("ConditionExpression"))
+        request.check_unused()
+        item = _deserialize_item(kwargs["Item"])
+        with self._lock:
+            table = self._table("PutItem", kwargs["TableName"])
+            key = table.key_of("PutItem", item, full_item=True)
+            old = table.items.get(key)
+            self._check_condition("PutItem", condition, old)
+            self._write("PutItem", table, item, key)
+        return _ok(**self._return_values(kwargs, old, item))
+
+    def get_item(self, **kwargs):
+        self._charge("get_item")
+        request = Request("GetItem", kwargs)
+        projection = request.projection(kwargs.get("ProjectionExpression"))
+        request.check_unused()
+        with self._lock:
+            table = self._table("GetItem", kwargs["TableName"])
+            item = table.items.get(table.key_of("GetItem", _deserialize_item(kwargs["Key"])))
+            item = copy.deepcopy(item)
+        if item is None:
+            return _ok()
+        return _ok(Item=_serialize_item(_project(item, projection) if projection else item))
+
+    def delete_item(self, **kwargs):
+        self._charge("delete_item")
+        request = Request("DeleteItem", kwargs)
+        condition = request.condition(kwargs.get("ConditionExpression"))
+        request.check_unused()
+        with self._lock:
+            table = self._table("DeleteItem", kwargs["TableName"])
+            key = table.key_of("DeleteItem", _deserialize_item(kwargs["Key"]))
+            old = table.items.get(key)
+            self._check_condition("DeleteItem", condition, old)
+            table.items.pop(key, None)
+        return _ok(**self._return_values(kwargs, old, None))
+
+    def _updated_item(self, operation, table, key_item, actions, old):
+        """The item after the actions of an UpdateExpression (the values are taken from the old item)"""
+        source = old or {}
+        new = copy.deepcopy(old) if old else dict(key_item)
+        paths = [path for _, path, _ in actions]
+        for i, path in enumerate(paths):
+            if path[0] in table.key_names:
+                raise client_error(operation, "ValidationException",
+                                   f"One or more parameter values were invalid: Cannot update attribute {path[0]}. "
+                                   "This attribute is part of the key")
+            for other in paths[i + 1:]:
+                if path[:len(other)] == other[:len(path)]:
+                    raise client_error(operation, "ValidationException",
+                                       "Invalid UpdateExpression: Two document paths overlap with each other")
+        values = [(clause, path, value(source) if value else None) for clause, path, value in actions]
+        for clause, path, value in values:
+            if clause == "SET":
+                if value is _MISSING:
+                    raise client_error(operation, "ValidationException",
+                                       "The provided expression refers to an attribute that does not exist in the item")
+                _set_path(operation, new, path, copy.deepcopy(value))
+            elif clause == "REMOVE":
+                _remove_path(new, path)
+            else:
+                current = _get_path(new, path)
+                kind = dynamo_type(value)
+                if clause == "ADD" and kind == "N":
+                    if current is not _MISSING and dynamo_type(current) != "N":
+                        raise client_error(operation, "ValidationException",
+                                           "An operand in the update expression has an incorrect data type")
+                    _set_path(operation, new, path, Decimal(value) + (current if current is not _MISSING else 0))
+                elif kind in ("SS", "NS", "BS"):
+                    if current is not _MISSING and dynamo_type(current) != kind:
+                        raise client_error(operation, "ValidationException",
+                                           "An operand in the update expression has an incorrect data type")
+                    current = set() if current is _MISSING else set(current)
+                    result = current | set(value) if clause == "ADD" else current - set(value)
+                    if result:
+                        _set_path(operation, new, path, result)
+                    else:
+                        _remove_path(new, path)
+                else:
+                    raise client_error(operation, "ValidationException",
+                                       "An operand in the update expression has an incorrect data type")
+        return new, sorted({path[0] for path in paths})
+
+    def _prepare_update(self, operation, kwargs):
+        request = Request(operation, kwargs)
+        actions = request.update(kwargs["UpdateExpression"]) if kwargs.get("UpdateExpression") else []
+        condition = request.condition(kwargs.get("ConditionExpression"))
+        request.check_unused()
+        return actions, condition
+
+    def update_item(self, **kwargs):
+        self._charge("update_item")
+        actions, condition = self._prepare_update("UpdateItem", kwargs)
+        with self._lock:
+            table = self._table("UpdateItem", kwargs["TableName"])
+            key_item = _deserialize_item(kwargs["Key"])
+            key = table.key_of("UpdateItem", key_item)
+            old = table.items.get(key)
+            self._check_condition("UpdateItem", condition, old)
+            new, updated = self._updated_item("UpdateItem", table, key_item, actions, old)
+            self._write("UpdateItem", table, new, key)
+        return _ok(**self._return_values(kwargs, old, new, updated))
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        """All updates, puts, deletes and condition checks are applied, or none of them"""
+        self._charge("transact_write_items")
+        operation = "TransactWriteItems"
+        if not 1 <= len(TransactItems) <= MAX_TRANSACT_ITEMS:
+            raise client_error(operation, "ValidationException",
+                               f"Member must have length less than or equal to {MAX_TRANSACT_ITEMS}")
+        prepared = []
+        for entry in TransactItems:
+            (kind, request), = entry.items()
+            if kind == "Update":
+                actions, condition = self._prepare_update(operation, request)
+            else:
+                parsed = Request(operation, request)
+                condition = parsed.condition(request.get("ConditionExpression"))
+                parsed.check_unused()
+                actions = None
+            prepared.append((kind, request, actions, condition))
+
+        with self._lock:
+            keys = []
+            for kind, request, _, _ in prepared:
+                table = self._table(operation, request["TableName"])
+                key = table.key_of(operation, _deserialize_item(request["Item"]), full_item=True) if kind == "Put" \
+                    else table.key_of(operation, _deserialize_item(request["Key"]))
+                if (table.name, key) in keys:
+                    raise client_error(operation, "ValidationException",
+                                       "Transaction request cannot include multiple operations on one item")
+                keys.append((table.name, key))
+
+            reasons = []
+            for (kind, request, _, condition), (table_name, key) in zip(prepared, keys):
+                if condition is not None and not condition(self.tables[table_name].items.get(key) or {}):
+                    reasons.append({"Code": "ConditionalCheckFailed", "Message": "The conditional request failed"})
+                else:
+                    reasons.append({"Code": "None"})
+            if any(reason["Code"] != "None" for reason in reasons):
+                raise client_error(operation, "TransactionCanceledException",
+                                   "Transaction cancelled, please refer cancellation reasons for specific reasons "
+                                   f"[{', '.join(reason['Code'] for reason in reasons)}]",
+                                   CancellationReasons=reasons)
+
+            writes = []
+            for (kind, request, actions, _), (table_name, key) in zip(prepared, keys):
+                table = self.tables[table_name]
+                if kind == "Put":
+                    writes.append((table, key, _deserialize_item(request["Item"])))
+                elif kind == "Delete":
+                    writes.append((table, key, None))
+                elif kind == "Update":
+                    new, _ = self._updated_item(operation, table, _deserialize_item(request["Key"]), actions,
+                                                table.items.get(key))
+                    writes.append((table, key, new))
+            for table, key, item in writes:
+                if item is None:
+                    table.items.pop(key, None)
+                else:
+                    self._write(operation, table, item, key)
+        return _ok()
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self._charge("batch_get_item")
+        operation = "BatchGetItem"
+        if sum(len(request["Keys"]) for request in RequestItems.values()) > MAX_BATCH_GET_KEYS:
+            raise client_error(operation, "ValidationException",
+                               "Too many items requested for the BatchGetItem call")
+        responses = {}
+        with self._lock:
+            for table_name, request in RequestItems.items():
+                table = self._table(operation, table_name)
+                parsed = Request(operation, request)
+                projection = parsed.projection(request.get("ProjectionExpression"))
+                parsed.check_unused()
+                keys = [table.key_of(operation, _deserialize_item(key)) for key in request["Keys"]]
+                if len(set(keys)) != len(keys):
+                    raise client_error(operation, "ValidationException",
+                                       "Provided list of item keys contains duplicates")
+                items = [copy.deepcopy(table.items[key]) for key in keys if key in table.items]
+                responses[table_name] = [_serialize_item(_project(item, projection) if projection else item)
+                                         for item in items]
+        return _ok(Responses=responses, UnprocessedKeys={})
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self._charge("batch_write_item")
+        operation = "BatchWriteItem"
+        if sum(len(requests) for requests in RequestItems.values()) > MAX_BATCH_WRITE_ITEMS:
+            raise client_error(operation, "ValidationException",
+                               "Too many items requested for the BatchWriteItem call")
+        with self._lock:
+            for table_name, requests in RequestItems.items():
+                table = self._table(operation, table_name)
+                for request in requests:
+                    if "PutRequest" in request:
+                        self._write(operation, table, _deserialize_item(request["PutRequest"]["Item"]))
+                    else:
+                        table.items.pop(table.key_of(operation, _deserialize_item(request["DeleteRequest"]["Key"])),
+                                        None)
+        return _ok(UnprocessedItems={})
+
+    # Query and scan
+
+    def _read_page(self, operation, kwargs, key_condition=None):
+        request = Request(operation, kwargs)
+        if key_condition is not None:
+            key_condition = request.condition(key_condition, "KeyConditionExpression")
+        filter_condition = request.condition(kwargs.get("FilterExpression"), "FilterExpression")
+        projection = request.projection(kwargs.get("ProjectionExpression"))
+        request.check_unused()
+
+        with self._lock:
+            table = self._table(operation, kwargs["TableName"])
+            index = None
+            if kwargs.get("IndexName"):
+                index = table.indexes.get(kwargs["IndexName"])
+                if index is None:
+                    raise client_error(operation, "ValidationException",
+                                       "The table does not have the specified index: " + kwargs["IndexName"])
+            items = table.ordered(index)
+            if key_condition is not None:
+                items = [item for item in items if key_condition(item)]
+                if not kwargs.get("ScanIndexForward", True):
+                    items.reverse()
+            if kwargs.get("TotalSegments"):
+                items = [item for item in items
+                         if zlib.crc32(repr(table.key_of(operation, item, True)).encode("utf-8"))
+                         % kwargs["TotalSegments"] == kwargs["Segment"]]
+            if kwargs.get("ExclusiveStartKey"):
+                start = table.key_of(operation, _deserialize_item(kwargs["ExclusiveStartKey"]), full_item=True)
+                positions = [i for i, item in enumerate(items) if table.key_of(operation, item, True) == start]
+                items = items[positions[0] + 1:] if positions else []
+            items = [copy.deepcopy(item) for item in items]
+
+        limit = kwargs.get("Limit")
+        page, scanned, size, last = [], 0, 0, None
+        for i, item in enumerate(items):
+            scanned += 1
+            size += item_size(item)
+            item = table.project_index(item, index)
+            if filter_condition is None or filter_condition(item):
+                page.append(_project(item, projection) if projection else item)
+            # A page ends after Limit items were read or about 1 MB
+            if i + 1 < len(items) and ((limit and scanned >= limit) or size >= MAX_PAGE_BYTES):
+                last = table.key_item(items[i], index)
+                break
+        response = {"Count": len(page), "ScannedCount": scanned}
+        if kwargs.get("Select") != "COUNT":
+            response["Items"] = [_serialize_item(item) for item in page]
+        if last is not None:
+            response["LastEvaluatedKey"] = _serialize_item(last)
+        return _ok(**response)
+
+    def query(self, **kwargs):
+        self._charge("query")
+        if not kwargs.get("KeyConditionExpression"):
+            raise client_error("Query", "ValidationException", "Either the KeyConditions or KeyConditionExpression "
+                                                               "parameter must be specified in the request.")
+        return self._read_page("Query", kwargs, kwargs["KeyConditionExpression"])
+
+    def scan(self, **kwargs):
+        self._charge("scan")
+        return self._read_page("Scan", kwargs)
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+# --- DynamoDB resource -----------------------------------------------------
+
+def _build_conditions(kwargs):
+    """Conditions built with boto3.dynamodb.conditions (Key, Attr) to expression strings, like boto3 does"""
+    builder = ConditionExpressionBuilder()
+    for name in ("KeyConditionExpression", "FilterExpression", "ConditionExpression"):
+        if isinstance(kwargs.get(name), ConditionBase):
+            built = builder.build_expression(kwargs[name], is_key_condition=name == "KeyConditionExpression")
+            kwargs[name] = built.condition_expression
+            kwargs.setdefault("ExpressionAttributeNames", {}).update(built.attribute_name_placeholders)
+            kwargs.setdefault("ExpressionAttributeValues", {}).update(built.attribute_value_placeholders)
+    return kwargs
+
+
+def _to_client(kwargs):
+    kwargs = _build_conditions(dict(kwargs))
+    for name in ("Item", "Key", "ExclusiveStartKey", "ExpressionAttributeValues"):
+        if name in kwargs:
+            kwargs[name] = _serialize_item(kwargs[name])
+    return kwargs
+
+
+def _from_client(response):
+    for name in ("Item", "Attributes", "LastEvaluatedKey"):
+        if name in response:
+            response[name] = _deserialize_item(response[name])
+    if "Items" in response:
+        response["Items"] = [_deserialize_item(item) for item in response["Items"]]
+    return response
+
+
+class MemoryTable:
+    """dynamodb.Table(name): python values in and out"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = self.table_name = name
+        self.meta = SimpleNamespace(client=client)
+
+    def _call(self, method, kwargs):
+        return _from_client(getattr(self.client, method)(**_to_client(dict(kwargs, TableName=self.name))))
+
+    def put_item(self, **kwargs):
+        return self._call("put_item", kwargs)
+
+    def get_item(self, **kwargs):
+        return self._call("get_item", kwargs)
+
+    def update_item(self, **kwargs):
+        return self._call("update_item", kwargs)
+
+    def delete_item(self, **kwargs):
+        return self._call("delete_item", kwargs)
+
+    def query(self, **kwargs):
+        return self._call("query", kwargs)
+
+    def scan(self, **kwargs):
+        return self._call("scan", kwargs)
+
+    def delete(self):
+        return self.client.delete_table(TableName=self.name)
+
+    def load(self):
+        self.client.describe_table(TableName=self.name)
+
+    @property
+    def table_status(self):
+        return self.client.describe_table(TableName=self.name)["Table"]["TableStatus"]
+
+    @property
+    def item_count(self):
+        return self.client.describe_table(TableName=self.name)["Table"]["ItemCount"]
+
+    def wait_until_exists(self):
+        self.client.get_waiter("table_exists").wait(TableName=self.name)
+
+    def wait_until_not_exists(self):
+        self.client.get_waiter("table_not_exists").wait(TableName=self.name)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    """Table.batch_writer(), the writes go through at once"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class MemoryDynamoResource:
+    """boto3.resource("dynamodb")"""
+
+    def __init__(self, client):
+        self.meta = SimpleNamespace(client=client)
+
+    def Table(self, name):
+        return MemoryTable(self.meta.client, name)
+
+    def create_table(self, **kwargs):
+        self.meta.client.create_table(**kwargs)
+        return self.Table(kwargs["TableName"])
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        request = {name: dict(request, Keys=[_serialize_item(key) for key in request["Keys"]])
+                   for name, request in RequestItems.items()}
+        response = self.meta.client.batch_get_item(RequestItems=request, **kwargs)
+        response["Responses"] = {name: [_deserialize_item(item) for item in items]
+                                 for name, items in response["Responses"].items()}
+        return response
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        request = {}
+        for name, requests in RequestItems.items():
+            request[name] = []
+            for entry in requests:
+                if "PutRequest" in entry:
+                    request[name].append({"PutRequest": {"Item": _serialize_item(entry["PutRequest"]["Item"])}})
+                else:
+                    request[name].append({"DeleteRequest": {"Key": _serialize_item(entry["DeleteRequest"]["Key"])}})
+        return self.meta.client.batch_write_item(RequestItems=request, **kwargs)
+
+
+# --- SSM -------------------------------------------------------------------
+
+class MemorySSM:
+    """The SSM client (Parameter Store)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.parameters = {}
+        self._lock = threading.RLock()
+        self.meta = SimpleNamespace(region_name=REGION, endpoint_url="memory://ssm")
+        self.exceptions = Exceptions(["ParameterNotFound", "ParameterAlreadyExists", "ValidationException"])
+
+    def _charge(self, operation):
+        self.backend.charge("ssm." + operation)
+
+    def _get(self, operation, name):
+        parameter = self.parameters.get(name)
+        if parameter is None:
+            raise client_error(operation, "ParameterNotFound", f"Parameter {name} not found.")
+        return dict(parameter)
+
+    def put_parameter(self, Name, Value, Type="String", Overwrite=False, **kwargs):
+        self._charge("put_parameter")
+        with self._lock:
+            old = self.parameters.get(Name)
+            if old is not None and not Overwrite:
+                raise client_error("PutParameter", "ParameterAlreadyExists",
+                                   "The parameter already exists. To overwrite this value, set the overwrite option "
+                                   "in the request to true.")
+            version = old["Version"] + 1 if old else 1
+            self.parameters[Name] = {
+                "Name": Name, "Type": Type, "Value": Value, "Version": version, "LastModifiedDate": _now(),
+                "ARN": f"arn:aws:ssm:{REGION}:{ACCOUNT_ID}:parameter/{Name.lstrip('/')}", "DataType": "text",
+            }
+        return _ok(Version=version, Tier="Standard")
+
+    def get_parameter(self, Name, WithDecryption=False, **kwargs):
+        self._charge("get_parameter")
+        with self._lock:
+            return _ok(Parameter=self._get("GetParameter", Name))
+
+    def get_parameters(self, Names, WithDecryption=False, **kwargs):
+        self._charge("get_parameters")
+        with self._lock:
+            found = [dict(self.parameters[name]) for name in Names if name in self.parameters]
+            return _ok(Parameters=found, InvalidParameters=[name for name in Names if name not in self.parameters])
+
+    def get_parameters_by_path(self, Path, Recursive=False, WithDecryption=False, MaxResults=MAX_PARAMETERS_PER_PAGE,
+                               NextToken=None, **kwargs):
+        self._charge("get_parameters_by_path")
+        if not Path.startswith("/") or MaxResults > MAX_PARAMETERS_PER_PAGE:
+            raise client_error("GetParametersByPath", "ValidationException", "Invalid path or MaxResults")
+        prefix = Path.rstrip("/") + "/"
+        with self._lock:
+            names = sorted(name for name in self.parameters
+                           if name.startswith(prefix) and (Recursive or "/" not in name[len(prefix):]))
+            start = int(NextToken or 0)
+            page = [dict(self.parameters[name]) for name in names[start:start + MaxResults]]
+        response = _ok(Parameters=page)
+        if start + MaxResults < len(names):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def delete_parameter(self, Name, **kwargs):
+        self._charge("delete_parameter")
+        with self._lock:
+            self._get("DeleteParameter", Name)
+            del self.parameters[Name]
+        return _ok()
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+# --- Lambda ----------------------------------------------------------------
+
+class LambdaContext:
+    """The context object of an invocation"""
+
+    def __init__(self, function):
+        self.function_name = function.name
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = function.arn
+        self.memory_limit_in_mb = function.memory
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = f"/aws/lambda/{function.name}"
+        self.log_stream_name = "memory"
+        self._deadline = time.monotonic() + function.timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+class MemoryLambda:
+    """The Lambda client, for handlers registered with register() that run in this process"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.functions = {}
+        self.queue = deque()
+        self.invocations = Counter()
+        self.errors = []
+        self._lock = threading.Lock()
+        self.meta = SimpleNamespace(region_name=REGION, endpoint_url="memory://lambda")
+        self.exceptions = Exceptions(["ResourceNotFoundException", "InvalidParameterValueException"])
+
+    def register(self, name, handler, timeout=900, memory=1024):
+        """
+        Adds a function. handler is a callable or "module.path.function", which is
+        imported on the first invocation (after the buckets and parameters exist).
+        """
+        self.functions[name] = SimpleNamespace(
+            name=name, handler=handler, timeout=timeout, memory=memory,
+            arn=f"arn:aws:lambda:{REGION}:{ACCOUNT_ID}:function:{name}")
+        return self.functions[name].arn
+
+    def _function(self, operation, name):
+        # A name, a full ARN or a name with qualifier
+        name = name.split(":function:")[-1].split(":")[0]
+        function = self.functions.get(name)
+        if function is None:
+            raise client_error(operation, "ResourceNotFoundException", f"Function not found: {name}", 404)
+        return function
+
+    @staticmethod
+    def _handler(function):
+        if isinstance(function.handler, str):
+            module, _, attribute = function.handler.rpartition(".")
+            function.handler = getattr(importlib.import_module(module), attribute)
+        return function.handler
+
+    def get_function(self, FunctionName, **kwargs):
+        self.backend.charge("lambda.get_function")
+        function = self._function("GetFunction", FunctionName)
+        return _ok(Configuration={
+            "FunctionName": function.name, "FunctionArn": function.arn, "Timeout": function.timeout,
+            "MemorySize": function.memory, "State": "Active", "LastUpdateStatus": "Successful",
+        })
+
+    def get_waiter(self, name):
+        return Waiter(lambda FunctionName, **kwargs: self._function("GetFunction", FunctionName))
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}", **kwargs):
+        payload = _read_body(Payload) or b"{}"
+        self.backend.charge("lambda.invoke", len(payload))
+        function = self._function("Invoke", FunctionName)
+        event = json.loads(payload)
+        if InvocationType == "DryRun":
+            return _ok(204, StatusCode=204)
+        if InvocationType == "Event":
+            self.enqueue(function.arn, event)
+            return _ok(202, StatusCode=202, Payload=StreamingBody(io.BytesIO(b""), 0))
+        result, error = self._run(function, event)
+        body = json.dumps(error or result).encode("utf-8")
+        response = {"StatusCode": 200, "ExecutedVersion": "$LATEST",
+                    "Payload": StreamingBody(io.BytesIO(body), len(body))}
+        if error:
+            response["FunctionError"] = "Unhandled"
+        return _ok(**response)
+
+    def _run(self, function, event):
+        """(result, None) or (None, error payload) of one invocation"""
+        with self._lock:
+            self.invocations[function.name] += 1
+        try:
+            result = self._handler(function)(event, LambdaContext(function))
+            # The result goes back as JSON, like from Lambda
+            return json.loads(json.dumps(result)), None
+        except Exception as e:
+            with self._lock:
+                self.errors.append((function.name, e))
+            traceback.print_exc()
+            return None, {"errorMessage": str(e), "errorType": type(e).__name__,
+                          "stackTrace": traceback.format_exception(type(e), e, e.__traceback__)}
+
+    def enqueue(self, function_name, event):
+        """An asynchronous invocation (Event, or an S3 notification), runs in drain()"""
+        function = self._function("Invoke", function_name)
+        with self._lock:
+            self.queue.append((function, event))
+
+    def drain(self, raise_errors=True):
+        """
+        Runs the queued asynchronous invocations, and the ones they queue, until none is left.
+        A failed one is run again up to ASYNC_RETRIES times, then its error is raised (or only
+        kept in errors). Returns the number of invocations.
+        """
+        count = 0
+        while True:
+            with self._lock:
+                if not self.queue:
+                    return count
+                function, event = self.queue.popleft()
+            for attempt in range(ASYNC_RETRIES + 1):
+                count += 1
+                _, error = self._run(function, event)
+                if error is None:
+                    break
+            else:
+                if raise_errors:
+                    raise self.errors[-1][1]
+
+
+# --- Pagination and the backend ----------------------------------------------
+
+# Request and response fields of the page tokens
+_PAGE_TOKENS = {
+    "list_objects_v2": ("ContinuationToken", "NextContinuationToken"),
+    "get_parameters_by_path": ("NextToken", "NextToken"),
+    "query": ("ExclusiveStartKey", "LastEvaluatedKey"),
+    "scan": ("ExclusiveStartKey", "LastEvaluatedKey"),
+}
+
+
+class Paginator:
+    """client.get_paginator(operation).paginate(**kwargs) for the paginated calls"""
+
+    def __init__(self, client, operation):
+        if operation not in _PAGE_TOKENS:
+            raise ValueError(f"No paginator for {operation}")
+        self.method = getattr(client, operation)
+        self.tokens = _PAGE_TOKENS[operation]
+
+    def paginate(self, **kwargs):
+        request_token, response_token = self.tokens
+        kwargs.pop("PaginationConfig", None)
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get(response_token):
+                return
+            kwargs[request_token] = page[response_token]
+
+
+class MemoryAWS:
+    """
+    One in-memory AWS account: the clients of S3, DynamoDB, SSM and Lambda and the stats of
+    the calls (calls and bytes per operation, seconds of injected latency).
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+        self.s3 = MemoryS3(self)
+        self.dynamodb = MemoryDynamoDB(self)
+        self.ssm = MemorySSM(self)
+        self.lambda_ = MemoryLambda(self)
+        self._dynamodb_resource = MemoryDynamoResource(self.dynamodb)
+
+    def client(self, service, **kwargs):
+        clients = {"s3": self.s3, "dynamodb": self.dynamodb, "ssm": self.ssm, "lambda": self.lambda_}
+        if service not in clients:
+            raise ValueError(f"No in-memory {service}")
+        return clients[service]
+
+    def resource(self, service, **kwargs):
+        if service != "dynamodb":
+            raise ValueError(f"No in-memory {service} resource")
+        return self._dynamodb_resource
+
+    def charge(self, operation, nbytes=0):
+        """Counts a call and waits its latency"""
+        seconds = self.latency.seconds(operation, nbytes)
+        with self._stats_lock:
+            self.stats["calls"][operation] += 1
+            self.stats["bytes"][operation] += nbytes
+            self.stats["seconds"] += seconds
+        if seconds > 0 and self.latency.sleep:
+            time.sleep(seconds)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = {"calls": Counter(), "bytes": Counter(), "seconds": 0.0}
+
+    def register_function(self, name, handler, timeout=900, memory=1024):
+        return self.lambda_.register(name, handler, timeout, memory)
+
+    def drain(self, raise_errors=True):
+        return self.lambda_.drain(raise_errors)
+
+
+# Names like in setup.ps1
+PIPELINE_BUCKETS = {
+    "input": "reviews-bucket-input",
+    "cleaned": "reviews-bucket-cleaned",
+    "presentiment": "reviews-bucket-presentiment",
+    "output": "reviews-bucket-output",
+}
+PIPELINE_FUNCTIONS = {
+    "preprocessing": ("lambdas.preprocessing.handler.handler", 120),
+    "profanity_check": ("lambdas.profanity_check.handler.handler", 180),
+    "sentiment_analysis": ("lambdas.sentiment_analysis.handler.handler", 240),
+    "fused_pipeline": ("lambdas.fused.handler.handler", 300),
+}
+
+
+def deploy_pipeline(backend, mode="staged"):
+    """
+    What setup.ps1 deploys, in the backend: the buckets, the two tables, the SSM parameters,
+    the four functions and the triggers of the mode ("staged" or "fused"). The table names
+    are the ones the handlers read from the environment. Returns the bucket names.
+    """
+    s3, ssm = backend.client("s3"), backend.client("ssm")
+    # The checkpoints (and shards) only if the handlers use them
+    for bucket in list(PIPELINE_BUCKETS.values()) + [os.environ.get("CHECKPOINT_BUCKET")]:
+        try:
+            if bucket:
+                s3.create_bucket(Bucket=bucket)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+                raise
+    for name, bucket in PIPELINE_BUCKETS.items():
+        ssm.put_parameter(Name=f"/dic/{name}_bucket", Value=bucket, Type="String", Overwrite=True)
+
+    ban_table = os.environ.get("BAN_TABLE", "ban_table")
+    sentiment_table = os.environ.get("SENTIMENT_TABLE", "sentiment_table")
+    ssm.put_parameter(Name="/dic/ban_table", Value=ban_table, Type="String", Overwrite=True)
+    ssm.put_parameter(Name="/dic/sentiment_table", Value=sentiment_table, Type="String", Overwrite=True)
+    dynamodb = backend.client("dynamodb")
+    tables = dynamodb.list_tables()["TableNames"]
+    if ban_table not in tables:
+        dynamodb.create_table(
+            TableName=ban_table,
+            KeySchema=[{"AttributeName": "reviewerID", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "reviewerID", "AttributeType": "S"},
+                                  {"AttributeName": "ban_status", "AttributeType": "S"}],
+            GlobalSecondaryIndexes=[{
+                "IndexName": os.environ.get("BANNED_INDEX", "banned-index"),
+                "KeySchema": [{"AttributeName": "ban_status", "KeyType": "HASH"},
+                              {"AttributeName": "reviewerID", "KeyType": "RANGE"}],
+                "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["profane_count", "banned"]},
+            }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+    if sentiment_table not in tables:
+        dynamodb.create_table(
+            TableName=sentiment_table,
+            KeySchema=[{"AttributeName": "sentiment", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "sentiment", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+    arns = {name: backend.register_function(name, handler, timeout)
+            for name, (handler, timeout) in PIPELINE_FUNCTIONS.items()}
+    first = "preprocessing" if mode == "staged" else "fused_pipeline"
+    triggers = {PIPELINE_BUCKETS["input"]: first}
+    if mode == "staged":
+        triggers[PIPELINE_BUCKETS["cleaned"]] = "profanity_check"
+        triggers[PIPELINE_BUCKETS["presentiment"]] = "sentiment_analysis"
+    for bucket in (PIPELINE_BUCKETS["input"], PIPELINE_BUCKETS["cleaned"], PIPELINE_BUCKETS["presentiment"]):
+        functions = [triggers[bucket]] if bucket in triggers else []
+        s3.put_bucket_notification_configuration(Bucket=bucket, NotificationConfiguration={
+            "LambdaFunctionConfigurations": [{"LambdaFunctionArn": arns[name], "Events": ["s3:ObjectCreated:*"]}
+                                             for name in functions]})
+    return dict(PIPELINE_BUCKETS)
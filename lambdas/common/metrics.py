@@ -0,0 +1,247 @@
+"""
+Timers and counters of the phases of an invocation, written as one CloudWatch embedded
+metric format (EMF) log line at the end of it, so CloudWatch turns them into metrics:
+
+    @metrics.instrumented("preprocessing", counters=lambda: {"lemma_cache_hits": ...})
+    def handler(event, context):
+        ...
+        with metrics.timer("preprocess"):
+            ...
+        metrics.count("dynamodb_calls", calls)
+
+A timer only counts its own time, the time of timers inside it (e.g. the S3 reads
+while lines are parsed) goes to those. Time outside of every timer is "other_ms".
+The S3 reads and writes, the compression and the checkpoints are timed where they
+happen (compression.py, streaming.py, checkpoint.py), the handlers time their own
+steps. counters= are cumulative numbers of the container (caches, DynamoWriter
+requests), the line gets how much they grew in the invocation.
+
+The timers are around batches, chunks and parts, never single lines. Outside of an
+invocation (the local batch runner, the tests of the functions) and with METRICS=0
+timer() is one shared context manager that does nothing and count() returns at once.
+
+The first invocation of a container also gets the cold start numbers of bootstrap.py
+(cold_start, init_ms, config_ms, clients_ms, clients).
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("METRICS", "1") != "0"
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ReviewPipeline")
+
+# Units of the metrics, by the end of their name (the rest are counts)
+UNITS = {"_ms": "Milliseconds", "bytes_in": "Bytes", "bytes_out": "Bytes"}
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Timer:
+    __slots__ = ("recorder", "name", "start", "inner")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.inner = 0.0
+        self.recorder.stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        stack = self.recorder.stack()
+        stack.pop()
+        if stack:
+            stack[-1].inner += elapsed
+        self.recorder.add_seconds(self.name, elapsed - self.inner)
+        return False
+
+
+class Recorder:
+    """The timers and counters of one invocation"""
+
+    def __init__(self, function_name, context=None, counters=None):
+        self.function_name = function_name
+        self.request_id = getattr(context, "aws_request_id", None)
+        self.seconds = {}
+        self.counts = {}
+        self.properties = {}
+        self.counters = counters
+        self.counters_start = counters() if counters else {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def stack(self):
+        # Every thread has its own timers, one of another thread has no outer timer
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def add_seconds(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def values(self):
+        """{metric name: value} of the invocation so far"""
+        values = {}
+        total = time.perf_counter() - self.start
+        with self._lock:
+            for name, seconds in self.seconds.items():
+                values[f"{name}_ms"] = round(seconds * 1000, 3)
+            values["other_ms"] = round(max(0.0, total - sum(self.seconds.values())) * 1000, 3)
+            values["total_ms"] = round(total * 1000, 3)
+            values.update(self.counts)
+        if self.counters:
+            for name, n in self.counters().items():
+                values[name] = n - self.counters_start.get(name, 0)
+        return values
+
+    def emf(self):
+        """The EMF record of the invocation (a dict, one JSON line in the log)"""
+        values = self.values()
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["function"]],
+                    "Metrics": [{"Name": name, "Unit": unit(name)} for name in values],
+                }],
+            },
+            "function": self.function_name,
+        }
+        if self.request_id:
+            record["request_id"] = self.request_id
+        record.update(self.properties)
+        record.update(values)
+        return record
+
+
+def unit(name):
+    for suffix, unit_name in UNITS.items():
+        if name.endswith(suffix):
+            return unit_name
+    return "Count"
+
+
+# The invocation that is running. A lambda container runs one at a time, but with the
+# in-memory AWS (common/memory_aws.py) the invocations run in this process, in threads
+# and inside each other (a shard inside the invocation that split the file).
+_state = threading.local()
+
+# The init of the container, logged once by its first invocation (see bootstrap.py)
+_cold_start = {}
+
+
+def active():
+    """The Recorder of the invocation running in this thread, None if there is none"""
+    return getattr(_state, "recorder", None)
+
+
+def timer(name):
+    """Context manager that adds its time to the phase name of the running invocation"""
+    recorder = getattr(_state, "recorder", None)
+    if recorder is None:
+        return NULL_TIMER
+    return Timer(recorder, name)
+
+
+def count(name, n=1):
+    """Adds n to the counter name of the running invocation"""
+    recorder = getattr(_state, "recorder", None)
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+def set_property(name, value):
+    """A value that is logged with the metrics but is not a metric (e.g. the key of the file)"""
+    recorder = getattr(_state, "recorder", None)
+    if recorder is not None:
+        recorder.properties[name] = value
+
+
+class TimedBody:
+    """An S3 body whose reads are timed as s3_read and counted in bytes_in"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, size=-1):
+        with timer("s3_read"):
+            data = self.body.read(size)
+        count("bytes_in", len(data))
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+def timed_body(body):
+    """TimedBody(body) during an invocation, else the body itself"""
+    return body if active() is None else TimedBody(body)
+
+
+def set_cold_start(values):
+    """The numbers of the container init, for the next invocation that starts"""
+    _cold_start.clear()
+    _cold_start.update(values)
+
+
+def begin(function_name, context=None, counters=None):
+    """Starts recording an invocation in this thread, end() finishes it"""
+    recorder = Recorder(function_name, context, counters) if ENABLED else None
+    if recorder is not None and _cold_start:
+        recorder.counts.update(_cold_start)
+        _cold_start.clear()
+    # The outer invocation (in memory) continues after this one
+    _state.outer = getattr(_state, "outer", []) + [active()]
+    _state.recorder = recorder
+    return recorder
+
+
+def end():
+    """Prints the EMF line of the running invocation and returns its record (None if disabled)"""
+    recorder = active()
+    _state.recorder = _state.outer.pop()
+    if recorder is None:
+        return None
+    record = recorder.emf()
+    print(json.dumps(record))
+    return record
+
+
+def instrumented(function_name, counters=None):
+    """Decorator for a handler: every invocation is recorded and ends with its EMF line, also if it fails"""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            begin(function_name, context, counters)
+            try:
+                records = event.get("Records") or [{}]
+                key = records[0].get("s3", {}).get("object", {}).get("key")
+                if key:
+                    set_property("key", key)
+                return handler(event, context)
+            finally:
+                end()
+        return wrapper
+    return decorate
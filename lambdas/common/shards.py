@@ -0,0 +1,279 @@
+"""
+Splits one big upload over several parallel invocations of the same lambda.
+
+A file above SHARD_SIZE_MB is cut into line-aligned byte ranges: every SHARD_SIZE_MB
+we look for the next "\\n" with a small ranged GET, so no line is split and nothing
+but those few bytes is read to plan the shards. The invocation that got the S3 event
+(the coordinator) then invokes the lambda once per range (RequestResponse, at most
+SHARD_CONCURRENCY at once). A shard invocation only reads its range (ranged GET),
+writes its output to SHARD_BUCKET and returns its counters. The coordinator is the
+reducer: it puts the shard outputs together in the original order with a server-side
+multipart copy (no download), adds up the counters and makes the DynamoDB updates
+once for the whole file, like for a file that was not split.
+
+A compressed or columnar file can only be split where a gzip member / zstd frame or
+a block starts. The stages that write the intermediate buckets mark these places while
+they write (MultipartWriter split_size, about every SHARD_SIZE_MB of reviews) and save
+them in an index next to the shard outputs (save_index), the next stage splits at them.
+Every offset of the index is checked with a small ranged GET (the frame or block has to
+start there), so an index of an older object with the same key is not used. Compressed
+or columnar files without an index, small files and files that are already continued
+from a checkpoint are processed in one invocation like before.
+The coordinator waits for the shards, so its timeout has to be longer than one shard
+takes. A failed shard is invoked again (its output is simply written again).
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from lambdas.common import aws, checkpoint, columnar, compression
+from lambdas.common.streaming import MIN_PART_SIZE, READ_CHUNK_SIZE, MultipartWriter
+
+# Where the outputs of the shards are kept until they are merged (the checkpoint bucket by default)
+SHARD_BUCKET = os.environ.get("SHARD_BUCKET", checkpoint.CHECKPOINT_BUCKET)
+# Files bigger than this are split into shards of about this size
+SHARD_SIZE = int(float(os.environ.get("SHARD_SIZE_MB", "64")) * 1024 * 1024)
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", "16"))
+SHARD_RETRIES = int(os.environ.get("SHARD_RETRIES", "2"))
+
+# How much is read at a time to find the end of a line
+LINE_END_WINDOW = 64 * 1024
+
+_invoke_client = None
+
+
+def invoke_client():
+    """Lambda client for the shard invocations, which can take minutes (no read timeout, no retries of botocore)"""
+    global _invoke_client
+    if _invoke_client is None:
+        from botocore.config import Config
+
+        config = Config(read_timeout=900, connect_timeout=10, retries={"max_attempts": 0},
+                        max_pool_connections=SHARD_CONCURRENCY)
+        _invoke_client = aws.client("lambda", config=config)
+    return _invoke_client
+
+
+def shard_of(record):
+    """The shard of a record a coordinator sent, None for a normal S3 event record"""
+    return record.get("shard")
+
+
+def find_line_end(s3, bucket, key, position, size):
+    """Offset right after the first "\\n" at or after position (size if there is none)"""
+    while position < size:
+        end = min(position + LINE_END_WINDOW, size)
+        data = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={position}-{end - 1}")["Body"].read()
+        if not data:
+            break
+        newline = data.find(b"\n")
+        if newline >= 0:
+            return position + newline + 1
+        position += len(data)
+    return size
+
+
+def split_size():
+    """split_size of the writers of the intermediate buckets (None without SHARD_BUCKET, nothing is split then)"""
+    return SHARD_SIZE if SHARD_BUCKET else None
+
+
+def index_key(bucket, key):
+    return f"index/{bucket}/{key}.json"
+
+
+def save_index(s3, bucket, key, splits):
+    """
+    Saves where the shards of bucket/key can start (MultipartWriter.splits). Call it before
+    the object is complete, the next stage is started by its S3 event.
+    """
+    if SHARD_BUCKET and splits:
+        s3.put_object(Bucket=SHARD_BUCKET, Key=index_key(bucket, key),
+                      Body=json.dumps({"splits": splits}).encode("utf-8"), ContentType="application/json")
+
+
+def delete_index(s3, record):
+    """Removes the index of the record's object once it is processed"""
+    if SHARD_BUCKET:
+        s3.delete_object(Bucket=SHARD_BUCKET, Key=index_key(record["s3"]["bucket"]["name"],
+                                                            record["s3"]["object"]["key"]))
+
+
+def read_index(s3, bucket, key, size):
+    """The splits of save_index, None without an index or if they don't fit the object (an older one)"""
+    from botocore.exceptions import ClientError
+
+    try:
+        obj = s3.get_object(Bucket=SHARD_BUCKET, Key=index_key(bucket, key))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    splits = [offset for offset in json.loads(obj["Body"].read())["splits"] if 0 < offset < size]
+
+    def start(offset):
+        return s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + 3}")["Body"].read()
+
+    # Every split starts like the object (a new gzip member, zstd frame or block), or with
+    # the "\n" before the next line in uncompressed JSON lines
+    first = start(0)
+    expected = next((magic for magic in (compression.GZIP_MAGIC, compression.ZSTD_MAGIC, columnar.MAGIC)
+                     if first.startswith(magic)), b"\n")
+    for offset in splits:
+        if not start(offset).startswith(expected):
+            print(f"Index of {key} doesn't match the object, not using it")
+            return None
+    return splits
+
+
+def plan(s3, record, shard_size=SHARD_SIZE):
+    """
+    Byte ranges [(start, end), ...] of the record's object if it should be split, otherwise None.
+    At the offsets of the index if there is one, else line-aligned (only uncompressed JSON lines).
+    """
+    if not SHARD_BUCKET or shard_of(record) is not None:
+        return None
+    bucket = record["s3"]["bucket"]["name"]
+    key = record["s3"]["object"]["key"]
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+    splits = read_index(s3, bucket, key, size)
+    if splits:
+        bounds = [0] + splits + [size]
+        return list(zip(bounds, bounds[1:]))
+    if size <= shard_size or head.get("ContentEncoding") not in (None, "", "identity"):
+        return None
+    # Compressed without the header or columnar, can't be split at lines
+    prefix = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{len(compression.ZSTD_MAGIC) - 1}")["Body"].read()
+    if prefix.startswith((compression.GZIP_MAGIC, compression.ZSTD_MAGIC, columnar.MAGIC)):
+        return None
+
+    bounds = [0]
+    while bounds[-1] + shard_size < size:
+        end = find_line_end(s3, bucket, key, bounds[-1] + shard_size, size)
+        if end >= size:
+            break
+        bounds.append(end)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def open_input(s3, record):
+    """Decompressed body of the shard's byte range (a range of the index starts with its own frame, see plan)"""
+    shard = shard_of(record)
+    body, _ = compression.open_object(s3, record["s3"]["bucket"]["name"], record["s3"]["object"]["key"],
+                                      shard["start"], "none", end=shard["end"])
+    return compression.open_body({"Body": body})
+
+
+def open_part_writer(s3, record, encoding, fmt="jsonl", **put_object_kwargs):
+    """
+    Writer for the output of a shard. JSON lines are joined with "\\n", so the first line of
+    every shard but the first gets one in front, then the merged parts are the same as one
+    output. Only with a line, a shard without output stays empty. If all shards before it
+    are empty, merge takes the "\\n" out again (see part_result).
+    """
+    shard = shard_of(record)
+    writer = compression.open_writer(s3, SHARD_BUCKET, shard["part"], encoding, **put_object_kwargs)
+    writer.separate_first = fmt == "jsonl" and shard["index"] > 0
+    return writer
+
+
+def part_result(record, writer, **counters):
+    """
+    Result of a shard invocation for merge: the part, its size, its JSON lines, whether it
+    starts with the "\\n" of open_part_writer, and the counters of the stage
+    """
+    return {"status": "OK", "part": record["shard"]["part"], "bytes": writer.bytes_written,
+            "lines": writer.lines_written, "separated": writer.separate_first and writer.lines_written > 0,
+            **counters}
+
+
+def fan_out(context, record, ranges, stage, client=None):
+    """
+    Invokes the lambda (context.invoked_function_arn) once per range and returns the
+    results of the shards in order. Every result has "part" and "bytes" (its output).
+    """
+    client = client or invoke_client()
+    bucket = record["s3"]["bucket"]["name"]
+    key = record["s3"]["object"]["key"]
+    etag = record["s3"]["object"].get("eTag") or "latest"
+
+    def run(index):
+        start, end = ranges[index]
+        shard = {"index": index, "count": len(ranges), "start": start, "end": end,
+                 "part": f"shards/{stage}/{bucket}/{key}/{etag}/{index:05d}"}
+        payload = json.dumps({"Records": [dict(record, shard=shard)]}).encode("utf-8")
+        for attempt in range(SHARD_RETRIES + 1):
+            resp = client.invoke(FunctionName=context.invoked_function_arn, InvocationType="RequestResponse",
+                                 Payload=payload)
+            result = json.loads(resp["Payload"].read() or b"null")
+            if "FunctionError" not in resp and isinstance(result, dict) and result.get("status") == "OK":
+                return result
+            print(f"Shard {index} of {key} failed (attempt {attempt + 1}): {result}")
+        raise RuntimeError(f"Shard {index} of {key} failed {SHARD_RETRIES + 1} times")
+
+    print(f"Splitting {key} into {len(ranges)} shards")
+    with ThreadPoolExecutor(max_workers=max(1, min(SHARD_CONCURRENCY, len(ranges)))) as pool:
+        return list(pool.map(run, range(len(ranges))))
+
+
+def merge(s3, results, bucket, key, indexed=False, **put_kwargs):
+    """
+    Writes the outputs of the shards one after another to bucket/key and deletes them.
+    With a multipart copy if every part but the last has the minimum part size,
+    otherwise (small outputs) they are copied through this lambda.
+    With indexed (an intermediate bucket) every part is a place where the next stage can
+    split the object, they are saved with save_index.
+    """
+    from botocore.exceptions import ClientError
+
+    written = [result for result in results if result["bytes"]]
+    for index, result in enumerate(written):
+        if result.get("separated"):
+            # The shards before it had no lines, its "\n" would be the first byte of the output
+            written[index] = strip_separator(s3, result)
+        if result.get("separated") or result.get("lines"):
+            break
+    parts = [result["part"] for result in written]
+    sizes = [result["bytes"] for result in written]
+    if indexed:
+        save_index(s3, bucket, key, [sum(sizes[:i]) for i in range(1, len(sizes))])
+    if len(parts) > 1 and all(size >= MIN_PART_SIZE for size in sizes[:-1]):
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **put_kwargs)["UploadId"]
+        try:
+            uploaded = []
+            for number, part in enumerate(parts, start=1):
+                resp = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                           CopySource={"Bucket": SHARD_BUCKET, "Key": part})
+                uploaded.append({"ETag": resp["CopyPartResult"]["ETag"], "PartNumber": number})
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={"Parts": uploaded})
+        except ClientError:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+    else:
+        with MultipartWriter(s3, bucket, key, **put_kwargs) as writer:
+            for part in parts:
+                body = s3.get_object(Bucket=SHARD_BUCKET, Key=part)["Body"]
+                while True:
+                    chunk = body.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+    for result in results + [result for result in written if result not in results]:
+        s3.delete_object(Bucket=SHARD_BUCKET, Key=result["part"])
+
+
+def strip_separator(s3, result):
+    """Writes the part again without its first byte (the "\\n"), compressed like it was"""
+    body, encoding = compression.open_object(s3, SHARD_BUCKET, result["part"])
+    body.read(1)
+    part = result["part"] + ".stripped"
+    with compression.open_writer(s3, SHARD_BUCKET, part, encoding) as writer:
+        while True:
+            chunk = body.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+    return dict(result, part=part, bytes=writer.bytes_written, separated=False)
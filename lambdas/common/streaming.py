@@ -0,0 +1,410 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from lambdas.common import metrics
+
+# resource only exists on Unix (the Lambda runtime), not on Windows where we run the tests
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# How much we read from the S3 body at once
+READ_CHUNK_SIZE = 1024 * 1024
+
+# S3 needs every part of a multipart upload (except the last one) to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = max(int(os.environ.get("PART_SIZE_MB", "8")) * 1024 * 1024, MIN_PART_SIZE)
+
+# Pipelined I/O: the input is downloaded with parallel ranged GETs ahead of the processing
+# (RangeReader) and the parts of the output are uploaded in the background while the next
+# one is filled (MultipartWriter), so the network and the CPU work at the same time.
+# PIPELINED_IO=0 reads and writes in line with the processing like before.
+PIPELINED_IO = os.environ.get("PIPELINED_IO", "1") != "0"
+RANGE_SIZE = max(int(float(os.environ.get("RANGE_SIZE_MB", "8")) * 1024 * 1024), 1)
+READ_CONCURRENCY = max(int(os.environ.get("READ_CONCURRENCY", "4")), 1)
+UPLOAD_CONCURRENCY = max(int(os.environ.get("UPLOAD_CONCURRENCY", "4")), 1)
+
+
+class LineReader:
+    """
+    Iterates over the lines of an S3 StreamingBody (or any file-like object) one at a time,
+    as str (or as bytes with decode=False).
+
+    Only one chunk plus one unfinished line is kept in memory,
+    so the whole file never has to be read at once.
+    `offset` is the byte offset right after the last line that was returned
+    (start is the offset the body starts at), reading from there gives the remaining lines.
+    """
+
+    def __init__(self, body, chunk_size=READ_CHUNK_SIZE, decode=True, start=0):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.decode = decode
+        self.offset = start
+        self._items = self._read()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def _read(self):
+        pending = b""
+        while True:
+            # The S3 reads inside are timed as s3_read, so this is the decompression
+            with metrics.timer("decompress"):
+                chunk = self.body.read(self.chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b"\n")
+            # The last piece may be cut off in the middle, keep it for the next chunk
+            pending = lines.pop()
+            for line in lines:
+                self.offset += len(line) + 1
+                yield line.decode("utf-8") if self.decode else line
+        if pending:
+            self.offset += len(pending)
+            yield pending.decode("utf-8") if self.decode else pending
+
+
+def iter_lines(body, chunk_size=READ_CHUNK_SIZE, decode=True, start=0):
+    """Lines of a body, see LineReader"""
+    return LineReader(body, chunk_size, decode, start)
+
+
+def read_exact(body, size):
+    """Reads size bytes (fewer only at the end of the body)"""
+    data = body.read(size)
+    while len(data) < size:
+        more = body.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class PrefixedBody:
+    """File-like object that first returns bytes we already read, then the rest of the body"""
+
+    def __init__(self, prefix, body):
+        self.prefix = prefix
+        self.body = body
+
+    def read(self, size=-1):
+        if self.prefix:
+            if size is None or size < 0:
+                data, self.prefix = self.prefix + self.body.read(), b""
+                return data
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        return self.body.read(size)
+
+
+class RangeReader:
+    """
+    File-like body of the bytes [start, end) of an S3 object, downloaded with parallel
+    ranged GETs ahead of the reader. `concurrency` ranges of range_size are downloading
+    or waiting to be read, the next one is only requested when the reader took one, so a
+    slow reader slows the downloads down instead of filling the memory. read() returns
+    the bytes in order, it only waits if the next range is not there yet.
+
+    first is the body of the range before start, which the caller already requested
+    (with it the size of the object). The GETs have IfMatch=etag, so an object that is
+    replaced while we read fails instead of mixing two versions.
+    """
+
+    def __init__(self, s3, bucket, key, first, start, end, etag=None, range_size=RANGE_SIZE,
+                 concurrency=READ_CONCURRENCY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.end = end
+        self.etag = etag
+        self.range_size = range_size
+        self.concurrency = concurrency
+        self._current = first
+        self._next = start
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="s3-read")
+        self._fill()
+
+    def _fill(self):
+        while self._next < self.end and len(self._pending) < self.concurrency:
+            last = min(self._next + self.range_size, self.end) - 1
+            self._pending.append(self._executor.submit(self._get, self._next, last))
+            self._next = last + 1
+        if self._next >= self.end:
+            # Everything is requested, the threads end when their GETs are done
+            self._executor.shutdown(wait=False)
+
+    def _get(self, first, last):
+        kwargs = {"IfMatch": self.etag} if self.etag else {}
+        obj = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={first}-{last}", **kwargs)
+        return obj["Body"].read()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(READ_CHUNK_SIZE), b""))
+        while True:
+            data = self._current.read(size)
+            if data or not self._pending:
+                return data
+            self._current = io.BytesIO(self._pending.popleft().result())
+            self._fill()
+
+    def close(self):
+        """Stops the downloads that didn't start yet (for a reader that stops early)"""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._next = self.end
+        self._executor.shutdown(wait=False)
+
+
+class MultipartWriter:
+    """
+    Writes lines to S3 through a multipart upload in parts of a fixed size.
+
+    Lines are joined with "\\n" like before, so the output is the same as one put_object.
+    Small outputs that never fill a single part are written with a normal put_object.
+    Use it as a context manager, the upload is aborted if an exception happens.
+
+    With make_compressor (returns a new compressor, see compression.py) the data
+    is compressed in chunks of READ_CHUNK_SIZE before it goes into the parts,
+    bytes_written is then the compressed size.
+
+    checkpoint() / resume= let another invocation continue the same upload (see checkpoint.py).
+
+    With upload_concurrency > 1 (PIPELINED_IO) a full part is uploaded in the background
+    and the writer goes on with the next one. If upload_concurrency parts are still
+    uploading, the writer waits for the oldest (only then the wait is timed as s3_write).
+    checkpoint() and close() wait for all of them.
+
+    With split_size the writer also marks where a shard of the next stage can start
+    (see shards.py): after a line or a record (write_record) once split_size bytes (not
+    compressed) came since the last mark, it ends the gzip member / zstd frame and adds
+    the offset in the object to `splits`. Every range between two of them can be read
+    on its own.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE, make_compressor=None, resume=None, pending=b"",
+                 upload_concurrency=None, split_size=None, **put_kwargs):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.put_kwargs = put_kwargs
+        self.upload_id = None
+        self.parts = []
+        self.lines_written = 0
+        self.bytes_written = 0
+        # The first line gets a "\n" in front as well (the shards after the first one, see shards.py)
+        self.separate_first = False
+        self.make_compressor = make_compressor
+        self.compressor = make_compressor() if make_compressor else None
+        self._buffer = bytearray(pending)
+        # Not yet compressed data (only used with a compressor)
+        self._raw = bytearray()
+        self.split_size = split_size
+        self.splits = []
+        # Bytes (not compressed) since the last split
+        self._since_split = 0
+        self._detached = False
+        if upload_concurrency is None:
+            upload_concurrency = UPLOAD_CONCURRENCY if PIPELINED_IO else 1
+        self.upload_concurrency = upload_concurrency
+        # Parts that are uploading in the background: (part number, future)
+        self._uploads = deque()
+        self._executor = None
+        if resume:
+            self.upload_id = resume["upload_id"]
+            self.parts = resume["parts"]
+            self.lines_written = resume["lines_written"]
+            self.bytes_written = resume["bytes_written"]
+            self.splits = resume.get("splits", [])
+        # For the metrics of the invocation (an upload that is continued counts only its new lines)
+        self._lines_before = self.lines_written
+
+    def write_line(self, line):
+        buffer = self._buffer if self.compressor is None else self._raw
+        if self.lines_written or self.separate_first:
+            buffer += b"\n"
+        line = line.encode("utf-8")
+        buffer += line
+        self.lines_written += 1
+        self._since_split += len(line) + 1
+        self._check_size()
+        self._check_split()
+
+    def write_raw_line(self, line):
+        """Same as write_line for a line that is already encoded (bytes)"""
+        buffer = self._buffer if self.compressor is None else self._raw
+        if self.lines_written or self.separate_first:
+            buffer += b"\n"
+        buffer += line
+        self.lines_written += 1
+        self._since_split += len(line) + 1
+        self._check_size()
+        self._check_split()
+
+    def write_record(self, data):
+        """Same as write for data that ends at a record (a columnar block), a shard can start after it"""
+        self.write(data)
+        self._since_split += len(data)
+        self._check_split()
+
+    def write(self, data):
+        """Writes raw bytes, without a newline"""
+        if self.compressor is None:
+            self._buffer += data
+        else:
+            self._raw += data
+        self._check_size()
+
+    def _check_size(self):
+        if len(self._raw) >= READ_CHUNK_SIZE:
+            with metrics.timer("compress"):
+                self._buffer += self.compressor.compress(bytes(self._raw))
+            self._raw = bytearray()
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _check_split(self):
+        if self.split_size and self._since_split >= self.split_size:
+            self._end_frame()
+            self.splits.append(self.bytes_written + len(self._buffer))
+            self._since_split = 0
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            resp = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.put_kwargs)
+            self.upload_id = resp["UploadId"]
+        part_number = len(self.parts) + len(self._uploads) + 1
+        body = bytes(self._buffer)
+        self.bytes_written += len(body)
+        metrics.count("bytes_out", len(body))
+        self._buffer = bytearray()
+        if self.upload_concurrency <= 1:
+            with metrics.timer("s3_write"):
+                self.parts.append(self._send_part(part_number, body))
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.upload_concurrency, thread_name_prefix="s3-write")
+        # Backpressure: at most upload_concurrency parts are in memory and uploading
+        while len(self._uploads) >= self.upload_concurrency:
+            self._finish_oldest()
+        self._uploads.append(self._executor.submit(self._send_part, part_number, body))
+
+    def _send_part(self, part_number, body):
+        resp = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"ETag": resp["ETag"], "PartNumber": part_number}
+
+    def _finish_oldest(self):
+        with metrics.timer("s3_write"):
+            self.parts.append(self._uploads.popleft().result())
+
+    def _wait_uploads(self):
+        """Waits until every part is uploaded (raises the error of a part that failed)"""
+        while self._uploads:
+            self._finish_oldest()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _end_frame(self):
+        """Compresses everything that is left and ends the gzip member / zstd frame"""
+        if self.compressor is not None:
+            with metrics.timer("compress"):
+                self._buffer += self.compressor.compress(bytes(self._raw)) + self.compressor.flush()
+            self._raw = bytearray()
+            self.compressor = self.make_compressor()
+
+    def checkpoint(self):
+        """
+        Returns (state, pending): the state of the upload (JSON) and the bytes that are not
+        uploaded yet. MultipartWriter(..., resume=state, pending=pending) continues from here.
+        A compressed output ends its frame here and starts a new one, readers handle that
+        like one stream (concatenated gzip members / zstd frames).
+        """
+        self._end_frame()
+        # Every part but the last one needs MIN_PART_SIZE, less stays pending
+        if len(self._buffer) >= MIN_PART_SIZE:
+            self._upload_part()
+        self._wait_uploads()
+        state = {
+            "upload_id": self.upload_id,
+            "parts": self.parts,
+            "lines_written": self.lines_written,
+            "bytes_written": self.bytes_written,
+            "splits": self.splits,
+        }
+        return state, bytes(self._buffer)
+
+    def detach(self):
+        """Leaves the upload open for another invocation (close and abort do nothing anymore)"""
+        self._detached = True
+        metrics.count("lines_out", self.lines_written - self._lines_before)
+
+    def close(self):
+        if self._detached:
+            return
+        self._end_frame()
+        # Nothing was uploaded yet, so one put_object is enough
+        metrics.count("lines_out", self.lines_written - self._lines_before)
+        if self.upload_id is None:
+            with metrics.timer("s3_write"):
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.put_kwargs)
+            self.bytes_written += len(self._buffer)
+            metrics.count("bytes_out", len(self._buffer))
+            self._buffer = bytearray()
+            return
+        if self._buffer:
+            self._upload_part()
+        self._wait_uploads()
+        with metrics.timer("s3_write"):
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+
+    def abort(self):
+        # The parts that are still uploading have to be done before the upload is aborted
+        for future in self._uploads:
+            future.exception()
+        self._uploads.clear()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.upload_id is not None and not self._detached:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB (None if not available)"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
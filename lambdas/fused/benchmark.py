@@ -0,0 +1,129 @@
+"""
+End-to-end latency and S3 bytes of the staged and the fused mode, on the deployed lambdas (LocalStack):
+    python -m lambdas.fused.benchmark [reviews file] [runs per mode]
+
+With AWS_BACKEND=memory (see common/aws.py) the pipeline is deployed in memory instead
+and the lambdas run in this process, one after another. MEMORY_LATENCY_MS and
+MEMORY_LATENCY_MS_PER_MB add a fixed cost to every call, like the network would.
+
+For every mode the input bucket trigger is pointed at the first lambda of the mode
+(preprocessing or fused_pipeline), the file is uploaded under a new key and the time
+until the output file and total_counts.json are written is measured. The S3 bytes are
+what the lambdas read and write: the input, every file between the stages (written
+once, read once) and the output. The checkpoints are not counted. Afterwards the
+trigger is set back and the files are deleted.
+
+The reviews are counted in the ban and sentiment tables like any other upload,
+so better not run it on a deployment whose counts matter.
+"""
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from lambdas.common import aws
+
+PREPROCESS_FUNCTION = os.environ.get("PREPROCESS_FUNCTION", "preprocessing")
+FUSED_FUNCTION = os.environ.get("FUSED_FUNCTION", "fused_pipeline")
+
+# Longest we wait for one file
+TIMEOUT = 900
+
+
+def object_size(s3, bucket, key):
+    """Size of the object in bytes, 0 if there is none"""
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return 0
+        raise
+
+
+def object_etag(s3, bucket, key):
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    except ClientError:
+        return None
+
+
+def set_trigger(s3, lambda_client, bucket, function_name):
+    """Points the ObjectCreated notification of the bucket at the function"""
+    arn = lambda_client.get_function(FunctionName=function_name)["Configuration"]["FunctionArn"]
+    s3.put_bucket_notification_configuration(
+        Bucket=bucket,
+        NotificationConfiguration={
+            "LambdaFunctionConfigurations": [{"LambdaFunctionArn": arn, "Events": ["s3:ObjectCreated:*"]}]
+        },
+    )
+
+
+def run_once(s3, buckets, body, mode):
+    """Uploads the file once, returns (seconds until the outputs are written, S3 bytes read and written)"""
+    key = f"benchmark/{mode}-{uuid.uuid4().hex}.json"
+    counts_etag = object_etag(s3, buckets["output"], "total_counts.json")
+
+    start = time.perf_counter()
+    s3.put_object(Bucket=buckets["input"], Key=key, Body=body)
+    if aws.backend() is not None:
+        # In memory the triggered lambdas run here
+        aws.backend().drain()
+    # The output file is complete first, total_counts.json is written after the DynamoDB updates
+    while object_size(s3, buckets["output"], key) == 0 or \
+            object_etag(s3, buckets["output"], "total_counts.json") == counts_etag:
+        if time.perf_counter() - start > TIMEOUT:
+            raise TimeoutError(f"No output for {key} after {TIMEOUT} s")
+        time.sleep(0.2)
+    latency = time.perf_counter() - start
+
+    sizes = {name: object_size(s3, bucket, key) for name, bucket in buckets.items()}
+    moved = sizes["input"] + 2 * sizes["cleaned"] + 2 * sizes["presentiment"] + sizes["output"]
+    for bucket in buckets.values():
+        s3.delete_object(Bucket=bucket, Key=key)
+    return latency, moved
+
+
+def benchmark(s3, lambda_client, buckets, body, runs=3):
+    """{mode: (median seconds, [seconds of every run], S3 bytes of one file)} for "staged" and "fused" """
+    old_config = s3.get_bucket_notification_configuration(Bucket=buckets["input"])
+    old_config.pop("ResponseMetadata", None)
+    results = {}
+    try:
+        for mode, function_name in (("staged", PREPROCESS_FUNCTION), ("fused", FUSED_FUNCTION)):
+            set_trigger(s3, lambda_client, buckets["input"], function_name)
+            latencies = []
+            for _ in range(runs):
+                latency, moved = run_once(s3, buckets, body, mode)
+                latencies.append(latency)
+            results[mode] = (statistics.median(latencies), latencies, moved)
+    finally:
+        s3.put_bucket_notification_configuration(Bucket=buckets["input"], NotificationConfiguration=old_config)
+    return results
+
+
+if __name__ == "__main__":
+    if aws.backend() is not None:
+        from lambdas.common.memory_aws import deploy_pipeline
+
+        deploy_pipeline(aws.backend())
+    s3 = aws.client("s3")
+    ssm = aws.client("ssm")
+    lambda_client = aws.client("lambda")
+    buckets = {
+        name: ssm.get_parameter(Name=f"/dic/{name}_bucket")["Parameter"]["Value"]
+        for name in ("input", "cleaned", "presentiment", "output")
+    }
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "reviews_sample.json"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with open(path, "rb") as f:
+        body = f.read()
+    results = benchmark(s3, lambda_client, buckets, body, runs)
+    for mode, (median, latencies, moved) in results.items():
+        print(f"{mode:7s} median {median:.2f} s ({', '.join(f'{l:.2f}' for l in latencies)}), "
+              f"S3 {moved / 1024 / 1024:.2f} MB read and written per file")
+    staged, fused = results["staged"], results["fused"]
+    print(f"fused: {staged[0] / fused[0]:.2f}x faster, {fused[2] / staged[2]:.0%} of the S3 bytes")
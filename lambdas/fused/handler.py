@@ -0,0 +1,155 @@
+"""
+Fused mode: preprocessing, profanity check and sentiment analysis in one lambda.
+
+The staged mode writes every file three times (cleaned, presentiment and output
+bucket) and reads it three times. Here the reviews of the input file are parsed once
+and go through the three steps as the same dicts, batch by batch, only the output
+bucket is written. The steps are the functions of the three stage handlers, so the
+output is the same as in the staged mode, and so are the DynamoDB updates: the
+ban table once per reviewer and the sentiment counter once per file, both only
+after the output is complete (see common/checkpoint.py).
+
+Which mode is deployed is set with $pipelineMode in setup.ps1, the benchmark is
+lambdas/fused/benchmark.py.
+"""
+# Imported first, it times the cold start of the lambda (see common/bootstrap.py)
+from lambdas.common import bootstrap
+import os
+from collections import Counter
+
+import nltk
+
+# The NLTK data of both stages is packed next to this file by build_bundles.py,
+# it has to be on the path before the stage handlers are imported
+nltk.data.path.insert(0, os.path.join(os.path.dirname(__file__), "nltk_data"))
+
+from lambdas.common import checkpoint, compression, formats, metrics, shards
+from lambdas.common.streaming import peak_rss_mb
+from lambdas.preprocessing import handler as preprocessing
+from lambdas.profanity_check import handler as profanity
+from lambdas.profanity_check.checks import check_review
+from lambdas.sentiment_analysis import handler as sentiment
+
+# The clients of the stage handlers are used as they are, the bucket names come from bootstrap.parameter()
+s3 = sentiment.s3
+
+# How many reviews go through the three steps together
+BATCH_SIZE = int(os.environ.get("FUSED_BATCH_SIZE", "1000"))
+
+
+def process_batch(batch, writer, counts, sentiment_total):
+    """Preprocesses, checks and classifies a batch of raw reviews and writes them to the output"""
+    preprocessing.preprocess_reviews(batch)
+    with metrics.timer("profanity"):
+        for review in batch:
+            review["has_profanity"] = check_review(review, counts)
+    sentiment.write_batch(batch, writer, sentiment_total)
+
+
+def process_reviews(kind, records, writer, counts, sentiment_total, cp=None):
+    """
+    All reviews of the input through the three steps, in batches. With a checkpointer the
+    progress is saved between batches, returns False if the time is up (then the handler hands off).
+    """
+    # Reading the reviews and parsing them, the steps inside have their own timers
+    with metrics.timer("parse"):
+        batch = []
+        for reviews in formats.iter_review_groups(kind, records):
+            batch.extend(reviews)
+            if len(batch) >= BATCH_SIZE:
+                process_batch(batch, writer, counts, sentiment_total)
+                batch = []
+                # Only between batches, then every review up to the offset is written
+                if cp is not None and cp.due() and cp.save_progress(writer, None, counts=counts,
+                                                                      sentiment_total=sentiment_total):
+                    return False
+        process_batch(batch, writer, counts, sentiment_total)
+    return True
+
+
+def process_shard(record):
+    """One byte range of a big file (see common/shards.py), the counters go back to the coordinator"""
+    metrics.set_property("shard", record["shard"]["index"])
+    counts = Counter()
+    sentiment_total = {"positive": 0, "neutral": 0, "negative": 0}
+    kind, records = formats.open_input(shards.open_input(s3, record), kind="jsonl", start=record["shard"]["start"])
+    with shards.open_part_writer(s3, record, compression.OUTPUT_COMPRESSION) as writer:
+        process_reviews(kind, records, writer, counts, sentiment_total)
+    print(f"Processed shard {record['shard']['index']} ({writer.lines_written} lines), peak RSS: {peak_rss_mb()} MB")
+    return shards.part_result(record, writer, lines_written=writer.lines_written, counts=counts,
+                              sentiment_total=sentiment_total)
+
+
+def counters_so_far():
+    """The counters of the three stages together, for the metrics"""
+    values = preprocessing.cache_counters()
+    values.update(sentiment.counters_so_far())
+    for name, n in profanity.writer_counters().items():
+        values[name] = values.get(name, 0) + n
+    return values
+
+
+@metrics.instrumented("fused_pipeline", counters=counters_so_far)
+def handler(event, context):
+    if shards.shard_of(event["Records"][0]) is not None:
+        return process_shard(event["Records"][0])
+
+    # Lines of all files of the event (with the ones an earlier invocation finished before it handed off)
+    total_lines = event.get("lines_written", 0)
+    for index, record in enumerate(event["Records"]):
+        key = record["s3"]["object"]["key"]
+        output_bucket = bootstrap.parameter("output_bucket")
+
+        # Progress of an earlier invocation on this file (a continuation or a retry), see common/checkpoint.py
+        cp = checkpoint.Checkpointer(s3, "fused", record, context)
+        cp.load()
+
+        # Profane reviews per reviewer and the sentiments of this file
+        counts = Counter(cp.data.get("counts", {}))
+        sentiment_total = cp.data.get("sentiment_total", {"positive": 0, "neutral": 0, "negative": 0})
+        lines_written = cp.data.get("lines_written", 0)
+
+        # A big file that was not started yet is split over parallel invocations
+        ranges = shards.plan(s3, record) if context is not None and cp.state is None else None
+        if ranges:
+            results = shards.fan_out(context, record, ranges, "fused")
+            for result in results:
+                counts.update(result["counts"])
+                for sentiment_name, n in result["sentiment_total"].items():
+                    sentiment_total[sentiment_name] += n
+            lines_written = sum(result["lines_written"] for result in results)
+            shards.merge(s3, results, output_bucket, key, **compression.put_kwargs(compression.OUTPUT_COMPRESSION))
+            cp.output_done(counts=counts, sentiment_total=sentiment_total, lines_written=lines_written)
+            print(f"Merged {len(results)} shards of {key}, {lines_written} lines")
+
+        elif cp.phase != checkpoint.OUTPUT_DONE:
+            # Read the raw file (streamed, not read at once)
+            kind, records = cp.open_input()
+            metrics.count("files")
+
+            # Only the final output is written, in parts while we go
+            with cp.open_writer(output_bucket, key, compression.OUTPUT_COMPRESSION) as writer:
+                if not process_reviews(kind, records, writer, counts, sentiment_total, cp):
+                    return cp.hand_off(event["Records"][index:], lines_written=total_lines)
+
+            lines_written = writer.lines_written
+            cp.output_done(counts=counts, sentiment_total=sentiment_total, lines_written=lines_written)
+            print(f"Processed {lines_written} lines of {key}, wrote {writer.bytes_written} bytes, peak RSS: {peak_rss_mb()} MB")
+
+        # The same DynamoDB updates as the profanity and sentiment lambdas make for a file
+        calls = profanity.apply_profane_counts(counts, cp.input_id)
+        with metrics.timer("dynamodb"):
+            update = sentiment.sentiment_counter.add(sentiment_total, hint=key, file_id=cp.input_id)
+            if not sentiment.sentiment_counter.added(update):
+                print(f"Sentiments of {key} were already counted")
+        cp.delete()
+        total_lines += lines_written
+        print(f"Updated {len(counts)} reviewers ({sum(counts.values())} profane reviews) with {calls} DynamoDB calls")
+
+    profanity.write_banned_users()
+    sentiment.write_total_counts(total_lines)
+    return {"status": "OK"}
+
+
+# Everything is imported and set up (the stage handlers too), the time until here is the init of the container
+bootstrap.init_done()
@@ -0,0 +1,256 @@
+"""
+Runs the whole pipeline on local JSON lines files, without LocalStack or S3 (e.g. for backfills):
+    python -m lambdas.local_batch <file or directory> [-o out] [--workers N] [--chunk-lines N] [--state file]
+
+Every review goes through the same functions as in the lambdas (preprocess_reviews,
+check_review and classify_batch). The lines of a file are cut into chunks that a
+process pool works on, at most two chunks per worker are in flight, and the results
+are written in the original order.
+
+The ban rule is the one of the ban table (more than BAN_THRESHOLD profane reviews
+bans a user, for good). Ban state and sentiment counts are kept in a SQLite file
+(by default <out>/local-state.db), so a later run continues the counts like the
+DynamoDB tables do; delete it to start over. Like in the lambdas, the counts of a
+file are only added once the file is completely written.
+
+The output directory gets the same three outputs as the output bucket: the processed
+reviews of every file (same file name), banned-users.json and total_counts.json
+(total_reviews_processed is the number of reviews of this run). The time of every
+stage and the throughput are printed at the end.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter, deque
+
+from lambdas.common import codec, compression, formats
+from lambdas.common.streaming import iter_lines, peak_rss_mb
+
+# Lines per chunk of work for the pool
+CHUNK_LINES = 2000
+
+# Order of the stages in the report
+STAGES = ["parse", "preprocess", "profanity", "sentiment", "serialize"]
+
+# Filled in every worker by init_worker (the modules load the word lists and the VADER lexicon)
+_steps = {}
+
+
+def init_worker():
+    from lambdas.preprocessing.handler import preprocess_reviews
+    from lambdas.profanity_check.checks import check_review
+    from lambdas.sentiment_analysis.classify import classify_batch
+
+    _steps.update(preprocess=preprocess_reviews, check=check_review, classify=classify_batch)
+
+
+def process_chunk(lines):
+    """
+    All steps of the pipeline for a list of JSON lines (bytes). Returns the output lines
+    joined with "\\n" (bytes), the number of reviews, the profane reviews per reviewer,
+    the sentiment counts and the seconds every stage took.
+    """
+    timings = {}
+    start = time.perf_counter()
+    reviews = list(formats.iter_json_reviews(lines))
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _steps["preprocess"](reviews)
+    timings["preprocess"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    counts = Counter()
+    for review in reviews:
+        review["has_profanity"] = _steps["check"](review, counts)
+    timings["profanity"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sentiment_total = Counter()
+    for review, sentiment in zip(reviews, _steps["classify"](reviews)):
+        review["sentiment"] = sentiment
+        sentiment_total[sentiment] += 1
+    timings["sentiment"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = "\n".join(codec.dumps(review) for review in reviews).encode("utf-8")
+    timings["serialize"] = time.perf_counter() - start
+    return output, len(reviews), counts, sentiment_total, timings
+
+
+class LocalStore:
+    """The ban table and the sentiment counts of the local runs, in a SQLite file"""
+
+    def __init__(self, path, ban_threshold):
+        self.ban_threshold = ban_threshold
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS bans "
+                            "(reviewerID TEXT PRIMARY KEY, profane_count INTEGER NOT NULL, banned INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sentiments (sentiment TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+
+    def add_file(self, counts, sentiment_total):
+        """Adds the counts of one file in one transaction, bans like apply_profane_counts"""
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO bans VALUES (?, ?, ?) ON CONFLICT(reviewerID) DO UPDATE SET "
+                "profane_count = profane_count + excluded.profane_count, "
+                "banned = banned OR profane_count + excluded.profane_count > ?",
+                [(reviewer_id, n, n > self.ban_threshold, self.ban_threshold) for reviewer_id, n in counts.items()],
+            )
+            self.db.executemany(
+                "INSERT INTO sentiments VALUES (?, ?) ON CONFLICT(sentiment) DO UPDATE SET count = count + excluded.count",
+                list(sentiment_total.items()),
+            )
+
+    def banned_users(self):
+        rows = self.db.execute("SELECT reviewerID, profane_count FROM bans WHERE banned ORDER BY reviewerID")
+        return [{"reviewerID": reviewer_id, "profane_count": n, "banned": True} for reviewer_id, n in rows]
+
+    def totals(self):
+        """(profane_total, banned_total, sentiment counts) like total_counts.json"""
+        profane_total, banned_total = self.db.execute("SELECT SUM(profane_count), SUM(banned) FROM bans").fetchone()
+        sentiment_counts = {"positive": 0, "neutral": 0, "negative": 0}
+        sentiment_counts.update(self.db.execute("SELECT sentiment, count FROM sentiments"))
+        return profane_total or 0, banned_total or 0, sentiment_counts
+
+
+def input_files(path):
+    """The file itself, or every file of the directory (sorted)"""
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, name)) and not name.startswith(".")]
+    return [path]
+
+
+def iter_chunks(path, chunk_lines):
+    """Lists of raw lines of a file (compressed files are decompressed while reading)"""
+    with open(path, "rb") as f:
+        chunk = []
+        for line in iter_lines(compression.open_body({"Body": f}), decode=False):
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def run_ordered(pool, chunks, in_flight):
+    """Results of process_chunk for all chunks, in order, with at most in_flight chunks queued"""
+    if pool is None:
+        yield from map(process_chunk, chunks)
+        return
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(process_chunk, (chunk,)))
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def process_file(path, out_path, pool, in_flight, chunk_lines, stats):
+    """Writes the processed reviews of one file, returns (reviews, profane counts, sentiment counts)"""
+    counts = Counter()
+    sentiment_total = Counter()
+    reviews = 0
+    with open(out_path, "wb") as out:
+        for output, n, chunk_counts, chunk_sentiments, timings in run_ordered(
+                pool, iter_chunks(path, chunk_lines), in_flight):
+            if n:
+                # Joined with "\n" and no newline at the end, like the output of the lambdas
+                if reviews:
+                    out.write(b"\n")
+                out.write(output)
+            reviews += n
+            counts.update(chunk_counts)
+            sentiment_total.update(chunk_sentiments)
+            for stage, seconds in timings.items():
+                stats[stage] = stats.get(stage, 0.0) + seconds
+    return reviews, counts, sentiment_total
+
+
+def ensure_nltk_data():
+    """The VADER lexicon for the workers (the lambdas have it in their package, see build_bundles.py)"""
+    import nltk
+
+    try:
+        nltk.data.find("sentiment/vader_lexicon.zip")
+    except LookupError:
+        nltk.download("vader_lexicon", quiet=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the review pipeline on local files")
+    parser.add_argument("input", help="JSON lines file or a directory of them")
+    parser.add_argument("-o", "--output", default="out", help="output directory (default out)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes (default: all cores)")
+    parser.add_argument("--chunk-lines", type=int, default=CHUNK_LINES, help="lines per chunk of work")
+    parser.add_argument("--state", help="SQLite file with the ban state and counts (default <output>/local-state.db)")
+    args = parser.parse_args(argv)
+
+    from lambdas.profanity_check.checks import BAN_THRESHOLD
+
+    ensure_nltk_data()
+    os.makedirs(args.output, exist_ok=True)
+    store = LocalStore(args.state or os.path.join(args.output, "local-state.db"), BAN_THRESHOLD)
+
+    pool = None
+    if args.workers > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker)
+    else:
+        init_worker()
+
+    stats = {}
+    total_reviews = 0
+    start = time.perf_counter()
+    try:
+        for path in input_files(args.input):
+            name = os.path.basename(path)
+            # The output is not compressed
+            for suffix in (".gz", ".zst"):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            file_start = time.perf_counter()
+            reviews, counts, sentiment_total = process_file(
+                path, os.path.join(args.output, name), pool, 2 * args.workers, args.chunk_lines, stats)
+            store.add_file(counts, sentiment_total)
+            total_reviews += reviews
+            seconds = time.perf_counter() - file_start
+            print(f"{path}: {reviews} reviews in {seconds:.1f} s ({reviews / max(seconds, 1e-9):.0f} reviews/s), "
+                  f"{sum(counts.values())} profane")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    wall = time.perf_counter() - start
+
+    banned_users = store.banned_users()
+    with open(os.path.join(args.output, "banned-users.json"), "w", encoding="utf-8") as f:
+        f.write("\n".join(json.dumps(user) for user in banned_users))
+    profane_total, banned_total, sentiment_counts = store.totals()
+    with open(os.path.join(args.output, "total_counts.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "total_profane_reviews": profane_total,
+            "total_banned_users": banned_total,
+            "sentiment_counts": sentiment_counts,
+            "total_reviews_processed": total_reviews,
+        }, indent=4))
+
+    # Stage times are summed over the workers, so reviews/s per stage is per core
+    print(f"{total_reviews} reviews in {wall:.1f} s with {args.workers} workers "
+          f"({total_reviews / max(wall, 1e-9):.0f} reviews/s), peak RSS of this process: {peak_rss_mb()} MB")
+    for stage in STAGES:
+        seconds = stats.get(stage, 0.0)
+        print(f"  {stage:10s} {seconds:8.2f} s  {total_reviews / max(seconds, 1e-9):10.0f} reviews/s per core")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
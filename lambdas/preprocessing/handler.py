@@ -1,22 +1,80 @@
-import json
+# Imported first, it times the cold start of the lambda (see common/bootstrap.py)
+from lambdas.common import bootstrap
+import functools
 import os
 import string
-import nltk
-from nltk.stem import WordNetLemmatizer
-import boto3
 
-# NLTK setup: ensure required resources are available in /tmp (without this, we had trouble with nltk)
-nltk.data.path.append("/tmp")
-nltk.download("wordnet", download_dir="/tmp")
-nltk.download("omw-1.4", download_dir="/tmp")
+from lambdas.common import aws, checkpoint, compression, formats, metrics, shards
+from lambdas.common.cache import MISSING, ResultCache
+from lambdas.common.streaming import peak_rss_mb
+from lambdas.preprocessing.lemma_table import load_lemma_table
 
-# Initialize the lemmatizer
-lemmatizer = WordNetLemmatizer()
+# Precomputed lemmas (see lemma_table.py), every word that is not in it is its own lemma.
+# Without the table file we fall back to WordNet.
+LEMMA_TABLE = load_lemma_table()
+
+_lemmatizer = None
+
+
+def wordnet_lemmatizer():
+    """
+    The WordNet lemmatizer, only needed without the lemma table. nltk takes half a second
+    to import, so it is only imported then (WordNet itself is loaded on the first lemmatize).
+    """
+    global _lemmatizer
+    if _lemmatizer is None:
+        import nltk
+        from nltk.stem import WordNetLemmatizer
+
+        # NLTK data is packed into the deployment package by build_bundles.py, nothing is downloaded
+        nltk.data.path.insert(0, os.path.join(os.path.dirname(__file__), "nltk_data"))
+        _lemmatizer = WordNetLemmatizer()
+    return _lemmatizer
 
 # Load the stopwords from the file at startup
 with open(os.path.join(os.path.dirname(__file__), "stopwords.txt"), "r", encoding="utf-8") as f:
     STOPWORDS = set(word.strip().lower() for word in f if word.strip())
 
+# Lemmas are cached across warm invocations, review text repeats the same words a lot
+LEMMA_CACHE_SIZE = int(os.environ.get("LEMMA_CACHE_SIZE", "100000"))
+
+# Cleaned tokens per field, kept across warm invocations. Summaries like "Great product"
+# or "Five Stars" repeat thousands of times, so the same text is only preprocessed once.
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "50000"))
+RESULT_CACHES = {"reviewText": ResultCache(RESULT_CACHE_SIZE), "summary": ResultCache(RESULT_CACHE_SIZE)}
+
+# How many reviews are preprocessed together in the handler
+BATCH_SIZE = int(os.environ.get("PREPROCESS_BATCH_SIZE", "1000"))
+
+@functools.lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word):
+    """Cached version of the WordNet lemmatize, hits and misses are in lemmatize.cache_info()"""
+    if LEMMA_TABLE is not None:
+        return LEMMA_TABLE.get(word, word)
+    return wordnet_lemmatizer().lemmatize(word)
+
+
+# Translation table that removes punctuation, built once instead of for every text
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
+def tokenize(text):
+    """
+    Lowercases the text, removes punctuation, splits it by whitespace and
+    removes stopwords and non-ASCII tokens (everything of preprocess_text except lemmatizing)
+    """
+    tokens = text.lower().translate(PUNCTUATION_TABLE).split()
+    # Almost all reviews are plain ASCII, then every token is ASCII as well
+    if text.isascii():
+        return [word for word in tokens if word not in STOPWORDS]
+    return [word for word in tokens if word not in STOPWORDS and word.isascii()]
+
+
+def tokenize_texts(texts):
+    """Batch version of tokenize, returns one list of tokens per text"""
+    return [tokenize(text) for text in texts]
+
+
 def preprocess_text(text):
     """
     This cleans and preprocesses the input by:
@@ -27,18 +85,107 @@ def preprocess_text(text):
 
     Returns a list of cleaned tokens
     """
-    # Lowercase and remove punctuation
-    text = text.lower().translate(str.maketrans("", "", string.punctuation))
+    return [lemmatize(word) for word in tokenize(text)]
 
-    # Tokenize by whitespace
-    tokens = text.split()
 
-    # Remove stopwords and non-ascii characters and lemmatize the remaining
-    processed = [lemmatizer.lemmatize(word) for word in tokens if word not in STOPWORDS and word.isascii()]
+def preprocess_texts(texts):
+    """
+    Batch version of preprocess_text for many texts at once.
 
-    return processed
+    Collects the unique vocabulary of all texts, lemmatizes every word
+    only once and maps the lemmas back onto the tokens.
+    Returns one list of cleaned tokens per text.
+    """
+    token_lists = tokenize_texts(texts)
+    vocabulary = set().union(*token_lists)
+    lemmas = {word: lemmatize(word) for word in vocabulary}
+    return [[lemmas[word] for word in tokens] for tokens in token_lists]
 
 
+def preprocess_reviews(reviews):
+    """
+    Replaces 'reviewText' and 'summary' (if present) of the reviews by their cleaned tokens, in place.
+    Texts seen before are taken from RESULT_CACHES, the others are preprocessed together.
+    """
+    with metrics.timer("preprocess"):
+        _preprocess_reviews(reviews)
+
+
+def _preprocess_reviews(reviews):
+    pending = []
+    for review in reviews:
+        for field in ("reviewText", "summary"):
+            if field in review:
+                key = RESULT_CACHES[field].key(review[field])
+                tokens = RESULT_CACHES[field].get(key)
+                if tokens is MISSING:
+                    pending.append((review, field, key))
+                else:
+                    review[field] = tokens
+
+    # Texts that repeat inside the batch are only preprocessed once as well
+    texts = list(dict.fromkeys(review[field] for review, field, key in pending))
+    cleaned = dict(zip(texts, preprocess_texts(texts)))
+    for review, field, key in pending:
+        tokens = cleaned[review[field]]
+        RESULT_CACHES[field].put(key, tokens)
+        review[field] = tokens
+
+
+def write_batch(batch, output):
+    """Preprocesses a batch of reviews and writes the cleaned reviews"""
+    preprocess_reviews(batch)
+    with metrics.timer("write"):
+        for json_data in batch:
+            output.write_row(json_data)
+
+
+def preprocess_lines(lines, writer, output, cp=None):
+    """
+    Preprocesses only fields "reviewText" and "Summary", in batches of lines. With a checkpointer
+    the progress is saved between batches, returns False if the time is up (then the handler hands off).
+    """
+    # Reading the lines and parsing them, the steps inside have their own timers
+    with metrics.timer("parse"):
+        batch = []
+        for json_data in formats.iter_json_reviews(lines):
+            batch.append(json_data)
+            if len(batch) >= BATCH_SIZE:
+                write_batch(batch, output)
+                batch = []
+                # Only between batches, then every line up to the offset is written
+                if cp is not None and cp.due() and cp.save_progress(writer, output):
+                    return False
+        write_batch(batch, output)
+    with metrics.timer("write"):
+        output.flush()
+    return True
+
+
+def preprocess_shard(s3, record):
+    """One byte range of a big upload (see common/shards.py), the cleaned part is merged by the coordinator"""
+    fmt = formats.INTERMEDIATE_FORMAT
+    metrics.set_property("shard", record["shard"]["index"])
+    _, lines = formats.open_input(shards.open_input(s3, record), kind="jsonl", start=record["shard"]["start"])
+    with shards.open_part_writer(s3, record, compression.COMPRESSION, fmt, **formats.put_kwargs(fmt)) as writer:
+        output = formats.open_output(writer, fmt)
+        preprocess_lines(lines, writer, output)
+    print(f"Preprocessed shard {record['shard']['index']} ({output.rows_written} lines), peak RSS: {peak_rss_mb()} MB")
+    return shards.part_result(record, writer, lines_written=output.rows_written)
+
+
+def cache_counters():
+    """Hits and misses of the caches so far (they live as long as the container), for the metrics"""
+    lemmas = lemmatize.cache_info()
+    return {
+        "lemma_cache_hits": lemmas.hits,
+        "lemma_cache_misses": lemmas.misses,
+        "result_cache_hits": sum(cache.hits for cache in RESULT_CACHES.values()),
+        "result_cache_misses": sum(cache.misses for cache in RESULT_CACHES.values()),
+    }
+
+
+@metrics.instrumented("preprocessing", counters=cache_counters)
 def handler(event, context):
     """
     This is what is triggered by S3 upload events
@@ -48,45 +195,56 @@ def handler(event, context):
     - Applies the preprocessing function to 'reviewText' and 'summary'
     - Writes the cleaned result to the next S3 bucket
     """
+    # The S3 client (LocalStack, or the in-memory one), made by the first invocation and
+    # then reused (see common/aws.py). Not at import, the local batch runner imports this module too.
+    s3 = aws.client("s3")
 
-    for record in event["Records"]:
-        # Read JSON from S3 (as string body)
-        bucket = record["s3"]["bucket"]["name"]
+    # A shard of a big upload, sent by the invocation that split it
+    if shards.shard_of(event["Records"][0]) is not None:
+        return preprocess_shard(s3, event["Records"][0])
+
+    for index, record in enumerate(event["Records"]):
+        # The key of the uploaded file (the checkpointer reads it from the record)
         key = record["s3"]["object"]["key"]
 
-        # Initialize the S3 client
-        s3 = boto3.client("s3", endpoint_url=os.getenv("AWS_ENDPOINT_URL"))
-
-        # Download the uploaded file from the bucket
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        raw_data = obj["Body"].read().decode("utf-8")
-
-        # Preprocess only fields "reviewText" and "Summary", line by line 
-        processed_lines = []
-        for line in raw_data.strip().splitlines():
-            if not line.strip():
-                continue
-            try:
-                json_data = json.loads(line)
-
-                # Preprocess the fields if present
-                if "reviewText" in json_data:
-                    json_data["reviewText"] = preprocess_text(json_data["reviewText"])
-                if "summary" in json_data:
-                    json_data["summary"] = preprocess_text(json_data["summary"])
-                # Store the cleaned line
-                processed_lines.append(json.dumps(json_data))
-            except json.JSONDecodeError: # Just in case 
-                continue  # Skip bad lines
-        
-        # Save to output bucket (same filename)
+        # Progress of an earlier invocation on this file (a continuation or a retry), see common/checkpoint.py
+        cp = checkpoint.Checkpointer(s3, "preprocessing", record, context)
+        cp.load()
+
+        # Save to output bucket (same filename), written in parts while we go
         output_bucket = os.getenv("CLEANED_BUCKET", "reviews-bucket-cleaned")
-        s3.put_object(Bucket=output_bucket,
-                      Key=key, 
-                      Body="\n".join(processed_lines).encode("utf-8") # Join all lines back together
-                      )
+        # Written as JSON lines or in the columnar format (INTERMEDIATE_FORMAT)
+        fmt = formats.INTERMEDIATE_FORMAT
+
+        # A big upload that was not started yet is split over parallel invocations
+        ranges = shards.plan(s3, record) if context is not None and cp.state is None else None
+        if ranges:
+            results = shards.fan_out(context, record, ranges, "preprocessing")
+            shards.merge(s3, results, output_bucket, key, indexed=True,
+                         **compression.put_kwargs(compression.COMPRESSION), **formats.put_kwargs(fmt))
+            print(f"Merged {len(results)} shards of {key}, {sum(r['lines_written'] for r in results)} lines")
+            continue
+
+        # Download the uploaded file from the bucket (streamed, not read at once)
+        _, lines = cp.open_input()
+        metrics.count("files")
+
+        # Big outputs are marked where the profanity check can split them
+        with cp.open_writer(output_bucket, key, compression.COMPRESSION, split_size=shards.split_size(),
+                            **formats.put_kwargs(fmt)) as writer:
+            output = cp.open_output(writer, fmt)
+            if not preprocess_lines(lines, writer, output, cp):
+                return cp.hand_off(event["Records"][index:])
+            shards.save_index(s3, output_bucket, key, writer.splits)
+        cp.delete()
+
+        print(f"Preprocessed {output.rows_written} lines of {key}, wrote {writer.bytes_written} bytes, peak RSS: {peak_rss_mb()} MB")
+        print(f"Lemma cache: {lemmatize.cache_info()}")
+        print(f"Result cache hit rate: summary {RESULT_CACHES['summary'].hit_rate():.1%}, "
+              f"reviewText {RESULT_CACHES['reviewText'].hit_rate():.1%}")
     # Return a response
     return {"status": "OK"}
 
 
-
+# Everything is imported and set up, the time until here is the init of the container
+bootstrap.init_done()
@@ -0,0 +1,80 @@
+"""
+The lemma lookup table (lemmas.tsv.gz) that the preprocessing lambda
+uses instead of loading WordNet at runtime, and the script that builds it.
+
+WordNetLemmatizer only returns a word other than itself if the word is in the
+noun exception list, or if one of the morphy rules (e.g. "ies" -> "y") turns it
+into a WordNet noun. So we run the lemmatizer over all WordNet nouns, all
+exceptions and every word the rules can map onto a noun, and only store the
+words whose lemma is different. Every word not in the table is its own lemma.
+
+Run it from the repository root (WordNet has to be available to nltk):
+    python -m lambdas.preprocessing.lemma_table
+"""
+import gzip
+import os
+import subprocess
+import sys
+
+LEMMA_TABLE_FILE = os.path.join(os.path.dirname(__file__), "lemmas.tsv.gz")
+
+
+def load_lemma_table(path=LEMMA_TABLE_FILE):
+    """Returns the table as a dict {word: lemma}, or None if it was not built"""
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return dict(line.rstrip("\n").split("\t") for line in f if not line.startswith("#"))
+
+
+def candidate_words(wn):
+    """All words for which WordNetLemmatizer (pos="n") might not return the word itself"""
+    nouns = set(wn.all_lemma_names(pos=wn.NOUN))
+    words = set(nouns)
+    words.update(wn._exception_map[wn.NOUN])
+    # Invert the morphy rules: a word becomes `lemma` if it ends with `old`
+    # and replacing `old` by `new` gives `lemma`
+    for lemma in nouns:
+        for old, new in wn.MORPHOLOGICAL_SUBSTITUTIONS[wn.NOUN]:
+            if lemma.endswith(new):
+                words.add(lemma[: len(lemma) - len(new)] + old)
+    return words
+
+
+def build(path=LEMMA_TABLE_FILE):
+    from nltk.corpus import wordnet as wn
+    from nltk.stem import WordNetLemmatizer
+
+    lemmatizer = WordNetLemmatizer()
+    table = {}
+    for word in candidate_words(wn):
+        lemma = lemmatizer.lemmatize(word)
+        if lemma != word:
+            table[word] = lemma
+
+    # mtime=0 so the same WordNet always gives the same file
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+        f.write(f"# wordnet {wn.get_version()}\n".encode("utf-8"))
+        for word in sorted(table):
+            f.write(f"{word}\t{table[word]}\n".encode("utf-8"))
+    return table
+
+
+def time_cold_start(statement):
+    """Runs the statement in a fresh python process and returns how long it took"""
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    repo_root = os.path.join(os.path.dirname(__file__), "..", "..")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=repo_root)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    table = build()
+    print(f"Wrote {len(table)} lemmas to {LEMMA_TABLE_FILE} ({os.path.getsize(LEMMA_TABLE_FILE) / 1024:.0f} KB)")
+
+    # Cold start: first lemma with WordNet vs. with the table
+    wordnet_time = time_cold_start("from nltk.stem import WordNetLemmatizer; WordNetLemmatizer().lemmatize('things')")
+    table_time = time_cold_start(
+        "from lambdas.preprocessing.lemma_table import load_lemma_table; load_lemma_table().get('things')"
+    )
+    print(f"Cold start until the first lemma: WordNet {wordnet_time:.2f} s, lemma table {table_time:.2f} s")
@@ -0,0 +1,85 @@
+"""
+The profanity check of the reviews, without anything of AWS (the handler and the
+local batch runner both use it): the bad word matcher, the checks of a review, a
+raw JSON line and a columnar block, and the ban threshold.
+"""
+import json
+import os
+
+from lambdas.common import codec
+from lambdas.profanity_check.scanner import PhraseMatcher, load_patterns
+
+# Bad words and phrases of both lists (bad-words.txt and the one from the profanityfilter package),
+# the automaton is built once per container
+matcher = PhraseMatcher(load_patterns())
+
+# Clean JSON lines are recognized from their raw bytes and not parsed (PROFANITY_SKIP_PARSE=0 to always parse)
+SKIP_PARSE = os.environ.get("PROFANITY_SKIP_PARSE", "1") == "1"
+
+# Create profanity filter 
+def contains_profanity(text):
+    return matcher.search(text)
+
+# Users with more profane reviews than this are banned
+BAN_THRESHOLD = 3
+
+
+def check_review(review, counts):
+    """Returns whether the review contains profanity (and counts it for the reviewer)"""
+    # Check the relevant fields
+    for field in ["reviewText", "summary"]: 
+        tokens = review.get(field, [])
+        if isinstance(tokens, list) and contains_profanity(tokens):
+            counts[review.get('reviewerID', 'unknown')] += 1
+            return True
+    return False
+
+def check_line(line, output, counts, skip_parse):
+    """Checks one JSON line (bytes) and writes it with the flag to output"""
+    if not line.strip():
+        return
+    # Most lines are clean, they get the flag without decoding and encoding them again
+    if skip_parse:
+        clean_line = matcher.mark_clean(line)
+        if clean_line is not None:
+            output.write_raw(clean_line)
+            return
+    try:
+        review = codec.loads(line)
+    except json.JSONDecodeError:
+        return  # Skip malformed lines
+    # Add the correct flag to the review
+    review["has_profanity"] = check_review(review, counts)
+    output.write_row(review)
+
+def check_block(block, counts):
+    """
+    Same as check_review for every review of a columnar block, returns the flags.
+    The tokens every match needs are looked up once in the vocabulary of the block,
+    only the reviews that have one of their ids are checked with the matcher.
+    """
+    flags = [False] * block.n_rows
+    vocabulary = block.vocabulary()
+    required_ids = {i for i, token in enumerate(vocabulary) if token in matcher.required}
+    for field in ["reviewText", "summary"]:
+        if field not in block.columns:
+            continue
+        rows = block.rows_with(field)
+        if block.columns[field]["type"] == "tokens":
+            offsets, ids = block.token_ids(field)
+            for row, start, end in zip(rows, offsets, offsets[1:]):
+                if not flags[row] and not required_ids.isdisjoint(ids[start:end]):
+                    flags[row] = matcher.search([vocabulary[i] for i in ids[start:end]])
+        else:
+            for row, tokens in zip(rows, block.values(field)):
+                if not flags[row] and isinstance(tokens, list) and contains_profanity(tokens):
+                    flags[row] = True
+
+    # Count them for the reviewers like check_review
+    reviewer_ids = {}
+    if "reviewerID" in block.columns:
+        reviewer_ids = dict(zip(block.rows_with("reviewerID"), block.values("reviewerID")))
+    for row, flagged in enumerate(flags):
+        if flagged:
+            counts[reviewer_ids.get(row, "unknown")] += 1
+    return flags
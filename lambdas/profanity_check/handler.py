@@ -1,122 +1,306 @@
+# Imported first, it times the cold start of the lambda (see common/bootstrap.py)
+from lambdas.common import bootstrap
 import os
 import json
-import boto3
+from collections import Counter
+from decimal import Decimal
 
-# Load the file paths
-BAD_WORDS_FILE_1 = os.path.join(os.path.dirname(__file__), "bad-words.txt")
-BAD_WORDS_FILE_2 = os.path.join(os.path.dirname(__file__), "badwords_profanityfilter.txt")
+from lambdas.common import aws, ban_totals, checkpoint, compression, dynamo, formats, metrics, shards
+from lambdas.common.streaming import peak_rss_mb
+# The checks themselves are in checks.py (no AWS in there, the local batch runner uses them too)
+from lambdas.profanity_check.checks import (
+    BAN_THRESHOLD, SKIP_PARSE, check_block, check_line,
+)
 
-# Set up AWS clients with LocalStack endpoint
-endpoint_url = os.environ.get("AWS_ENDPOINT_URL") or ("http://" + os.environ.get("LOCALSTACK_HOSTNAME", "localhost") + ":4566")
-s3 = boto3.client("s3", endpoint_url=endpoint_url)
-ssm = boto3.client("ssm", endpoint_url=endpoint_url)
+# Set up AWS clients with LocalStack endpoint (or the in-memory ones, see common/aws.py)
+s3 = aws.client("s3")
 
 # Get the DynamoDB table for ban status
-dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
+dynamodb = aws.resource('dynamodb')
 table_name = os.environ.get("BAN_TABLE", "ban_table")
 table = dynamodb.Table(table_name)
 
-# Get the bucket names from SSM parameters for result output
-presentiment_bucket = ssm.get_parameter(Name="/dic/presentiment_bucket")["Parameter"]["Value"]
-output_bucket = ssm.get_parameter(Name="/dic/output_bucket")["Parameter"]["Value"]
+# The updates of the ban table run in parallel, rate limited and retried (see common/dynamo.py)
+ban_writer = dynamo.DynamoWriter(
+    aws.client("dynamodb", config=dynamo.client_config()), table_name
+)
 
-# Load bad words from file
-with open(BAD_WORDS_FILE_1, "r", encoding="utf-8") as f:
-    bad_words1 = set(line.strip().lower() for line in f if line.strip())
+# The bucket names are SSM parameters, all of them come with one call and are cached
+# (see common/bootstrap.py). Fetched here for the cold start, the invocations read them again.
+bootstrap.config()
 
-# Load bad words from profanityfilter package: 
-with open(BAD_WORDS_FILE_2, "r", encoding="utf-8") as f:
-    bad_words2 = set(line.strip().lower() for line in f if line.strip())
+# Sparse index of the ban table: only banned users have the ban_status attribute,
+# so only they are in the index (see setup.ps1)
+BANNED_INDEX = os.environ.get("BANNED_INDEX", "banned-index")
+BANNED_STATUS = "banned"
 
-# Combine the dictionaries
-bad_words = bad_words1.union(bad_words2)
+def apply_profane_counts(counts, file_id=None):
+    """
+    Adds the profane reviews of a file to the ban table, one update per reviewer
+    instead of one or two per review. Returns the number of DynamoDB calls.
 
-# Create profanity filter 
-def contains_profanity(text):
-    return any(word in bad_words for word in text)
+    The count and the ban flag are changed in the same (atomic) update. Reviewers
+    that stay at or below the threshold only need the conditional update. If the
+    condition fails, the new count is above the threshold, so the second update
+    adds the count and bans in one go. Counts only grow, so that stays true even
+    if another lambda updated the user in between.
 
-def handler(event, context):
-    for record in event["Records"]:
-        # Get S3 bucket and key from the event
-        bucket = record["s3"]["bucket"]["name"]
-        key = record["s3"]["object"]["key"]
+    A ban of a user that wasn't banned yet is a transaction with the banned_total
+    of the totals item (see common/ban_totals.py), so every ban is counted exactly once.
+    The profane reviews of the file are added to profane_total with one more update.
+
+    With file_id (Checkpointer.input_id) every update only applies if the file isn't
+    in applied_files of the reviewer yet and adds it there, the profane_total comes
+    with the marker item of the file (see common/ban_totals.py). A retry after a crash
+    in the middle of the updates only applies the ones that are missing.
+    """
+    with metrics.timer("dynamodb"):
+        return _apply_profane_counts(counts, file_id)
+
+
+def _apply_profane_counts(counts, file_id=None):
+    from botocore.exceptions import ClientError
+
+    def reviewer_update(reviewer_id, n, set_expression, condition=None, values=None):
+        update = {
+            "Key": {"reviewerID": reviewer_id},
+            "UpdateExpression": "ADD profane_count :n SET " + set_expression,
+            "ExpressionAttributeValues": {":n": n, **(values or {})},
+        }
+        if file_id is not None:
+            update["UpdateExpression"] = "ADD profane_count :n, applied_files :files SET " + set_expression
+            update["ExpressionAttributeValues"].update({":file": file_id, ":files": {file_id}})
+            condition = f"({condition}) AND NOT contains(applied_files, :file)" if condition \
+                else "NOT contains(applied_files, :file)"
+        if condition:
+            update["ConditionExpression"] = condition
+        return update
+
+    def ban_update(reviewer_id, n, condition=None):
+        values = {":true": True, ":status": BANNED_STATUS}
+        if condition:
+            condition = "attribute_not_exists(banned) OR banned = :false"
+            values[":false"] = False
+        return reviewer_update(reviewer_id, n, "banned = :true, ban_status = :status", condition, values)
 
-        # Read the raw file
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        raw_data = obj["Body"].read().decode("utf-8")
+    def ban(reviewer_id, n):
+        return ban_writer.transact_update(ban_update(reviewer_id, n, condition=True), ban_totals.add_banned_update())
 
-        processed_lines = []
+    # All updates are sent at once, the writer limits how many run at the same time
+    updates, bans = {}, {}
+    for reviewer_id, n in counts.items():
+        if n <= BAN_THRESHOLD:
+            updates[reviewer_id] = ban_writer.update_item(**reviewer_update(
+                reviewer_id, n, "banned = if_not_exists(banned, :false)",
+                "attribute_not_exists(profane_count) OR profane_count <= :limit",
+                {":false": False, ":limit": BAN_THRESHOLD - n},
+            ))
+        else:
+            bans[reviewer_id] = ban(reviewer_id, n)
+    total = None
+    if counts and file_id is not None:
+        total = ban_writer.transact_update(ban_totals.file_marker_update(file_id),
+                                           ban_totals.add_profane_update(sum(counts.values())))
+    elif counts:
+        total = ban_writer.update_item(**ban_totals.add_profane_update(sum(counts.values())))
+    calls = len(updates) + len(bans) + (total is not None)
 
-        # Check profanity line by line
-        for line in raw_data.strip().splitlines():
-            if not line.strip():
-                continue
+    for reviewer_id, update in updates.items():
+        try:
+            update.result()
+        except ClientError as e:
+            if not dynamo.condition_failed(e):
+                raise
+            # Over the threshold with this file (or the file was already added), ban
+            bans[reviewer_id] = ban(reviewer_id, counts[reviewer_id])
+            calls += 1
+
+    # Logic for user banning
+    for reviewer_id, update in bans.items():
+        try:
+            update.result()
+            print(f"Banning user {reviewer_id} for excessive profanity.")
+        except ClientError as e:
+            if not dynamo.condition_failed(e):
+                raise
+            # Already banned, only the count goes up (and the ban is not counted again)
+            calls += 1
             try:
-                review = json.loads(line)
-                flagged = False
-                reviewer_id = review.get('reviewerID', 'unknown')
-                # Check the relevant fields
-                for field in ["reviewText", "summary"]: 
-                    tokens = review.get(field, [])
-                    if isinstance(tokens, list) and contains_profanity(tokens):
-                        flagged = True
-                        # Logic for updating the DynamoDB table 
-                        resp = table.update_item(
-                            Key={"reviewerID": reviewer_id},
-                            UpdateExpression="ADD profane_count :one SET banned = if_not_exists(banned, :false)",
-                            ExpressionAttributeValues={":one": 1,":false": False},
-                            ReturnValues="UPDATED_NEW"
-                        )
-                        # Logic for user banning
-                        profane_count = int(resp["Attributes"].get("profane_count", 0))
-                        if profane_count > 3 and not resp["Attributes"].get("banned", False):
-                            print(f"Banning user {reviewer_id} for excessive profanity.")
-                            table.update_item(
-                                Key={"reviewerID": reviewer_id},
-                                UpdateExpression="SET banned = :true",
-                                ExpressionAttributeValues={":true": True}
-                            )
-                        break
-                # Add the correct flag to the review
-                review["has_profanity"] = flagged
-                processed_lines.append(json.dumps(review))
-            except json.JSONDecodeError:
-                continue
-
-        # Put result in next bucket
-        s3.put_object(
-            Bucket=presentiment_bucket,
-            Key=key,
-            Body="\n".join(processed_lines).encode("utf-8") # Join all lines back together 
-        )
+                ban_writer.update_item(**ban_update(reviewer_id, counts[reviewer_id])).result()
+            except ClientError as e:
+                if not dynamo.condition_failed(e):
+                    raise
+                # The file was already added to the reviewer (a retry)
+    if total is not None:
+        try:
+            total.result()
+        except ClientError as e:
+            if not dynamo.condition_failed(e):
+                raise
+            # The marker of the file exists, its profane reviews are already in the totals
+    return calls
+
+def get_banned_users():
+    """
+    All banned users, from the sparse index instead of a scan of the whole table.
+    Paginated, a single query only returns up to 1 MB.
+    """
+    kwargs = {
+        "IndexName": BANNED_INDEX,
+        "KeyConditionExpression": "ban_status = :status",
+        "ExpressionAttributeValues": {":status": BANNED_STATUS},
+    }
+    users = []
+    while True:
+        resp = table.query(**kwargs)
+        metrics.count("dynamodb_reads")
+        for item in resp.get("Items", []):
+            item.pop("ban_status", None)
+            item.pop("applied_files", None)
+            users.append(item)
+        if "LastEvaluatedKey" not in resp:
+            return users
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
 
-        #  Fetch banned users from DynamoDB 
-        print("Fetching banned users from DynamoDB...")
-        banned_users = table.scan(
-            FilterExpression="banned = :true",
-            ExpressionAttributeValues={":true": True}
-        ).get("Items", [])
-        
-        # DynamoDB returns Decimal types for numbers, 
-        # so we need to convert them to JSON-compatible types: 
-        from decimal import Decimal
-        class DecimalEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, Decimal):
-                    # Convert to int if it's a whole number, else float
-                    return int(obj) if obj % 1 == 0 else float(obj)
-                return super(DecimalEncoder, self).default(obj)
-
-        # Save the banned user list to S3
-        banned_json = "\n".join(json.dumps(user, cls=DecimalEncoder) for user in banned_users).encode("utf-8")
+# DynamoDB returns Decimal types for numbers, 
+# so we need to convert them to JSON-compatible types: 
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            # Convert to int if it's a whole number, else float
+            return int(obj) if obj % 1 == 0 else float(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+def write_banned_users():
+    """Saves the list of all banned users to banned-users.json in the output bucket"""
+    #  Fetch banned users from DynamoDB 
+    print("Fetching banned users from DynamoDB...")
+    with metrics.timer("dynamodb"):
+        banned_users = get_banned_users()
+
+    # Save the banned user list to S3
+    banned_json = "\n".join(json.dumps(user, cls=DecimalEncoder) for user in banned_users).encode("utf-8")
+    body = compression.compress(banned_json, compression.OUTPUT_COMPRESSION)
+    with metrics.timer("s3_write"):
         s3.put_object(
-            Bucket=output_bucket,
+            Bucket=bootstrap.parameter("output_bucket"),
             Key="banned-users.json",
-            Body=banned_json,
-            ContentType="application/json"
+            Body=body,
+            ContentType="application/json",
+            **compression.put_kwargs(compression.OUTPUT_COMPRESSION)
         )
-        print(f"Wrote banned-users.json with {len(banned_users)} users.")
+    metrics.count("bytes_out", len(body))
+    print(f"Wrote banned-users.json with {len(banned_users)} users.")
+
+def writer_counters():
+    """Requests of the ban table writer so far (it lives as long as the container), for the metrics"""
+    writer = ban_writer.metrics()
+    return {"dynamodb_writes": writer["requests"], "dynamodb_retries": writer["retries"],
+            "dynamodb_throttles": writer["throttles"]}
+
+def check_records(kind, records, writer, output, fmt, counts, cp=None):
+    """
+    Checks the reviews of open_input(...) and writes them with the flag to output, the profane
+    ones are counted per reviewer. With a checkpointer the progress is saved between lines /
+    blocks, returns False if the time is up (then the handler hands off).
+    """
+    # Parsing (only of the lines that need it) and writing are part of the check
+    with metrics.timer("profanity"):
+        if kind == "columnar":
+            for block in records:
+                flags = check_block(block, counts)
+                if fmt == "columnar":
+                    # Only the new column is encoded, the others are copied as they are
+                    output.write_block(block.with_column("has_profanity", flags), block.n_rows)
+                else:
+                    for review, flagged in zip(block.rows(), flags):
+                        review["has_profanity"] = flagged
+                        output.write_row(review)
+                if cp is not None and cp.due() and cp.save_progress(writer, output, counts=counts):
+                    return False
+        else:
+            # Check profanity line by line
+            skip_parse = SKIP_PARSE and fmt == "jsonl"
+            for line in records:
+                check_line(line, output, counts, skip_parse)
+                if cp is not None and cp.due() and cp.save_progress(writer, output, counts=counts):
+                    return False
+    output.flush()
+    return True
+
+def check_shard(record):
+    """One byte range of a big file (see common/shards.py), the checked part is merged by the coordinator"""
+    fmt = formats.INTERMEDIATE_FORMAT
+    metrics.set_property("shard", record["shard"]["index"])
+    kind, records = formats.open_input(shards.open_input(s3, record), decode=False, start=record["shard"]["start"])
+    counts = Counter()
+    with shards.open_part_writer(s3, record, compression.COMPRESSION, fmt, **formats.put_kwargs(fmt)) as writer:
+        output = formats.open_output(writer, fmt)
+        check_records(kind, records, writer, output, fmt, counts)
+    print(f"Checked shard {record['shard']['index']} ({output.rows_written} lines), peak RSS: {peak_rss_mb()} MB")
+    return shards.part_result(record, writer, counts=counts, lines_written=output.rows_written)
+
+@metrics.instrumented("profanity_check", counters=writer_counters)
+def handler(event, context):
+    # A shard of a big file, sent by the invocation that split it
+    if shards.shard_of(event["Records"][0]) is not None:
+        return check_shard(event["Records"][0])
+
+    for index, record in enumerate(event["Records"]):
+        # Get S3 key from the event
+        key = record["s3"]["object"]["key"]
+
+        # Progress of an earlier invocation on this file (a continuation or a retry), see common/checkpoint.py
+        cp = checkpoint.Checkpointer(s3, "profanity_check", record, context)
+        cp.load()
+
+        # Profane reviews per reviewer in this file
+        counts = Counter(cp.data.get("counts", {}))
+        output_bucket = bootstrap.parameter("presentiment_bucket")
+        fmt = formats.INTERMEDIATE_FORMAT
+
+        # A big file that was not started yet is split over parallel invocations (at the
+        # frames / blocks the preprocessing marked), the counts of the shards are added up
+        ranges = shards.plan(s3, record) if context is not None and cp.state is None else None
+        if ranges:
+            results = shards.fan_out(context, record, ranges, "profanity_check")
+            for result in results:
+                counts.update(result["counts"])
+            shards.merge(s3, results, output_bucket, key, indexed=True,
+                         **compression.put_kwargs(compression.COMPRESSION), **formats.put_kwargs(fmt))
+            print(f"Merged {len(results)} shards of {key}, {sum(r['lines_written'] for r in results)} lines")
+            metrics.count("files")
+            cp.output_done(counts=counts)
+        elif cp.phase != checkpoint.OUTPUT_DONE:
+            # Read the raw file (streamed, not read at once), JSON lines or columnar
+            kind, records = cp.open_input(decode=False)
+            metrics.count("files")
+
+            # Put result in next bucket, written in parts while we go. Big outputs are
+            # marked where the sentiment analysis can split them
+            with cp.open_writer(output_bucket, key, compression.COMPRESSION, split_size=shards.split_size(),
+                                **formats.put_kwargs(fmt)) as writer:
+                output = cp.open_output(writer, fmt)
+                if not check_records(kind, records, writer, output, fmt, counts, cp):
+                    return cp.hand_off(event["Records"][index:])
+                shards.save_index(s3, output_bucket, key, writer.splits)
+
+            print(f"Checked {output.rows_written} lines of {key}, wrote {writer.bytes_written} bytes, peak RSS: {peak_rss_mb()} MB")
+            cp.output_done(counts=counts)
+
+        # Update the ban table once per reviewer, only after the output was written.
+        # The updates are marked with the file, a retry after a crash in between doesn't count them twice
+        calls = apply_profane_counts(counts, cp.input_id)
+        cp.delete()
+        shards.delete_index(s3, record)
+        print(f"Updated {len(counts)} reviewers ({sum(counts.values())} profane reviews) with {calls} DynamoDB calls")
+        print(f"Ban table writer: {ban_writer.metrics()}")
+
+        write_banned_users()
 
     # Return a response
     return {"status": "OK"}
 
+
+# Everything is imported and set up, the time until here is the init of the container
+bootstrap.init_done()
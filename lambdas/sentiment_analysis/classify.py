@@ -0,0 +1,45 @@
+"""
+Sentiment of the reviews, without anything of AWS (the handler and the local batch
+runner both use it). The VADER lexicon has to be on nltk.data.path before this is
+imported, the analyzer is created once per container.
+"""
+import os
+
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+from lambdas.common.cache import ResultCache
+from lambdas.sentiment_analysis.engine import VaderBatchEngine, full_text
+
+# Instantiate analyzer
+analyzer = SentimentIntensityAnalyzer()
+
+# VADER compound scores, kept across warm invocations so repeated texts are only scored once.
+# The key is the whole "summary. reviewText" text, because VADER looks at the words around
+# each word (and at all "!" and "?"), so the score can't be put together from the two fields.
+SENTIMENT_CACHE = ResultCache(int(os.environ.get("RESULT_CACHE_SIZE", "50000")))
+
+def compound_score(text):
+    return SENTIMENT_CACHE.get_or_compute(text, lambda t: analyzer.polarity_scores(t)["compound"])
+
+# Returns 'positive', 'neutral', or 'negative' based on compound score
+def classify_sentiment(text, rating):
+    score = compound_score(text)
+    score += (rating-3)/2
+    if score >= 0.05:
+        return "positive"
+    elif score <= -0.05:
+        return "negative"
+    else:
+        return "neutral"
+
+# Scores whole batches with NumPy, texts VADER would treat specially still go through
+# VADER (see engine.py). SENTIMENT_ENGINE=vader scores every review with VADER like before.
+SENTIMENT_ENGINE = os.environ.get("SENTIMENT_ENGINE", "batch")
+engine = VaderBatchEngine(analyzer, fallback=compound_score)
+BATCH_SIZE = int(os.environ.get("SENTIMENT_BATCH_SIZE", "1000"))
+
+def classify_batch(reviews):
+    """Labels of many reviews, the same as classify_sentiment for each of them"""
+    if SENTIMENT_ENGINE == "batch":
+        return engine.classify(reviews)
+    return [classify_sentiment(full_text(review), review.get("overall", 3.0)) for review in reviews]
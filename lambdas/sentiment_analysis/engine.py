@@ -0,0 +1,198 @@
+"""
+Batch sentiment scores for the sentiment_analysis lambda.
+
+VADER's polarity_scores joins nothing we didn't split ourselves: it splits the
+"summary. reviewText" text again and walks every word through sentiment_valence,
+_but_check, _idioms_check and _never_check in pure Python. For the preprocessed
+tokens (lower case, no punctuation) most of that can't change anything: if a text
+has no negation, booster, "but", "least", "never"/"so"/"this", idiom or booster phrase
+("cut the mustard", "kind of"), every word just has its lexicon valence and the compound score is
+normalize(sum of the valences). That is computed for a whole batch at once with
+NumPy (np.bincount adds the valences in the same order as VADER's sum, so the
+scores are the same to the bit). Every other text (and anything unusual, e.g.
+upper case or punctuation in a token) goes through VADER itself.
+
+Label agreement with the per-review classification and the speedup:
+    python -m lambdas.sentiment_analysis.engine [reviews file, e.g. reviews_devset.json]
+"""
+import json
+import string
+import sys
+import time
+
+import numpy as np
+
+# Token codes: words that need the exact VADER path, words of a phrase (only exact
+# if the whole phrase is there) and words without valence
+EXACT = -1
+PHRASE_PART = -2
+NEUTRAL = 0
+
+# normalize() of VADER
+ALPHA = 15
+
+
+def _context_words(constants):
+    """Every single word that makes VADER look at the words around it"""
+    words = set(constants.NEGATE) | {"but", "least", "never", "so", "this"}
+    words.update(word for word in constants.BOOSTER_DICT if " " not in word)
+    return words
+
+
+def _phrases(constants):
+    """The idioms and booster phrases ("kind of"), they only count as the whole phrase"""
+    return {tuple(phrase.split()) for phrase in list(constants.BOOSTER_DICT) + list(constants.SPECIAL_CASE_IDIOMS)
+            if " " in phrase}
+
+
+class VaderBatchEngine:
+    """Compound scores and labels of many reviews at once, see the module docstring"""
+
+    def __init__(self, analyzer, fallback=None):
+        self.analyzer = analyzer
+        # Compound score of one text on the exact path (e.g. a cached polarity_scores)
+        self.fallback = fallback or (lambda text: analyzer.polarity_scores(text)["compound"])
+        self.context_words = _context_words(analyzer.constants)
+        self.phrases = _phrases(analyzer.constants)
+        self.phrase_words = {word for phrase in self.phrases for word in phrase}
+        self.punctuation = set(string.punctuation)
+        # Valence of every lexicon word by id, id 0 is "no valence"
+        self.valences = np.zeros(len(analyzer.lexicon) + 1)
+        self._lexicon_ids = {}
+        for i, (word, valence) in enumerate(analyzer.lexicon.items(), start=1):
+            self.valences[i] = valence
+            self._lexicon_ids[word] = i
+        # Code of every token seen so far (EXACT, NEUTRAL or the lexicon id)
+        self._codes = {}
+        self.exact_count = 0
+        self.fast_count = 0
+
+    def _code(self, token):
+        if not isinstance(token, str):
+            code = EXACT
+        elif token.lower() in self.context_words or "n't" in token.lower():
+            code = EXACT
+        elif token != token.lower() or not self.punctuation.isdisjoint(token):
+            code = EXACT
+        elif len(token) < 2:
+            # VADER drops these
+            code = NEUTRAL
+        elif token in self.phrase_words:
+            code = PHRASE_PART
+        else:
+            code = self._lexicon_ids.get(token, NEUTRAL)
+        self._codes[token] = code
+        return code
+
+    def compound_scores(self, reviews):
+        """VADER compound score of f"{summary}. {reviewText}" of every review (list of floats)"""
+        codes = self._codes
+        ids = []
+        owners = []
+        exact = []
+        for row, review in enumerate(reviews):
+            summary = review.get("summary", [])
+            text = review.get("reviewText", [])
+            if not isinstance(summary, list) or not isinstance(text, list):
+                exact.append(row)
+                continue
+            # The "." after the summary stays on a one letter word, let VADER handle that
+            if summary and len(summary[-1]) == 1:
+                exact.append(row)
+                continue
+            row_ids = []
+            has_phrase_part = False
+            for token in summary + text:
+                code = codes[token] if token in codes else self._code(token)
+                if code == EXACT:
+                    break
+                if code == PHRASE_PART:
+                    has_phrase_part = True
+                    code = self._lexicon_ids.get(token, NEUTRAL)
+                if code:
+                    row_ids.append(code)
+            else:
+                if not has_phrase_part or not self._has_phrase(summary + text):
+                    ids.extend(row_ids)
+                    owners.extend([row] * len(row_ids))
+                    continue
+            exact.append(row)
+
+        sums = np.bincount(np.array(owners, dtype=np.int64), weights=self.valences[np.array(ids, dtype=np.int64)],
+                           minlength=len(reviews))
+        scores = sums / np.sqrt(sums * sums + ALPHA)
+        # round() like polarity_scores (Python's round, np.round can differ in the last digit)
+        scores = [round(score, 4) for score in scores.tolist()]
+        for row in exact:
+            review = reviews[row]
+            scores[row] = self.fallback(full_text(review))
+        self.exact_count += len(exact)
+        self.fast_count += len(reviews) - len(exact)
+        return scores
+
+    def _has_phrase(self, tokens):
+        """Whether one of the phrases is in the tokens (as VADER sees them, without one letter words)"""
+        words = [token for token in tokens if len(token) > 1]
+        for n in {len(phrase) for phrase in self.phrases}:
+            for start in range(len(words) - n + 1):
+                if tuple(words[start:start + n]) in self.phrases:
+                    return True
+        return False
+
+    def classify(self, reviews):
+        """Labels ("positive", "neutral", "negative") of the reviews, the rating moves the score like before"""
+        scores = np.array(self.compound_scores(reviews), dtype=np.float64)
+        ratings = np.array([review.get("overall", 3.0) for review in reviews], dtype=np.float64)
+        scores += (ratings - 3) / 2
+        labels = np.where(scores >= 0.05, "positive", np.where(scores <= -0.05, "negative", "neutral"))
+        return labels.tolist()
+
+
+def full_text(review):
+    """The text the handler scores, the tokens joined again"""
+    review_text = " ".join(review.get("reviewText", []))
+    summary_text = " ".join(review.get("summary", []))
+    return f"{summary_text}. {review_text}".strip()
+
+
+def benchmark(reviews, analyzer, repeat=3):
+    """Label agreement with the per-review classification and the time of both (seconds)"""
+    def classify_one(review):
+        score = analyzer.polarity_scores(full_text(review))["compound"]
+        score += (review.get("overall", 3.0) - 3) / 2
+        return "positive" if score >= 0.05 else "negative" if score <= -0.05 else "neutral"
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = [classify_one(review) for review in reviews]
+    old_time = (time.perf_counter() - start) / repeat
+
+    # Built once per container in the lambda
+    engine = VaderBatchEngine(analyzer)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        labels = engine.classify(reviews)
+    new_time = (time.perf_counter() - start) / repeat
+    agree = sum(a == b for a, b in zip(expected, labels))
+    return {"reviews": len(reviews), "agree": agree, "exact_path": engine.exact_count // repeat,
+            "old_s": old_time, "new_s": new_time}
+
+
+if __name__ == "__main__":
+    import os
+
+    import nltk
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+    from lambdas.preprocessing.handler import preprocess_reviews
+
+    nltk.data.path.insert(0, os.path.join(os.path.dirname(__file__), "nltk_data"))
+    # Raw reviews, preprocessed like the first lambda does
+    with open(sys.argv[1] if len(sys.argv) > 1 else "reviews_sample.json", "r", encoding="utf-8") as f:
+        reviews = [json.loads(line) for line in f if line.strip()]
+    preprocess_reviews(reviews)
+    r = benchmark(reviews, SentimentIntensityAnalyzer())
+    print(f"{r['reviews']} reviews, {r['exact_path']} on the exact VADER path, "
+          f"labels agree for {r['agree']} ({r['agree'] / r['reviews']:.2%})")
+    print(f"VADER review by review: {r['old_s'] * 1000:.1f} ms, batch engine: {r['new_s'] * 1000:.1f} ms "
+          f"({r['old_s'] / r['new_s']:.1f}x)")
@@ -1,26 +1,25 @@
+# Imported first, it times the cold start of the lambda (see common/bootstrap.py)
+from lambdas.common import bootstrap
 import os
 import json
-import boto3
 import nltk
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
 
-# Download VADER lexicon to a Lambda-writable location
-nltk.data.path.append("/tmp")
-nltk.download("vader_lexicon", download_dir="/tmp")
+# The VADER lexicon is packed into the deployment package by build_bundles.py, nothing is downloaded at import.
+# It has to be on the path before classify.py creates the analyzer.
+nltk.data.path.insert(0, os.path.join(os.path.dirname(__file__), "nltk_data"))
 
-# Set NLTK to look in the Lambda-writable directory
-os.environ["NLTK_DATA"] = "/tmp"
+from lambdas.common import aws, ban_totals, checkpoint, codec, compression, counters, dynamo, formats, metrics, shards
+from lambdas.common.streaming import peak_rss_mb
+# The classification itself is in classify.py (no AWS in there, the local batch runner uses it too)
+from lambdas.sentiment_analysis.classify import (
+    BATCH_SIZE, SENTIMENT_CACHE, classify_batch, engine,
+)
 
-# Instantiate analyzer
-analyzer = SentimentIntensityAnalyzer()
-
-# Set up AWS clients with LocalStack endpoint
-endpoint_url = os.environ.get("AWS_ENDPOINT_URL") or ("http://" + os.environ.get("LOCALSTACK_HOSTNAME", "localhost") + ":4566")
-s3 = boto3.client("s3", endpoint_url=endpoint_url)
-ssm = boto3.client("ssm", endpoint_url=endpoint_url)
+# Set up AWS clients with LocalStack endpoint (or the in-memory ones, see common/aws.py)
+s3 = aws.client("s3")
 
 # Get the DynamoDB table for ban status
-dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
+dynamodb = aws.resource('dynamodb')
 table_name = os.environ.get("BAN_TABLE", "ban_table")
 ban_table = dynamodb.Table(table_name)
 
@@ -28,8 +27,17 @@ ban_table = dynamodb.Table(table_name)
 table_name2 = os.environ.get("SENTIMENT_TABLE", "sentiment_table")
 sentiment_table = dynamodb.Table(table_name2)
 
-# Get the bucket names from SSM parameters for result output
-output_bucket = ssm.get_parameter(Name="/dic/output_bucket")["Parameter"]["Value"]
+# The counter updates run in parallel, rate limited and retried (see common/dynamo.py)
+sentiment_writer = dynamo.DynamoWriter(
+    aws.client("dynamodb", config=dynamo.client_config()), table_name2
+)
+
+# The counts are spread over COUNTER_SHARDS items, so parallel invocations don't all update the same keys
+sentiment_counter = counters.ShardedCounter(dynamodb, sentiment_writer, "sentiment")
+
+# The bucket names are SSM parameters, all of them come with one call and are cached
+# (see common/bootstrap.py). Fetched here for the cold start, the invocations read them again.
+bootstrap.config()
 
 # DynamoDB returns Decimal types for numbers, 
 # so we need to convert them to JSON-compatible types: 
@@ -41,106 +49,158 @@ class DecimalEncoder(json.JSONEncoder):
             return int(obj) if obj % 1 == 0 else float(obj)
         return super(DecimalEncoder, self).default(obj)
 
-# For counting profane reviews and banned users
+# For counting profane reviews and banned users, kept up to date by the profanity lambda
+# in one item of the ban table (see common/ban_totals.py), so no scan of the table
 def get_total_profane_and_banned():
-    profane_total = 0
-    ban_total = 0
-    response = ban_table.scan()
-
-    for item in response["Items"]:
-        profane_count = item.get("profane_count", 0)
-        ban = item.get("banned", False)
-        if isinstance(profane_count, Decimal):  # DynamoDB uses Decimal
-            profane_total += int(profane_count)
-        if ban:  # Only count banned users
-            ban_total += 1 
-        
-    return  profane_total, ban_total
-
-# Returns 'positive', 'neutral', or 'negative' based on compound score
-def classify_sentiment(text, rating):
-    score = analyzer.polarity_scores(text)["compound"]
-    score += (rating-3)/2
-    if score >= 0.05:
-        return "positive"
-    elif score <= -0.05:
-        return "negative"
-    else:
-        return "neutral"
-
-def handler(event, context):
-    for record in event["Records"]:
-        # Get file from S3 event trigger
-        bucket = record["s3"]["bucket"]["name"]
-        key = record["s3"]["object"]["key"]
-
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        raw_data = obj["Body"].read().decode("utf-8")
-
-        processed_lines = []
-
-        # For counting the sentiment of reviews
-        sentiment_total = {"positive": 0, "neutral": 0, "negative": 0}
-
-        # Process line by line
-        for line in raw_data.strip().splitlines():
-            if not line.strip():
-                continue
-            try:
-                review = json.loads(line)
-
-                # Join tokenized fields to get the original text
-                review_text = " ".join(review.get("reviewText", []))
-                summary_text = " ".join(review.get("summary", []))
-                overall_rating = review.get("overall", 3.0) # if no rating, then 3
-                full_text = f"{summary_text}. {review_text}".strip()
-
-                # Classify Sentiment
-                sentiment = classify_sentiment(full_text, overall_rating)
-                review["sentiment"] = sentiment
-                
-                # Count sentiments (more efficient than DynamoDB update per review)
-                sentiment_total[sentiment] += 1
-
-                processed_lines.append(json.dumps(review))
-            except json.JSONDecodeError:
-                continue  # Skip malformed lines
-
-        # Save processed reviews with sentiment tags
-        s3.put_object(
-            Bucket=output_bucket,
-            Key=key,
-            Body="\n".join(processed_lines).encode("utf-8")
-        )
-
-    # Update sentiment counts in DynamoDB (Update per sentiment instead of per review as done previously)
-    for sentiment, count in sentiment_total.items():
-        sentiment_table.update_item(
-            Key={"sentiment": sentiment},
-            UpdateExpression="ADD c :one",  # used c since "count" and "counter" are reserved words
-            ExpressionAttributeValues={":one": count},
-            ReturnValues="UPDATED_NEW"
-        )
-    
+    return ban_totals.get_totals(ban_table)
+
+def write_batch(reviews, writer, sentiment_total):
+    """Classifies a batch of reviews, counts the sentiments and writes the reviews with them"""
+    with metrics.timer("sentiment"):
+        sentiments = classify_batch(reviews)
+    with metrics.timer("write"):
+        for review, sentiment in zip(reviews, sentiments):
+            review["sentiment"] = sentiment
+            # Count sentiments (more efficient than DynamoDB update per review)
+            sentiment_total[sentiment] += 1
+            # The final output stays JSON lines
+            writer.write_line(codec.dumps(review))
+
+def classify_records(kind, records, writer, sentiment_total, cp=None):
+    """
+    Classifies the reviews of open_input(...) in batches and writes them with their sentiment.
+    With a checkpointer the progress is saved between batches, returns False if the time
+    is up (then the handler hands off).
+    """
+    # Reading the reviews and parsing them, the steps inside have their own timers
+    with metrics.timer("parse"):
+        batch = []
+        for reviews in formats.iter_review_groups(kind, records):
+            batch.extend(reviews)
+            if len(batch) >= BATCH_SIZE:
+                write_batch(batch, writer, sentiment_total)
+                batch = []
+                # Only between batches, then every review up to the offset is written
+                if cp is not None and cp.due() and cp.save_progress(writer, None, sentiment_total=sentiment_total):
+                    return False
+        write_batch(batch, writer, sentiment_total)
+    return True
+
+def classify_shard(record):
+    """One byte range of a big file (see common/shards.py), the classified part is merged by the coordinator"""
+    metrics.set_property("shard", record["shard"]["index"])
+    kind, records = formats.open_input(shards.open_input(s3, record), start=record["shard"]["start"])
+    sentiment_total = {"positive": 0, "neutral": 0, "negative": 0}
+    with shards.open_part_writer(s3, record, compression.OUTPUT_COMPRESSION) as writer:
+        classify_records(kind, records, writer, sentiment_total)
+    print(f"Classified shard {record['shard']['index']} ({writer.lines_written} lines), peak RSS: {peak_rss_mb()} MB")
+    return shards.part_result(record, writer, sentiment_total=sentiment_total, lines_written=writer.lines_written)
+
+def write_total_counts(lines_written):
+    """Saves the profane, banned and sentiment totals to total_counts.json in the output bucket"""
     # To count everything together 
-    profane_total, banned_total = get_total_profane_and_banned()
-    sentiment_counts = sentiment_table.scan()
-    sentiment_counts = {item["sentiment"]: int(item["c"]) for item in sentiment_counts["Items"]}
+    with metrics.timer("dynamodb"):
+        profane_total, banned_total = get_total_profane_and_banned()
+        sentiment_counts = sentiment_counter.totals()
 
     # Convert counts to JSON
     count_json = json.dumps({
         "total_profane_reviews": profane_total,
         "total_banned_users": banned_total,
         "sentiment_counts": sentiment_counts,
-        "total_reviews_processed": len(processed_lines)
+        "total_reviews_processed": lines_written
     }, cls=DecimalEncoder, indent = 4)
 
     # Save the counts to S3
-    s3.put_object(
-            Bucket=output_bucket,
-            Key="total_counts.json",
-            Body=count_json,
-            ContentType="application/json"
-        )
+    body = compression.compress(count_json.encode("utf-8"), compression.OUTPUT_COMPRESSION)
+    with metrics.timer("s3_write"):
+        s3.put_object(
+                Bucket=bootstrap.parameter("output_bucket"),
+                Key="total_counts.json",
+                Body=body,
+                ContentType="application/json",
+                **compression.put_kwargs(compression.OUTPUT_COMPRESSION)
+            )
+    metrics.count("bytes_out", len(body))
+
+def counters_so_far():
+    """Cache, engine and writer numbers so far (they live as long as the container), for the metrics"""
+    writer = sentiment_writer.metrics()
+    return {
+        "sentiment_cache_hits": SENTIMENT_CACHE.hits,
+        "sentiment_cache_misses": SENTIMENT_CACHE.misses,
+        "reviews_vectorized": engine.fast_count,
+        "reviews_vader": engine.exact_count,
+        "dynamodb_writes": writer["requests"],
+        "dynamodb_retries": writer["retries"],
+        "dynamodb_throttles": writer["throttles"],
+    }
+
+@metrics.instrumented("sentiment_analysis", counters=counters_so_far)
+def handler(event, context):
+    # A shard of a big file, sent by the invocation that split it
+    if shards.shard_of(event["Records"][0]) is not None:
+        return classify_shard(event["Records"][0])
+
+    # Lines of all files of the event (with the ones an earlier invocation finished before it handed off)
+    total_lines = event.get("lines_written", 0)
+    for index, record in enumerate(event["Records"]):
+        # Get file from S3 event trigger
+        key = record["s3"]["object"]["key"]
+
+        # Progress of an earlier invocation on this file (a continuation or a retry), see common/checkpoint.py
+        cp = checkpoint.Checkpointer(s3, "sentiment_analysis", record, context)
+        cp.load()
+
+        # For counting the sentiment of reviews
+        sentiment_total = cp.data.get("sentiment_total", {"positive": 0, "neutral": 0, "negative": 0})
+        lines_written = cp.data.get("lines_written", 0)
+
+        # A big file that was not started yet is split over parallel invocations (at the
+        # frames / blocks the profanity check marked), the sentiments of the shards are added up
+        ranges = shards.plan(s3, record) if context is not None and cp.state is None else None
+        if ranges:
+            results = shards.fan_out(context, record, ranges, "sentiment_analysis")
+            for result in results:
+                for sentiment, n in result["sentiment_total"].items():
+                    sentiment_total[sentiment] += n
+            lines_written = sum(result["lines_written"] for result in results)
+            shards.merge(s3, results, bootstrap.parameter("output_bucket"), key,
+                         **compression.put_kwargs(compression.OUTPUT_COMPRESSION))
+            print(f"Merged {len(results)} shards of {key}, {lines_written} lines")
+            metrics.count("files")
+            cp.output_done(sentiment_total=sentiment_total, lines_written=lines_written)
+        elif cp.phase != checkpoint.OUTPUT_DONE:
+            # Save processed reviews with sentiment tags, written in parts while we go
+            with cp.open_writer(bootstrap.parameter("output_bucket"), key, compression.OUTPUT_COMPRESSION) as writer:
+                # Process the reviews in batches (streamed, not read at once), JSON lines or columnar
+                kind, records = cp.open_input()
+                metrics.count("files")
+                if not classify_records(kind, records, writer, sentiment_total, cp):
+                    return cp.hand_off(event["Records"][index:], lines_written=total_lines)
+
+            lines_written = writer.lines_written
+            cp.output_done(sentiment_total=sentiment_total, lines_written=lines_written)
+            print(f"Classified {writer.lines_written} lines of {key}, wrote {writer.bytes_written} bytes, peak RSS: {peak_rss_mb()} MB")
+            print(f"Sentiment cache hit rate: {SENTIMENT_CACHE.hit_rate():.1%}, "
+                  f"batch engine: {engine.fast_count} reviews vectorized, {engine.exact_count} with VADER")
+
+        # Update sentiment counts of this file in DynamoDB, all three in one update of one shard
+        # (see common/counters.py), before the next file, so a hand off doesn't lose them
+        with metrics.timer("dynamodb"):
+            update = sentiment_counter.add(sentiment_total, hint=key, file_id=cp.input_id)
+            # The update has to be acked before the totals are read, a retry of the file adds nothing
+            if not sentiment_counter.added(update):
+                print(f"Sentiments of {key} were already counted")
+        cp.delete()
+        shards.delete_index(s3, record)
+        total_lines += lines_written
+    print(f"Sentiment table writer: {sentiment_writer.metrics()}")
+
+    write_total_counts(total_lines)
     # Return response
     return {"status": "OK"}
+
+
+# Everything is imported and set up, the time until here is the init of the container
+bootstrap.init_done()
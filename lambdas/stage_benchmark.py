@@ -0,0 +1,455 @@
+"""
+Throughput and memory of every stage of the pipeline, with a regression gate:
+    python -m lambdas.stage_benchmark [--sizes 10000,100000] [--stages ...] [-o results.json]
+                                      [--baseline benchmarks/baseline.json] [--tolerance 0.25] [--update-baseline]
+                                      [--any-machine]
+
+The corpora are made from reviews_sample.json: every synthetic review is a sample review
+with a new reviewer (a quarter as many reviewers as reviews) and a part of its words
+swapped for words of other reviews, so the texts are different like in a real upload and
+the result caches don't get everything for free. They are made once per size and seed
+and kept in benchmarks/corpora, together with the preprocessed tokens the profanity
+check and the sentiment classification get as input.
+
+The stages:
+- tokenize (tokenize_texts of the preprocessing, without lemmatizing, also tokens_per_s),
+  preprocess_text, contains_profanity, classify_sentiment (VADER per review),
+  classify_batch (what the sentiment lambda uses) and json_roundtrip (codec.loads and
+  codec.dumps of every line): the function on every review, without reading the file
+- staged: the three handlers one after another (handler:preprocessing, handler:profanity_check,
+  handler:sentiment_analysis), fused: handler:fused_pipeline. They run on the in-memory
+  AWS of common/memory_aws.py (MEMORY_LATENCY_MS etc. are used), only the time in the
+  handlers is counted, not the upload of the corpus.
+
+Every stage runs in a new process, so the caches are cold and nothing else is in memory.
+Lines/s is reviews per second. The memory is the RSS, sampled while the stage runs:
+peak_rss_mb is the highest RSS of the process, peak_delta_mb how much of it the stage
+added (for the handlers the corpus in the in-memory S3 is already there before, but the
+files they write are kept in it too, so these are more than in a real lambda). Groups
+that take less than MIN_SECONDS are run again (at most MAX_RUNS times) and the fastest
+run counts, short runs vary too much for the gate.
+
+The results (and the Python version and machine) are written as JSON. If a baseline file
+exists, every stage and size that is in both is compared with it and the exit code is 1
+if its lines/s are more than --tolerance below the baseline. --update-baseline puts
+the results into the baseline instead (replacing the same stages and sizes).
+
+The numbers only mean something on the same machine, so the baseline is not in the repo
+(benchmarks/baseline.json is ignored): make it with --update-baseline on the machine that
+runs the gate, before the change. A baseline of another machine (Python, processor, CPUs
+or JSON codec differ, see same_machine) is not compared with, only with --any-machine.
+The default sizes are 10k and 100k, a gate run with 1M (--sizes 10000,100000,1000000)
+takes about half an hour.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from lambdas.common import codec
+from lambdas.common.streaming import peak_rss_mb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_FILE = os.path.join(ROOT, "reviews_sample.json")
+CORPUS_DIR = os.path.join(ROOT, "benchmarks", "corpora")
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+SIZES = [10000, 100000]
+
+# One word in this many of a review text is swapped for a word of another review
+SWAP_EVERY = 4
+
+# Reviews per chunk for the function stages (parsing them is not counted)
+CHUNK_LINES = 2000
+
+# Seconds between two RSS samples
+SAMPLE_INTERVAL = 0.01
+
+# Stage groups, every group runs in its own process
+FUNCTION_STAGES = ["tokenize", "preprocess_text", "contains_profanity", "classify_sentiment", "classify_batch", "json_roundtrip"]
+HANDLER_STAGES = {
+    "staged": ["preprocessing", "profanity_check", "sentiment_analysis"],
+    "fused": ["fused_pipeline"],
+}
+GROUPS = FUNCTION_STAGES + list(HANDLER_STAGES)
+
+# The lines/s of a stage may be this much lower than the baseline
+TOLERANCE = 0.25
+
+# Groups faster than this (seconds in the stages) are run again, up to MAX_RUNS times
+MIN_SECONDS = 10
+MAX_RUNS = 5
+
+
+def corpus_paths(size, seed, directory=CORPUS_DIR):
+    """(reviews file, preprocessed tokens file) of the corpus"""
+    base = os.path.join(directory, f"reviews-{size}-seed{seed}")
+    return base + ".json", base + ".tokens.json"
+
+
+def make_corpus(path, size, seed=0, sample=SAMPLE_FILE):
+    """Writes size synthetic reviews made from the sample reviews to path (the same for the same seed)"""
+    with open(sample, "rb") as f:
+        reviews = [json.loads(line) for line in f if line.strip()]
+    words = [word for review in reviews for word in review.get("reviewText", "").split()]
+    reviewers = max(1, size // 4)
+    rng = random.Random(seed)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for _ in range(size):
+            review = dict(rng.choice(reviews))
+            tokens = review.get("reviewText", "").split()
+            for _ in range(len(tokens) // SWAP_EVERY):
+                tokens[rng.randrange(len(tokens))] = rng.choice(words)
+            review["reviewText"] = " ".join(tokens)
+            review["reviewerID"] = f"B{rng.randrange(reviewers):09d}"
+            f.write(json.dumps(review) + "\n")
+    os.replace(tmp_path, path)
+
+
+def make_tokens(path, tokens_path):
+    """Writes the reviews of path with preprocessed reviewText and summary, the input of the later stages"""
+    from lambdas.preprocessing.handler import preprocess_reviews
+
+    tmp_path = tokens_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for reviews in iter_chunks(path):
+            preprocess_reviews(reviews)
+            f.write("".join(json.dumps(review) + "\n" for review in reviews))
+    os.replace(tmp_path, tokens_path)
+
+
+def ensure_corpus(size, seed=0, directory=CORPUS_DIR):
+    path, tokens_path = corpus_paths(size, seed, directory)
+    if not os.path.exists(path):
+        print(f"making {path}", flush=True)
+        make_corpus(path, size, seed)
+    if not os.path.exists(tokens_path):
+        print(f"making {tokens_path}", flush=True)
+        make_tokens(path, tokens_path)
+    return path, tokens_path
+
+
+def iter_chunks(path, chunk_lines=CHUNK_LINES, parse=True):
+    """Lists of chunk_lines reviews (or raw lines) of a JSON lines file"""
+    chunk = []
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(codec.loads(line) if parse else line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def current_rss_mb():
+    """RSS of this process right now in MB, the peak so far where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb() or 0.0
+
+
+class RssSampler:
+    """Samples the RSS in a thread between start() and stop(), stop() returns (RSS at the start, peak) in MB"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.start_mb, self.peak_mb
+
+
+def result(stage, size, lines, seconds, start_mb, peak_mb, tokens=None):
+    r = {
+        "stage": stage,
+        "size": size,
+        "lines": lines,
+        "seconds": round(seconds, 4),
+        "lines_per_s": round(lines / max(seconds, 1e-9), 1),
+        "peak_rss_mb": round(peak_mb, 1),
+        "peak_delta_mb": round(peak_mb - start_mb, 1),
+    }
+    if tokens is not None:
+        r["tokens"] = tokens
+        r["tokens_per_s"] = round(tokens / max(seconds, 1e-9), 1)
+    return r
+
+
+def function_stage(stage):
+    """
+    (input file "raw" or "tokens", parse the lines?, function that runs the stage on one chunk).
+    The function of tokenize returns the number of tokens, for tokens_per_s.
+    """
+    if stage == "tokenize":
+        from lambdas.preprocessing.handler import tokenize_texts
+
+        def run(reviews):
+            tokens = tokenize_texts([review.get(field, "") for review in reviews for field in ("reviewText", "summary")])
+            return sum(map(len, tokens))
+        return "raw", True, run
+    if stage == "preprocess_text":
+        from lambdas.preprocessing.handler import preprocess_text
+
+        def run(reviews):
+            for review in reviews:
+                preprocess_text(review.get("reviewText", ""))
+                preprocess_text(review.get("summary", ""))
+        return "raw", True, run
+    if stage == "contains_profanity":
+        from lambdas.profanity_check.checks import contains_profanity
+
+        def run(reviews):
+            for review in reviews:
+                contains_profanity(review.get("reviewText", []))
+                contains_profanity(review.get("summary", []))
+        return "tokens", True, run
+    if stage == "classify_sentiment":
+        from lambdas.sentiment_analysis.classify import classify_sentiment
+        from lambdas.sentiment_analysis.engine import full_text
+
+        def run(reviews):
+            for review in reviews:
+                classify_sentiment(full_text(review), review.get("overall", 3.0))
+        return "tokens", True, run
+    if stage == "classify_batch":
+        from lambdas.sentiment_analysis.classify import classify_batch
+
+        return "tokens", True, classify_batch
+    if stage == "json_roundtrip":
+        def run(lines):
+            for line in lines:
+                codec.dumps(codec.loads(line))
+        return "raw", False, run
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def run_function_stage(stage, size, path, tokens_path):
+    source, parse, run = function_stage(stage)
+    seconds = 0.0
+    lines = 0
+    tokens = None
+    sampler = RssSampler()
+    sampler.start()
+    for chunk in iter_chunks(path if source == "raw" else tokens_path, parse=parse):
+        start = time.perf_counter()
+        counted = run(chunk)
+        seconds += time.perf_counter() - start
+        lines += len(chunk)
+        if stage == "tokenize":
+            tokens = (tokens or 0) + counted
+    start_mb, peak_mb = sampler.stop()
+    return [result(stage, size, lines, seconds, start_mb, peak_mb, tokens)]
+
+
+def run_handler_stages(group, size, path):
+    """Uploads the corpus to the in-memory pipeline of the mode and times the handlers it triggers"""
+    from lambdas.common import aws
+    from lambdas.common.memory_aws import Latency, MemoryAWS, deploy_pipeline
+    from lambdas.local_batch import ensure_nltk_data
+
+    ensure_nltk_data()
+    backend = aws.backend() or aws.set_backend(MemoryAWS(Latency.from_env()))
+    buckets = deploy_pipeline(backend, mode=group)
+    functions = backend.lambda_.functions
+    stats = {name: {"seconds": 0.0, "start_mb": None, "peak_mb": 0.0} for name in HANDLER_STAGES[group]}
+
+    def timed(name, handler):
+        def run(event, context):
+            sampler = RssSampler()
+            sampler.start()
+            start = time.perf_counter()
+            try:
+                return handler(event, context)
+            finally:
+                stats[name]["seconds"] += time.perf_counter() - start
+                start_mb, peak_mb = sampler.stop()
+                if stats[name]["start_mb"] is None:
+                    stats[name]["start_mb"] = start_mb
+                stats[name]["peak_mb"] = max(stats[name]["peak_mb"], peak_mb)
+        return run
+
+    for name in stats:
+        # Imported here, so the import and the start of the handler are not counted
+        functions[name].handler = timed(name, backend.lambda_._handler(functions[name]))
+
+    with open(path, "rb") as f:
+        body = f.read()
+    backend.client("s3").put_object(Bucket=buckets["input"], Key=os.path.basename(path), Body=body)
+    del body
+    backend.drain()
+    return [result(f"handler:{name}", size, size, s["seconds"], s["start_mb"] or 0.0, s["peak_mb"])
+            for name, s in stats.items()]
+
+
+def run_group(group, size, path, tokens_path):
+    """The results of one stage group on one corpus, as a list of dicts"""
+    if group in HANDLER_STAGES:
+        return run_handler_stages(group, size, path)
+    return run_function_stage(group, size, path, tokens_path)
+
+
+def run_isolated(group, size, path, tokens_path):
+    """run_group in a new process"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_group, group, size, path, tokens_path).result()
+
+
+def order(stage):
+    """Position of the stage in the reports"""
+    stages = FUNCTION_STAGES + [f"handler:{name}" for names in HANDLER_STAGES.values() for name in names]
+    return stages.index(stage) if stage in stages else len(stages)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compares the lines/s of the results with the ones of the baseline (both lists of result dicts).
+    Returns (lines of the report, regressions as (stage, size, lines/s, baseline lines/s)).
+    """
+    base = {(r["stage"], r["size"]): r["lines_per_s"] for r in baseline}
+    report = []
+    regressions = []
+    for r in results:
+        key = (r["stage"], r["size"])
+        if key not in base:
+            continue
+        ratio = r["lines_per_s"] / max(base[key], 1e-9)
+        failed = ratio < 1 - tolerance
+        report.append(f"  {r['stage']:28s} {r['size']:>8d} {r['lines_per_s']:>12.0f} {base[key]:>12.0f} "
+                      f"{ratio:7.0%}{'  REGRESSION' if failed else ''}")
+        if failed:
+            regressions.append((r["stage"], r["size"], r["lines_per_s"], base[key]))
+    return report, regressions
+
+
+def machine():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "codec": codec.backend.name,
+    }
+
+
+def same_machine(a, b):
+    """Whether two machine() dicts are comparable (the platform string changes with every kernel update)"""
+    keys = ("python", "processor", "cpus", "codec")
+    return all(a.get(key) == b.get(key) for key in keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and memory of every stage, with a regression gate")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="corpus sizes in reviews (comma-separated)")
+    parser.add_argument("--stages", default=",".join(GROUPS), help=f"comma-separated, of {', '.join(GROUPS)}")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpora")
+    parser.add_argument("--repeat", type=int, default=1, help="at least this many runs per stage, the fastest counts")
+    parser.add_argument("-o", "--output", default="benchmark-results.json", help="results file (JSON)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline results to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed drop of lines/s (0.25 = 25%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--any-machine", action="store_true", help="compare with a baseline of another machine too")
+    parser.add_argument("--corpus-dir", default=CORPUS_DIR, help="where the corpora are kept")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    groups = [group for group in args.stages.split(",") if group]
+    for group in groups:
+        if group not in GROUPS:
+            parser.error(f"unknown stage {group}")
+
+    results = []
+    for size in sizes:
+        path, tokens_path = ensure_corpus(size, args.seed, args.corpus_dir)
+        for group in groups:
+            runs = []
+            while len(runs) < args.repeat or (len(runs) < MAX_RUNS and
+                                              sum(r["seconds"] for run in runs for r in run) < MIN_SECONDS):
+                runs.append(run_isolated(group, size, path, tokens_path))
+            # The fastest run of every stage of the group
+            for stage_results in zip(*runs):
+                best = max(stage_results, key=lambda r: r["lines_per_s"])
+                results.append(best)
+                tokens = f"  {best['tokens_per_s']:>12.0f} tokens/s" if "tokens_per_s" in best else ""
+                print(f"{best['stage']:28s} {size:>8d} lines {best['lines_per_s']:>12.0f} lines/s  "
+                      f"peak RSS {best['peak_rss_mb']:8.1f} MB (+{best['peak_delta_mb']:.1f}){tokens}", flush=True)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": machine(),
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        # The stages and sizes that were not run stay as they are
+        new = {(r["stage"], r["size"]) for r in results}
+        if baseline is not None:
+            report["results"] = [r for r in baseline["results"] if (r["stage"], r["size"]) not in new] + results
+        report["results"].sort(key=lambda r: (r["size"], order(r["stage"])))
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if baseline is None:
+        print(f"no baseline {args.baseline}, nothing to compare with")
+        return 0
+
+    if not same_machine(baseline.get("machine", {}), report["machine"]) and not args.any_machine:
+        print("=" * 72)
+        print(f"WARNING: {args.baseline} is from another machine, not comparing with it")
+        print(f"  baseline: {baseline.get('machine')}")
+        print(f"  this one: {report['machine']}")
+        print("  make one here with --update-baseline (or compare anyway with --any-machine)")
+        print("=" * 72)
+        return 0
+
+    lines, regressions = compare(results, baseline["results"], args.tolerance)
+    print(f"compared with {args.baseline} (lines/s, now / baseline):")
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} stage(s) more than {args.tolerance:.0%} slower than the baseline")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,42 +7,79 @@ $inputBucket = "reviews-bucket-input"
 $cleanedBucket = "reviews-bucket-cleaned"
 $presentimentBucket = "reviews-bucket-presentiment"
 $outputBucket = "reviews-bucket-output"
+# Progress of the lambdas on big files, so they can continue in a new invocation (no trigger)
+$checkpointBucket = "reviews-bucket-checkpoints"
 
 # DynamoDB table names
 $banTable = "ban-table"
 $sentimentTable = "sentiment-table" 
 
+# Format of the files between the lambdas ("jsonl" or the smaller "columnar"), the output is always JSON lines
+$intermediateFormat = "columnar"
+
+# Compression of the files the lambdas write ("none", "gzip" or "zstd"), for the intermediate and the output bucket
+$compression = "zstd"
+$outputCompression = "none"
+
+# Files bigger than this (MB) are split into shards that are processed by parallel
+# invocations of the lambda and merged again. The files between the stages are split where
+# their writer marked a new frame / block, about once per this many MB (see lambdas/common/shards.py)
+$shardSizeMb = 64
+
+# Every invocation logs its phase times and counters as one CloudWatch EMF line ("0" turns it off, see lambdas/common/metrics.py)
+$metrics = "1"
+# How long the lambdas keep the SSM parameters (the bucket names) before they fetch them again, in seconds (see lambdas/common/bootstrap.py)
+$configTtl = "300"
+# Download the input in parallel ranges ahead of the processing and upload the output parts in the background ("0" reads and writes in line, see lambdas/common/streaming.py)
+$pipelinedIo = "1"
+
+# Number of items every sentiment counter is spread over, so parallel invocations don't update the same keys
+$counterShards = 8
+
+# "staged": the three lambdas one after another, with a bucket for the files between them.
+# "fused": one lambda does all three steps and only writes the output bucket.
+# Both are deployed, this only sets which one the input bucket triggers
+# (python -m lambdas.fused.benchmark compares them).
+$pipelineMode = "staged"
+
 # Lambda function names
 $preprocessName = "preprocessing"
 $profanityName = "profanity_check"
 $sentimentName = "sentiment_analysis"
+$fusedName = "fused_pipeline"
 
 # Paths for each Lambda source code
 $preprocessFolder = "lambdas/preprocessing"
 $profanityFolder = "lambdas/profanity_check"
 $sentimentFolder = "lambdas/sentiment_analysis"
+$fusedFolder = "lambdas/fused"
 
 # Paths where the dependancies are installed
 $preprocessPackage = "$preprocessFolder/package"
 $profanityPackage = "$profanityFolder/package"
 $sentimentPackage = "$sentimentFolder/package"
+$fusedPackage = "$fusedFolder/package"
 
 # Where to zip the final packages
 $preprocessZip = "$preprocessFolder/lambda.zip"
 $profanityZip = "$profanityFolder/lambda.zip"
 $sentimentZip = "$sentimentFolder/lambda.zip"
+$fusedZip = "$fusedFolder/lambda.zip"
 
 # === CREATE S3 BUCKETS ===
 awslocal s3 mb "s3://$inputBucket"
 awslocal s3 mb "s3://$cleanedBucket"
 awslocal s3 mb "s3://$presentimentBucket"
 awslocal s3 mb "s3://$outputBucket"
+awslocal s3 mb "s3://$checkpointBucket"
 
 # === CREATE DYNAMODB TABLE FOR BAN STATUS ===
+# Only banned users have ban_status, so the banned-index only holds them (sparse index)
 awslocal dynamodb create-table `
     --table-name $banTable `
     --key-schema AttributeName=reviewerID,KeyType=HASH `
-    --attribute-definitions AttributeName=reviewerID,AttributeType=S `
+    --attribute-definitions AttributeName=reviewerID,AttributeType=S AttributeName=ban_status,AttributeType=S `
+    --global-secondary-indexes "IndexName=banned-index,KeySchema=[{AttributeName=ban_status,KeyType=HASH},{AttributeName=reviewerID,KeyType=RANGE}],Projection={ProjectionType=INCLUDE,NonKeyAttributes=[profane_count,banned]}" `
     --billing-mode PAY_PER_REQUEST 
 
 # === CREATE DYNAMODB TABLE FOR SENTIMENT COUNTING ===
@@ -64,7 +101,7 @@ awslocal ssm put-parameter --name "/dic/sentiment_table" --type String --value "
 # === PACKAGE & DEPLOY: PREPROCESSING ===
 
 # This checks whether the preprocessing lambda dependancies have been installed
-if (-Not (Test-Path "$preprocessPackage\handler.py")) {
+if (-Not (Test-Path "$preprocessPackage\zstandard")) {
     Write-Host "Installing preprocessing dependencies..."
     # Create the "package" directory if it doesn't exist
     if (-Not (Test-Path $preprocessPackage)) {
@@ -78,14 +115,9 @@ if (-Not (Test-Path "$preprocessPackage\handler.py")) {
         --no-deps
 }
 
-# Copy the two files into the package
-Copy-Item "$preprocessFolder\handler.py" $preprocessPackage -Force
-Copy-Item "$preprocessFolder\stopwords.txt" $preprocessPackage -Force
-
-# Create a .zip deployment package
-Push-Location $preprocessPackage
-Compress-Archive -Path * -DestinationPath ../lambda.zip -Force
-Pop-Location
+# Build a minimal deployment package (handler, data files, only the nltk modules
+# that are imported, NLTK data and precompiled bytecode) into lambda.zip
+python -m lambdas.build_bundles $preprocessName
 
 # # Create the preprocessing function
 awslocal lambda create-function `
@@ -95,7 +127,7 @@ awslocal lambda create-function `
     --zip-file "fileb://$preprocessZip" `
     --handler handler.handler `
     --role "arn:aws:iam::000000000000:role/lambda-role" `
-    --environment "Variables={STAGE=local,CLEANED_BUCKET=$cleanedBucket}"
+    --environment "Variables={STAGE=local,METRICS=$metrics,CONFIG_TTL=$configTtl,PIPELINED_IO=$pipelinedIo,CLEANED_BUCKET=$cleanedBucket,INTERMEDIATE_FORMAT=$intermediateFormat,COMPRESSION=$compression,CHECKPOINT_BUCKET=$checkpointBucket,SHARD_SIZE_MB=$shardSizeMb}"
 
 # Allow S3 to invoke
 awslocal lambda add-permission `
@@ -105,33 +137,29 @@ awslocal lambda add-permission `
     --principal s3.amazonaws.com `
     --source-arn "arn:aws:s3:::$inputBucket"
 
-# Add the S3 trigger for the preprocessing
-$preprocessArn = (awslocal lambda get-function --function-name $preprocessName | ConvertFrom-Json).Configuration.FunctionArn
-$preprocessConfig = '{\"LambdaFunctionConfigurations\":[{\"LambdaFunctionArn\":\"' + $preprocessArn + '\",\"Events\":[\"s3:ObjectCreated:*\"]}]}'
+# Add the S3 trigger for the preprocessing (in the fused mode the fused lambda gets it, see below)
+if ($pipelineMode -eq "staged") {
+    $preprocessArn = (awslocal lambda get-function --function-name $preprocessName | ConvertFrom-Json).Configuration.FunctionArn
+    $preprocessConfig = '{\"LambdaFunctionConfigurations\":[{\"LambdaFunctionArn\":\"' + $preprocessArn + '\",\"Events\":[\"s3:ObjectCreated:*\"]}]}'
 
-awslocal s3api put-bucket-notification-configuration `
-    --bucket $inputBucket `
-    --notification-configuration "$preprocessConfig"
+    awslocal s3api put-bucket-notification-configuration `
+        --bucket $inputBucket `
+        --notification-configuration "$preprocessConfig"
+}
 
 # === PACKAGE & DEPLOY: PROFANITY-CHECK ===
 # As above, checks dependancies, but for the profanity check
-if (-Not (Test-Path "$profanityPackage\handler.py")) {
+if (-Not (Test-Path "$profanityPackage\zstandard")) {
     Write-Host "Installing profanity_check dependencies..."
     if (-Not (Test-Path $profanityPackage)) {
         New-Item -ItemType Directory -Path $profanityPackage | Out-Null
     }
-    pip install -r "$profanityFolder/requirements.txt" -t $profanityPackage --upgrade 
+    # orjson has compiled code, so we need the linux wheels like for the other two lambdas
+    pip install -r "$profanityFolder/requirements.txt" -t $profanityPackage --platform manylinux2014_x86_64 --only-binary=:all: --upgrade --no-deps
 }
 
-# Copy the files into the package
-Copy-Item "$profanityFolder\handler.py" $profanityPackage -Force
-Copy-Item "$profanityFolder\bad-words.txt" $profanityPackage -Force
-Copy-Item "$profanityFolder\badwords_profanityfilter.txt" $profanityPackage -Force
-
-# Zip and package
-Push-Location $profanityPackage
-Compress-Archive -Path * -DestinationPath ../lambda.zip -Force
-Pop-Location
+# Build the deployment package into lambda.zip
+python -m lambdas.build_bundles $profanityName
 
 # Create the profanity check lambda function
 awslocal lambda create-function `
@@ -142,7 +170,7 @@ awslocal lambda create-function `
     --zip-file "fileb://$profanityZip" `
     --handler handler.handler `
     --role "arn:aws:iam::000000000000:role/lambda-role" `
-    --environment "Variables={STAGE=local,PRESENTIMENT_BUCKET=$presentimentBucket,BAN_TABLE=$banTable,OUTPUT_BUCKET=$outputBucket}"
+    --environment "Variables={STAGE=local,METRICS=$metrics,CONFIG_TTL=$configTtl,PIPELINED_IO=$pipelinedIo,PRESENTIMENT_BUCKET=$presentimentBucket,BAN_TABLE=$banTable,OUTPUT_BUCKET=$outputBucket,INTERMEDIATE_FORMAT=$intermediateFormat,COMPRESSION=$compression,OUTPUT_COMPRESSION=$outputCompression,CHECKPOINT_BUCKET=$checkpointBucket,SHARD_SIZE_MB=$shardSizeMb}"
 
 # Allow S3 to invoke
 awslocal lambda add-permission `
@@ -163,7 +191,7 @@ awslocal s3api put-bucket-notification-configuration `
 # === PACKAGE & DEPLOY: SENTIMENT ANALYSIS ===
 
 # Same thing as with the previous two functions, but for sentiment analysis
-if (-Not (Test-Path "$sentimentPackage\handler.py")) {
+if (-Not (Test-Path "$sentimentPackage\zstandard")) {
     Write-Host "Installing sentiment_analysis dependencies..."
     if (-Not (Test-Path $sentimentPackage)) {
         New-Item -ItemType Directory -Path $sentimentPackage | Out-Null
@@ -171,10 +199,9 @@ if (-Not (Test-Path "$sentimentPackage\handler.py")) {
     pip install -r "$sentimentFolder/requirements.txt" -t $sentimentPackage --platform manylinux2014_x86_64 --only-binary=:all: --upgrade --no-deps
 
 }
-Copy-Item "$sentimentFolder\handler.py" $sentimentPackage -Force
-Push-Location $sentimentPackage
-Compress-Archive -Path * -DestinationPath ../lambda.zip -Force
-Pop-Location
+
+# Build the deployment package (with the VADER lexicon) into lambda.zip
+python -m lambdas.build_bundles $sentimentName
 
 # Create the Lambda function for sentiment analysis
 awslocal lambda create-function `
@@ -185,7 +212,7 @@ awslocal lambda create-function `
     --zip-file "fileb://$sentimentZip" `
     --handler handler.handler `
     --role "arn:aws:iam::000000000000:role/lambda-role" `
-    --environment "Variables={STAGE=local,OUTPUT_BUCKET=$outputBucket,SENTIMENT_TABLE=$sentimentTable,BAN_TABLE=$banTable}"
+    --environment "Variables={STAGE=local,METRICS=$metrics,CONFIG_TTL=$configTtl,PIPELINED_IO=$pipelinedIo,OUTPUT_BUCKET=$outputBucket,SENTIMENT_TABLE=$sentimentTable,COUNTER_SHARDS=$counterShards,BAN_TABLE=$banTable,OUTPUT_COMPRESSION=$outputCompression,CHECKPOINT_BUCKET=$checkpointBucket,SHARD_SIZE_MB=$shardSizeMb}"
 
 # Allow S3 to onvoke
 awslocal lambda add-permission `
@@ -203,6 +230,49 @@ awslocal s3api put-bucket-notification-configuration `
     --bucket $presentimentBucket `
     --notification-configuration "$sentimentConfig"
 
+# === PACKAGE & DEPLOY: FUSED PIPELINE ===
+
+# All three steps in one lambda, so it needs the dependencies of all of them
+if (-Not (Test-Path "$fusedPackage\zstandard")) {
+    Write-Host "Installing fused pipeline dependencies..."
+    if (-Not (Test-Path $fusedPackage)) {
+        New-Item -ItemType Directory -Path $fusedPackage | Out-Null
+    }
+    pip install -r "$fusedFolder/requirements.txt" -t $fusedPackage --platform manylinux2014_x86_64 --only-binary=:all: --upgrade --no-deps
+}
+
+# Build the deployment package (the three stage handlers, their data files and NLTK data) into lambda.zip
+python -m lambdas.build_bundles fused
+
+# Create the fused lambda function, with the environment of all three
+awslocal lambda create-function `
+    --function-name $fusedName `
+    --runtime python3.11 `
+    --timeout 300 `
+    --memory-size 1024 `
+    --zip-file "fileb://$fusedZip" `
+    --handler handler.handler `
+    --role "arn:aws:iam::000000000000:role/lambda-role" `
+    --environment "Variables={STAGE=local,METRICS=$metrics,CONFIG_TTL=$configTtl,PIPELINED_IO=$pipelinedIo,BAN_TABLE=$banTable,SENTIMENT_TABLE=$sentimentTable,COUNTER_SHARDS=$counterShards,OUTPUT_BUCKET=$outputBucket,OUTPUT_COMPRESSION=$outputCompression,CHECKPOINT_BUCKET=$checkpointBucket,SHARD_SIZE_MB=$shardSizeMb}"
+
+# Allow S3 to invoke
+awslocal lambda add-permission `
+    --function-name $fusedName `
+    --action lambda:InvokeFunction `
+    --statement-id s3invoke4 `
+    --principal s3.amazonaws.com `
+    --source-arn "arn:aws:s3:::$inputBucket"
+
+# In the fused mode the uploads go to the fused lambda instead of the preprocessing
+if ($pipelineMode -eq "fused") {
+    $fusedArn = (awslocal lambda get-function --function-name $fusedName | ConvertFrom-Json).Configuration.FunctionArn
+    $fusedConfig = '{\"LambdaFunctionConfigurations\":[{\"LambdaFunctionArn\":\"' + $fusedArn + '\",\"Events\":[\"s3:ObjectCreated:*\"]}]}'
+
+    awslocal s3api put-bucket-notification-configuration `
+        --bucket $inputBucket `
+        --notification-configuration "$fusedConfig"
+}
+
 # === Create Output Folder ===
 if (-Not (Test-Path out)) {
         New-Item -ItemType Directory -Path out | Out-Null
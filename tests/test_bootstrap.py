@@ -0,0 +1,70 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from botocore.config import Config
+
+from lambdas.common import aws, bootstrap, metrics
+from lambdas.common.memory_aws import MemoryAWS
+
+
+class TestBootstrap(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = aws.backend()
+        self.backend = aws.set_backend(MemoryAWS())
+        ssm = self.backend.client("ssm")
+        for name, value in (("output_bucket", "out"), ("presentiment_bucket", "pre"), ("other/nested", "x")):
+            ssm.put_parameter(Name=f"/dic/{name}", Value=value, Type="String")
+        ssm.put_parameter(Name="/elsewhere", Value="no", Type="String")
+        self.config = mock.patch.dict(bootstrap._config, {"values": None, "fetched": 0.0, "backend": None})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        aws.set_backend(self.previous)
+
+    def test_config_one_call_and_ttl(self):
+        """Tests that all parameters come with one call, are cached, and are fetched again after the TTL."""
+        self.assertEqual(bootstrap.parameter("output_bucket"), "out")
+        self.assertEqual(bootstrap.parameter("other/nested"), "x")
+        self.assertEqual(bootstrap.parameter("presentiment_bucket"), "pre")
+        self.assertNotIn("elsewhere", bootstrap.config())
+        self.assertEqual(self.backend.stats["calls"]["ssm.get_parameters_by_path"], 1)
+        with self.assertRaises(KeyError):
+            bootstrap.parameter("missing")
+
+        self.backend.client("ssm").put_parameter(Name="/dic/output_bucket", Value="new", Overwrite=True)
+        self.assertEqual(bootstrap.parameter("output_bucket"), "out")
+        with mock.patch.object(bootstrap, "CONFIG_TTL", 0.0):
+            self.assertEqual(bootstrap.parameter("output_bucket"), "new")
+            # A failed refresh keeps the old values
+            with mock.patch.object(bootstrap, "fetch_config", side_effect=RuntimeError("down")), \
+                    redirect_stdout(io.StringIO()):
+                self.assertEqual(bootstrap.parameter("output_bucket"), "new")
+
+    def test_shared_clients(self):
+        """Tests that the clients are made once per service and backend, and the pool settings are merged."""
+        self.assertIs(aws.client("ssm"), aws.client("ssm"))
+        self.assertIs(aws.resource("dynamodb"), aws.resource("dynamodb"))
+        config = aws.client_config(Config(max_pool_connections=5))
+        self.assertEqual((config.max_pool_connections, config.tcp_keepalive), (5, True))
+        self.assertEqual(aws.client_config().max_pool_connections, aws.MAX_POOL_CONNECTIONS)
+
+    def test_cold_start_logged_once(self):
+        """Tests that only the first invocation after the init gets the cold start numbers."""
+        bootstrap.init_done()
+        with redirect_stdout(io.StringIO()):
+            metrics.begin("fn")
+            first = metrics.end()
+            metrics.begin("fn")
+            second = metrics.end()
+        self.assertEqual(first["cold_start"], 1)
+        self.assertGreater(first["init_ms"], 0)
+        self.assertIn("config_ms", first)
+        self.assertNotIn("cold_start", second)
+
+
+if __name__ == "__main__":
+    unittest.main()
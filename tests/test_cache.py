@@ -0,0 +1,45 @@
+import unittest
+
+from lambdas.common.cache import MISSING, ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        """Tests that a repeated text is computed once and counted as a hit."""
+        cache = ResultCache(10)
+        calls = []
+        compute = lambda text: calls.append(text) or text.upper()
+        self.assertEqual(cache.get_or_compute("great product", compute), "GREAT PRODUCT")
+        self.assertEqual(cache.get_or_compute("great product", compute), "GREAT PRODUCT")
+        self.assertEqual(calls, ["great product"])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_bounded(self):
+        """Tests that the least recently used text is dropped when the cache is full."""
+        cache = ResultCache(2)
+        for text in ["a", "b"]:
+            cache.put(cache.key(text), text)
+        cache.get(cache.key("a"))
+        cache.put(cache.key("c"), "c")
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(cache.key("b")), MISSING)
+        self.assertEqual(cache.get(cache.key("a")), "a")
+
+    def test_none_is_a_result(self):
+        """Tests that None can be cached (MISSING means not cached)."""
+        cache = ResultCache(2)
+        cache.put(cache.key("x"), None)
+        self.assertIsNone(cache.get(cache.key("x")))
+
+
+    def test_lone_surrogate(self):
+        """Tests that a text with a lone surrogate (valid in JSON, not in UTF-8) has a key."""
+        cache = ResultCache(2)
+        cache.put(cache.key("bad \ud800"), 1)
+        self.assertEqual(cache.get(cache.key("bad \ud800")), 1)
+        self.assertIs(cache.get(cache.key("bad \udc00")), MISSING)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import io
+import json
+import unittest
+
+from lambdas.common import compression, columnar, formats
+from lambdas.common.checkpoint import OUTPUT_DONE, Checkpointer
+from lambdas.common.streaming import MIN_PART_SIZE, iter_lines
+from test_streaming import RecordingS3
+
+
+class FakeContext:
+    """Lambda context whose remaining time goes down by step_ms on every call"""
+
+    def __init__(self, remaining_ms, step_ms):
+        self.remaining_ms = remaining_ms
+        self.step_ms = step_ms
+        self.invoked_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:test"
+
+    def get_remaining_time_in_millis(self):
+        self.remaining_ms -= self.step_ms
+        return self.remaining_ms
+
+
+def record(key):
+    return {"s3": {"bucket": {"name": "input"}, "object": {"key": key, "eTag": "abc"}}}
+
+
+def run(s3, key, context, encoding, fmt="jsonl"):
+    """
+    Copies the reviews of input/key to output/key like the handlers do and counts them.
+    Returns True if it had to stop (the checkpoint is then saved).
+    """
+    cp = Checkpointer(s3, "test", record(key), context, bucket="checkpoints", interval=3600, margin_ms=1000)
+    cp.load()
+    count = cp.data.get("count", 0)
+    kind, records = cp.open_input(decode=False)
+    with cp.open_writer("output", key, encoding, **formats.put_kwargs(fmt)) as writer:
+        output = cp.open_output(writer, fmt)
+        for reviews in formats.iter_review_groups(kind, records):
+            for review in reviews:
+                output.write_row(review)
+                count += 1
+            if cp.due() and cp.save_progress(writer, output, count=count):
+                return True
+        output.flush()
+    cp.output_done(count=count)
+    return False
+
+
+class TestWriterCheckpoint(unittest.TestCase):
+
+    def test_resume_gives_the_same_object(self):
+        """Tests that a writer that is continued from a checkpoint writes the same object."""
+        lines = [f"line {i} " + "x" * (i % 200) for i in range(60000)]
+        for encoding in compression.ENCODINGS:
+            s3 = RecordingS3()
+            writer = compression.open_writer(s3, "bucket", "key", encoding, part_size=MIN_PART_SIZE)
+            for line in lines[:40000]:
+                writer.write_line(line)
+            state, pending = writer.checkpoint()
+            writer.detach()
+            # Nothing happens to the upload of a detached writer
+            writer.close()
+            self.assertNotIn(("bucket", "key"), s3.objects)
+
+            state = json.loads(json.dumps(state))
+            with compression.open_writer(s3, "bucket", "key", encoding, resume=state, pending=pending,
+                                         part_size=MIN_PART_SIZE) as resumed:
+                for line in lines[40000:]:
+                    resumed.write_line(line)
+            obj = s3.get_object(Bucket="bucket", Key="key")
+            self.assertEqual(list(iter_lines(compression.open_body(obj))), lines, msg=encoding)
+            self.assertEqual(resumed.lines_written, len(lines))
+
+    def test_line_offset(self):
+        """Tests that reading from the offset gives the lines that were not returned yet."""
+        data = b"first\nsecond\n\nthird\nlast"
+        lines = iter_lines(io.BytesIO(data), chunk_size=3)
+        it = iter(lines)
+        self.assertEqual([next(it), next(it)], ["first", "second"])
+        rest = list(iter_lines(io.BytesIO(data[lines.offset:]), start=lines.offset))
+        self.assertEqual(rest, ["", "third", "last"])
+
+
+class TestCheckpointer(unittest.TestCase):
+
+    def reviews(self, n=3000):
+        return [{"reviewerID": f"R{i % 50}", "reviewText": ["word"] * (i % 7), "overall": 4.0} for i in range(n)]
+
+    def check_continuation(self, data, encoding, step_ms=10):
+        s3 = RecordingS3()
+        s3.put_object(Bucket="input", Key="key", Body=data)
+        # Every line / block takes step_ms of the 2 s, so it has to stop a few times
+        invocations = 1
+        while run(s3, "key", FakeContext(2000, step_ms), encoding):
+            invocations += 1
+        self.assertGreater(invocations, 1)
+
+        cp = Checkpointer(s3, "test", record("key"), None, bucket="checkpoints")
+        cp.load()
+        self.assertEqual(cp.phase, OUTPUT_DONE)
+        self.assertEqual(cp.data["count"], 3000)
+        cp.delete()
+        self.assertEqual(set(s3.objects), {("input", "key"), ("output", "key")})
+
+        obj = s3.get_object(Bucket="output", Key="key")
+        return list(formats.iter_reviews(compression.open_body(obj)))
+
+    def test_json_lines(self):
+        """Tests that a file that is continued in new invocations gives every review once."""
+        reviews = self.reviews()
+        data = "\n".join(json.dumps(review) for review in reviews).encode("utf-8")
+        for encoding in compression.ENCODINGS:
+            # Plain input is continued with range requests, compressed input is skipped up to the offset
+            self.assertEqual(self.check_continuation(compression.compress(data, encoding), encoding), reviews)
+
+    def test_columnar(self):
+        """Tests the same for a columnar file, which is continued at a block boundary."""
+        reviews = self.reviews()
+        data = b"".join(columnar.encode_block(reviews[i:i + 100]) for i in range(0, len(reviews), 100))
+        self.assertEqual(self.check_continuation(data, "none", step_ms=200), reviews)
+
+    def test_disabled_without_bucket(self):
+        """Tests that nothing is saved without a checkpoint bucket."""
+        s3 = RecordingS3()
+        cp = Checkpointer(s3, "test", record("key"), FakeContext(0, 0), bucket="")
+        self.assertIsNone(cp.load())
+        self.assertFalse(cp.due())
+        cp.output_done(count=1)
+        self.assertEqual(s3.objects, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import json
+import unittest
+
+from lambdas.common import codec
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_same_output_as_json(self):
+        """Tests that every backend writes exactly what json.dumps(json.loads(line)) writes."""
+        with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        for name, backend in codec.BACKENDS.items():
+            for line in lines:
+                self.assertEqual(backend.dumps(backend.loads(line)), json.dumps(json.loads(line)), msg=name)
+
+    def test_lines_only_stdlib_accepts(self):
+        """Tests that lines json.loads accepts (NaN, big numbers) are read the same way."""
+        line = '{"overall": NaN, "unixReviewTime": 123456789012345678901234567890}'
+        for name, backend in codec.BACKENDS.items():
+            self.assertEqual(backend.dumps(backend.loads(line)), json.dumps(json.loads(line)), msg=name)
+
+    def test_broken_line(self):
+        """Tests that broken lines raise json.JSONDecodeError, which the handlers skip."""
+        for backend in codec.BACKENDS.values():
+            with self.assertRaises(json.JSONDecodeError):
+                backend.loads('{"reviewerID": ')
+
+    def test_unknown_backend(self):
+        """Tests that asking for a backend that is not installed fails."""
+        with self.assertRaises(ValueError):
+            codec.get_codec("does-not-exist")
+
+
+if __name__ == "__main__":
+    unittest.main()
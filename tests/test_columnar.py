@@ -0,0 +1,122 @@
+import io
+import os
+import json
+import unittest
+
+from lambdas.common import columnar, formats
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+class BytesWriter:
+    """Collects what ColumnarWriter / JsonLinesWriter write, like MultipartWriter"""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+        self.lines = []
+
+    def write(self, data):
+        self.data.write(data)
+
+    def write_record(self, data):
+        self.data.write(data)
+
+    def write_line(self, line):
+        self.lines.append(line)
+
+
+def cleaned_reviews():
+    """The sample reviews with tokens instead of texts, like the preprocessing stage writes them"""
+    with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+        reviews = [json.loads(line) for line in f if line.strip()]
+    for review in reviews:
+        for field in columnar.TOKEN_FIELDS:
+            if field in review:
+                review[field] = review[field].lower().split()
+    return reviews
+
+
+def write_columnar(reviews, block_rows=100):
+    out = BytesWriter()
+    writer = columnar.ColumnarWriter(out, block_rows=block_rows)
+    for review in reviews:
+        writer.write_row(review)
+    writer.flush()
+    return out.data.getvalue(), writer.rows_written
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Tests that reading a columnar file gives exactly the same JSON lines."""
+        reviews = cleaned_reviews()
+        data, rows_written = write_columnar(reviews)
+        self.assertEqual(rows_written, len(reviews))
+        read = list(formats.iter_reviews(io.BytesIO(data)))
+        self.assertEqual([json.dumps(r) for r in read], [json.dumps(r) for r in reviews])
+
+    def test_mixed_layouts_and_types(self):
+        """Tests rows with missing keys, other key orders and values that need the json type."""
+        reviews = [
+            {"reviewerID": "A", "overall": 5.0, "summary": ["good"], "helpful": [1, 2]},
+            {"summary": [], "reviewerID": "B", "vote": "3"},
+            {"reviewerID": "C", "overall": 1, "reviewText": "not tokenized", "big": 2**70, "flag": True},
+        ]
+        data, _ = write_columnar(reviews, block_rows=2)
+        read = list(formats.iter_reviews(io.BytesIO(data)))
+        self.assertEqual([json.dumps(r) for r in read], [json.dumps(r) for r in reviews])
+
+    def test_lone_surrogate(self):
+        """Tests that a lone surrogate (valid JSON escape, not valid UTF-8) in str and tokens columns survives."""
+        reviews = [json.loads(line) for line in (
+            '{"reviewerID": "A", "reviewerName": "\\ud800", "summary": ["ok", "\\udc00x"]}',
+            '{"reviewerID": "B", "reviewerName": "plain", "summary": ["fine"]}',
+        )]
+        data, _ = write_columnar(reviews)
+        read = list(formats.iter_reviews(io.BytesIO(data)))
+        self.assertEqual(read, reviews)
+        self.assertEqual(read[0]["reviewerName"], "\ud800")
+
+    def test_token_ids(self):
+        """Tests that the token ids point into the vocabulary of the block."""
+        block = next(columnar.iter_blocks(io.BytesIO(columnar.encode_block([
+            {"summary": ["a", "b"]}, {"summary": ["b", "c", "a"]},
+        ]))))
+        offsets, ids = block.token_ids("summary")
+        vocabulary = block.vocabulary()
+        self.assertEqual([vocabulary[i] for i in ids[offsets[1]:offsets[2]]], ["b", "c", "a"])
+
+    def test_with_column(self):
+        """Tests adding a column to an encoded block (what the profanity stage does)."""
+        reviews = cleaned_reviews()[:50]
+        block = next(columnar.iter_blocks(io.BytesIO(columnar.encode_block(reviews))))
+        flags = [i % 3 == 0 for i in range(len(reviews))]
+        new_block = next(columnar.iter_blocks(io.BytesIO(block.with_column("has_profanity", flags))))
+        for review, flag in zip(reviews, flags):
+            review["has_profanity"] = flag
+        self.assertEqual([json.dumps(r) for r in new_block.rows()], [json.dumps(r) for r in reviews])
+
+    def test_detects_jsonl(self):
+        """Tests that JSON lines are still read (skipping blank and broken lines)."""
+        body = io.BytesIO(b'{"reviewerID": "A"}\n\n{"broken": \n{"reviewerID": "B"}\n')
+        kind, _ = formats.open_input(io.BytesIO(body.getvalue()))
+        self.assertEqual(kind, "jsonl")
+        self.assertEqual([r["reviewerID"] for r in formats.iter_reviews(body)], ["A", "B"])
+
+    def test_smaller_than_jsonl(self):
+        """Tests that the columnar file is smaller than the same reviews as JSON lines."""
+        reviews = cleaned_reviews()
+        data, _ = write_columnar(reviews, block_rows=columnar.BLOCK_ROWS)
+        jsonl = "\n".join(json.dumps(r) for r in reviews).encode("utf-8")
+        print(f"\ncolumnar: {len(data)} bytes, JSON lines: {len(jsonl)} bytes")
+        self.assertLess(len(data), len(jsonl))
+
+    def test_truncated_block(self):
+        """Tests that a cut off file fails instead of silently losing reviews."""
+        data = columnar.encode_block(cleaned_reviews()[:10])
+        with self.assertRaises(ValueError):
+            list(columnar.iter_blocks(io.BytesIO(data[:-5])))
+
+
+if __name__ == "__main__":
+    unittest.main()
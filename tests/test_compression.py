@@ -0,0 +1,72 @@
+import io
+import os
+import unittest
+
+from lambdas.common import compression
+from lambdas.common.streaming import MIN_PART_SIZE, iter_lines
+from test_streaming import RecordingS3
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+def sample_lines():
+    with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+class TestCompression(unittest.TestCase):
+
+    def write(self, lines, encoding):
+        s3 = RecordingS3()
+        with compression.open_writer(s3, "bucket", "key", encoding) as writer:
+            for line in lines:
+                writer.write_line(line)
+        return s3, writer
+
+    def test_round_trip(self):
+        """Tests that every encoding gives back exactly the lines that were written."""
+        lines = sample_lines()
+        for encoding in compression.ENCODINGS:
+            s3, _ = self.write(lines, encoding)
+            obj = {"Body": io.BytesIO(s3.objects[("bucket", "key")])}
+            obj.update(compression.put_kwargs(encoding))
+            self.assertEqual(list(iter_lines(compression.open_body(obj))), lines, msg=encoding)
+
+    def test_detects_without_header(self):
+        """Tests that compressed objects without Content-Encoding are recognized by their first bytes."""
+        lines = sample_lines()
+        for encoding in compression.ENCODINGS:
+            s3, _ = self.write(lines, encoding)
+            obj = {"Body": io.BytesIO(s3.objects[("bucket", "key")])}
+            self.assertEqual(list(iter_lines(compression.open_body(obj))), lines, msg=encoding)
+
+    def test_compressed_parts(self):
+        """Tests a compressed multipart upload (the parts are one stream that is cut anywhere)."""
+        lines = [f'{{"reviewerID": "{i}", "n": {i * 7919 % 104729}}}' for i in range(400000)]
+        for encoding in compression.ENCODINGS[1:]:
+            s3 = RecordingS3()
+            with compression.open_writer(s3, "bucket", "key", encoding) as writer:
+                writer.part_size = MIN_PART_SIZE // 16  # Smaller parts, so the test stays fast
+                for line in lines:
+                    writer.write_line(line)
+            self.assertIn("upload_part", s3.calls, msg=encoding)
+            obj = {"Body": io.BytesIO(s3.objects[("bucket", "key")]), "ContentEncoding": encoding}
+            self.assertEqual(list(iter_lines(compression.open_body(obj))), lines, msg=encoding)
+            self.assertEqual(writer.bytes_written, len(s3.objects[("bucket", "key")]))
+
+    def test_smaller(self):
+        """Tests that compression makes the sample smaller."""
+        lines = sample_lines()
+        raw = len("\n".join(lines).encode("utf-8"))
+        for encoding in compression.ENCODINGS[1:]:
+            _, writer = self.write(lines, encoding)
+            self.assertLess(writer.bytes_written, raw / 2, msg=encoding)
+
+    def test_unknown_encoding(self):
+        """Tests that a wrong COMPRESSION setting fails early."""
+        with self.assertRaises(ValueError):
+            compression.compressor("brotli")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import threading
+import unittest
+
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from lambdas.common.counters import ShardedCounter
+from lambdas.common.dynamo import DynamoWriter
+from lambdas.common.memory_aws import MemoryAWS
+
+_deserializer = TypeDeserializer()
+
+
+class FakeCounterTable:
+    """
+    Low-level client for the updates (ADD of several attributes) and resource for
+    batch_get_item, which leaves the first key unprocessed once
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.requests = []
+        self.unprocessed_once = True
+        self.lock = threading.Lock()
+
+    def describe_table(self, TableName):
+        return {"Table": {}}
+
+    def update_item(self, **request):
+        with self.lock:
+            self.requests.append(request)
+            key = request["Key"]["sentiment"]["S"]
+            item = self.items.setdefault(key, {"sentiment": key})
+            for part in request["UpdateExpression"][len("ADD "):].split(", "):
+                name, value = part.split(" ")
+                name = request["ExpressionAttributeNames"][name]
+                item[name] = item.get(name, 0) + _deserializer.deserialize(request["ExpressionAttributeValues"][value])
+            return {}
+
+    def batch_get_item(self, RequestItems):
+        (table_name, request), = RequestItems.items()
+        keys = request["Keys"]
+        unprocessed = {}
+        if self.unprocessed_once:
+            self.unprocessed_once = False
+            unprocessed = {table_name: dict(request, Keys=keys[:1])}
+            keys = keys[1:]
+        items = [self.items[key["sentiment"]] for key in keys if key["sentiment"] in self.items]
+        return {"Responses": {table_name: items}, "UnprocessedKeys": unprocessed}
+
+
+class TestShardedCounter(unittest.TestCase):
+
+    def counter(self, table, **kwargs):
+        writer = DynamoWriter(table, "sentiment_table", max_workers=4, rate=None)
+        return ShardedCounter(table, writer, "sentiment", **kwargs)
+
+    def test_one_update_per_add(self):
+        """Tests that all counts of a file go to one shard in one update."""
+        table = FakeCounterTable()
+        counter = self.counter(table, shards=4)
+        counter.add({"positive": 2, "neutral": 0, "negative": 1}).result()
+        self.assertEqual(len(table.requests), 1)
+        (item,) = table.items.values()
+        self.assertRegex(item["sentiment"], r"^counts#[0-3]$")
+        self.assertEqual((item["positive"], item["neutral"], item["negative"]), (2, 0, 1))
+
+    def test_totals_sum_all_shards(self):
+        """Tests that the totals are the sum over the shards, also with unprocessed keys."""
+        table = FakeCounterTable()
+        counter = self.counter(table, shards=8)
+        futures = [counter.add({"positive": 1, "negative": 2}) for _ in range(100)]
+        for future in futures:
+            future.result()
+        self.assertGreater(len(table.items), 1)
+        self.assertEqual(counter.totals(), {"positive": 100, "negative": 200})
+
+    def test_hash_sharding(self):
+        """Tests that the same hint always gives the same shard with hash sharding."""
+        counter = self.counter(FakeCounterTable(), shards=16, sharding="hash")
+        self.assertEqual(counter.choose_shard("reviews/a.json"), counter.choose_shard("reviews/a.json"))
+        self.assertTrue(all(0 <= counter.choose_shard(f"file{i}") < 16 for i in range(100)))
+        with self.assertRaises(ValueError):
+            self.counter(FakeCounterTable(), sharding="round-robin")
+
+    def test_once_per_file(self):
+        """Tests that a file is counted once, also when it is retried or its request is sent again after a timeout."""
+        backend = MemoryAWS()
+        client = backend.client("dynamodb")
+        client.create_table(TableName="sentiment_table", BillingMode="PAY_PER_REQUEST",
+                            KeySchema=[{"AttributeName": "sentiment", "KeyType": "HASH"}],
+                            AttributeDefinitions=[{"AttributeName": "sentiment", "AttributeType": "S"}])
+        transact = client.transact_write_items
+        lost = []
+
+        def transact_lost_response(**request):
+            # The first transaction is applied, but the response is lost and the writer sends it again
+            response = transact(**request)
+            if not lost:
+                lost.append(request)
+                raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+            return response
+
+        client.transact_write_items = transact_lost_response
+        writer = DynamoWriter(client, "sentiment_table", max_workers=2, rate=None, base_delay=0)
+        counter = ShardedCounter(backend.resource("dynamodb"), writer, "sentiment", shards=4)
+        self.assertFalse(counter.added(counter.add({"positive": 2, "negative": 1}, file_id="in/a.json/e1")))
+        self.assertEqual(writer.retries, 1)
+        self.assertFalse(counter.added(counter.add({"positive": 2, "negative": 1}, file_id="in/a.json/e1")))
+        self.assertTrue(counter.added(counter.add({"positive": 1}, file_id="in/a.json/e2")))
+        self.assertEqual(counter.totals(), {"positive": 3, "negative": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
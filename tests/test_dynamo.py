@@ -0,0 +1,156 @@
+import threading
+import time
+import unittest
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from lambdas.common.dynamo import DynamoWriter, TokenBucket, condition_failed, error_code
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "UpdateItem")
+
+
+def cancelled(*reasons):
+    return ClientError({
+        "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+        "CancellationReasons": [{"Code": reason} for reason in reasons],
+    }, "TransactWriteItems")
+
+
+class FakeDynamoClient:
+    """Low-level client that fails with the given error codes first, then adds :n to the item"""
+
+    def __init__(self, errors=(), delay=0.0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.requests = []
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def describe_table(self, TableName):
+        return {"Table": {"ProvisionedThroughput": {"WriteCapacityUnits": 0}}}
+
+    def update_item(self, **request):
+        time.sleep(self.delay)
+        with self.lock:
+            self.requests.append(request)
+            if self.errors:
+                raise client_error(self.errors.pop(0))
+            key = request["Key"]["id"]["S"]
+            old = self.items.get(key, 0)
+            self.items[key] = old + int(request["ExpressionAttributeValues"][":n"]["N"])
+            return {"Attributes": {"n": {"N": str(old)}}}
+
+    def transact_write_items(self, TransactItems):
+        with self.lock:
+            self.requests.append(TransactItems)
+            if self.errors:
+                raise self.errors.pop(0)
+            for item in TransactItems:
+                update = item["Update"]
+                key = update["Key"]["id"]["S"]
+                self.items[key] = self.items.get(key, 0) + int(update["ExpressionAttributeValues"][":n"]["N"])
+            return {}
+
+
+class TestDynamoWriter(unittest.TestCase):
+
+    def update(self, writer, key, n=1):
+        return writer.update_item(
+            Key={"id": key},
+            UpdateExpression="ADD n :n",
+            ExpressionAttributeValues={":n": n},
+            ReturnValues="UPDATED_OLD",
+        )
+
+    def test_updates_and_acks(self):
+        """Tests that every update is sent once and acked with python values."""
+        client = FakeDynamoClient()
+        writer = DynamoWriter(client, "table", max_workers=4, rate=None)
+        futures = [self.update(writer, f"user{i % 10}") for i in range(100)]
+        writer.wait()
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual(sum(client.items.values()), 100)
+        self.assertIsInstance(futures[0].result()["Attributes"]["n"], Decimal)
+        metrics = writer.metrics()
+        self.assertEqual(metrics["acked"], 100)
+        self.assertLessEqual(metrics["max_in_flight"], 4)
+        self.assertIsNotNone(metrics["p99_ms"])
+
+    def test_retries_throttling(self):
+        """Tests that throttled updates are retried with backoff."""
+        client = FakeDynamoClient(errors=["ProvisionedThroughputExceededException", "ThrottlingException"])
+        writer = DynamoWriter(client, "table", max_workers=1, rate=None, base_delay=0.001)
+        self.assertEqual(self.update(writer, "a", 2).result()["Attributes"]["n"], 0)
+        self.assertEqual(client.items["a"], 2)
+        self.assertEqual(writer.metrics()["retries"], 2)
+        self.assertEqual(writer.metrics()["throttles"], 2)
+
+    def test_no_retry_for_conditional_check(self):
+        """Tests that a failed condition is not retried but raised to the caller."""
+        client = FakeDynamoClient(errors=["ConditionalCheckFailedException"])
+        writer = DynamoWriter(client, "table", max_workers=1, rate=None)
+        with self.assertRaises(ClientError) as raised:
+            self.update(writer, "a").result()
+        self.assertEqual(error_code(raised.exception), "ConditionalCheckFailedException")
+        self.assertEqual(len(client.requests), 1)
+        writer.wait()
+        self.assertEqual(writer.metrics()["conditions_failed"], 1)
+        self.assertEqual(writer.metrics()["failed"], 0)
+
+    def test_gives_up(self):
+        """Tests that an update fails after max_retries retries."""
+        client = FakeDynamoClient(errors=["InternalServerError"] * 10)
+        writer = DynamoWriter(client, "table", max_workers=1, rate=None, max_retries=3, base_delay=0.001)
+        with self.assertRaises(ClientError):
+            self.update(writer, "a").result()
+        self.assertEqual(len(client.requests), 4)
+
+    def test_transaction(self):
+        """Tests that a transaction applies all updates and is retried after a conflict."""
+        client = FakeDynamoClient(errors=[cancelled("None", "TransactionConflict")])
+        writer = DynamoWriter(client, "table", max_workers=1, rate=None, base_delay=0.001)
+        update = {"Key": {"id": "a"}, "UpdateExpression": "ADD n :n", "ExpressionAttributeValues": {":n": 2}}
+        writer.transact_update(update, dict(update, Key={"id": "totals"})).result()
+        self.assertEqual(client.items, {"a": 2, "totals": 2})
+        self.assertEqual(writer.metrics()["retries"], 1)
+        self.assertEqual(client.requests[0][0]["Update"]["TableName"], "table")
+
+    def test_transaction_condition(self):
+        """Tests that a transaction cancelled by a condition is not retried."""
+        client = FakeDynamoClient(errors=[cancelled("ConditionalCheckFailed", "None")])
+        writer = DynamoWriter(client, "table", max_workers=1, rate=None)
+        update = {"Key": {"id": "a"}, "UpdateExpression": "ADD n :n", "ExpressionAttributeValues": {":n": 1}}
+        with self.assertRaises(ClientError) as raised:
+            writer.transact_update(update).result()
+        self.assertTrue(condition_failed(raised.exception))
+        writer.wait()
+        self.assertEqual(writer.metrics()["conditions_failed"], 1)
+        self.assertEqual(len(client.requests), 1)
+
+    def test_rate_limit(self):
+        """Tests that the token bucket keeps the request rate."""
+        client = FakeDynamoClient()
+        writer = DynamoWriter(client, "table", max_workers=8, rate=50)
+        start = time.perf_counter()
+        for i in range(75):
+            self.update(writer, "a")
+        writer.wait()
+        # 50 requests right away (one second of burst), the other 25 need half a second
+        self.assertGreaterEqual(time.perf_counter() - start, 0.45)
+
+    def test_token_bucket_adapts(self):
+        """Tests that the rate goes down on throttling and back up on success."""
+        bucket = TokenBucket(100)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 25)
+        for _ in range(100):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import json
+import unittest
+
+import nltk
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+from lambdas.sentiment_analysis.engine import VaderBatchEngine, full_text
+
+nltk.data.path.append("/tmp")
+try:
+    nltk.data.find("sentiment/vader_lexicon.zip")
+except LookupError:
+    nltk.download("vader_lexicon", download_dir="/tmp")
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+class TestVaderBatchEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.analyzer = SentimentIntensityAnalyzer()
+
+    def vader(self, review):
+        return self.analyzer.polarity_scores(full_text(review))["compound"]
+
+    def test_same_scores_as_vader(self):
+        """Tests that the batch scores are exactly VADER's on the (tokenized) sample."""
+        from lambdas.preprocessing.handler import tokenize
+
+        with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+            reviews = [json.loads(line) for line in f if line.strip()]
+        for review in reviews:
+            for field in ("reviewText", "summary"):
+                review[field] = tokenize(review.get(field, ""))
+        engine = VaderBatchEngine(self.analyzer)
+        self.assertEqual(engine.compound_scores(reviews), [self.vader(review) for review in reviews])
+        self.assertGreater(engine.fast_count, engine.exact_count)
+
+    def test_exact_path(self):
+        """Tests that negations, boosters and idioms go through VADER."""
+        engine = VaderBatchEngine(self.analyzer)
+        reviews = [
+            {"summary": ["great"], "reviewText": ["dont", "like"]},
+            {"summary": ["good"], "reviewText": ["extremely", "happy"]},
+            {"summary": [], "reviewText": ["cut", "the", "mustard"]},
+            {"summary": ["nice"], "reviewText": ["good", "but", "bad"]},
+        ]
+        self.assertEqual(engine.compound_scores(reviews), [self.vader(review) for review in reviews])
+        self.assertEqual(engine.exact_count, 4)
+
+    def test_phrase_words_alone(self):
+        """Tests that a word of an idiom on its own stays on the fast path."""
+        engine = VaderBatchEngine(self.analyzer)
+        reviews = [{"summary": ["bad"], "reviewText": ["cut", "finger", "hand"], "overall": 1.0}]
+        self.assertEqual(engine.compound_scores(reviews), [self.vader(reviews[0])])
+        self.assertEqual(engine.fast_count, 1)
+        self.assertEqual(engine.classify(reviews), ["negative"])
+        self.assertEqual(engine.classify([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import json
+import unittest
+import botocore
+import botocore.exceptions
+
+import nltk
+
+# Ensure NLTK resources are available
+nltk.data.path.append("/tmp")
+try:
+    nltk.data.find("corpora/wordnet")
+    nltk.data.find("omw-1.4")
+except LookupError:
+    nltk.download("wordnet", download_dir="/tmp")
+    nltk.download("omw-1.4", download_dir="/tmp")
+try:
+    nltk.data.find("sentiment/vader_lexicon.zip")
+except LookupError:
+    nltk.download("vader_lexicon", download_dir="/tmp")
+
+# Environment for Localstack
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+os.environ["AWS_ACCESS_KEY_ID"] = "test"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+os.environ["BAN_TABLE"] = "ban_table"
+os.environ["SENTIMENT_TABLE"] = "sentiment_table"
+os.environ["AWS_ENDPOINT_URL"] = "http://localhost.localstack.cloud:4566"
+# In-memory AWS unless AWS_BACKEND says otherwise (e.g. AWS_BACKEND=localstack), see lambdas/common/aws.py
+os.environ.setdefault("AWS_BACKEND", "memory")
+
+from lambdas.common import aws
+
+# Boto3 Clients
+s3 = aws.client("s3")
+dynamodb = aws.resource("dynamodb")
+ssm = aws.client("ssm")
+
+INPUT_BUCKET = "test-fused-input"
+OUTPUT_BUCKET = "test-output-bucket"
+
+# The stage handlers read the bucket names when they are imported, the same in every test module
+for name, value in (("presentiment_bucket", "test-presentiment-bucket"), ("output_bucket", OUTPUT_BUCKET)):
+    ssm.put_parameter(Name=f"/dic/{name}", Value=value, Type="String", Overwrite=True)
+
+from lambdas.common.ban_totals import get_totals
+from lambdas.fused.handler import handler as fused_handler
+from lambdas.preprocessing.handler import preprocess_text
+
+# Raw reviews, like they are uploaded
+reviews = [
+    {"reviewerID": "FUSEDUSER1", "reviewText": "This product is total crap!", "summary": "Crap", "overall": 1.0},
+    {"reviewerID": "FUSEDUSER2", "reviewText": "Amazing and awesome, I love it.", "summary": "Fantastic", "overall": 5.0},
+]
+
+
+class TestFusedHandler(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        for bucket in [INPUT_BUCKET, OUTPUT_BUCKET]:
+            try:
+                s3.create_bucket(Bucket=bucket)
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+                    raise
+
+        # Recreate both tables
+        for table_name in [os.environ["BAN_TABLE"], os.environ["SENTIMENT_TABLE"]]:
+            try:
+                table = dynamodb.Table(table_name)
+                table.delete()
+                table.wait_until_not_exists()
+            except dynamodb.meta.client.exceptions.ResourceNotFoundException:
+                pass
+
+        dynamodb.create_table(
+            TableName=os.environ["BAN_TABLE"],
+            KeySchema=[{"AttributeName": "reviewerID", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "reviewerID", "AttributeType": "S"},
+                {"AttributeName": "ban_status", "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": "banned-index",
+                    "KeySchema": [
+                        {"AttributeName": "ban_status", "KeyType": "HASH"},
+                        {"AttributeName": "reviewerID", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["profane_count", "banned"]},
+                }
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        ).wait_until_exists()
+        dynamodb.create_table(
+            TableName=os.environ["SENTIMENT_TABLE"],
+            KeySchema=[{"AttributeName": "sentiment", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "sentiment", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        ).wait_until_exists()
+
+    def test_handler_all_steps(self):
+        """Tests that one invocation preprocesses, checks and classifies the raw reviews and writes only the outputs."""
+        key = "fused-reviews.json"
+        s3.put_object(Bucket=INPUT_BUCKET, Key=key, Body="\n".join(json.dumps(r) for r in reviews) + "\n")
+        event = {"Records": [{"s3": {"bucket": {"name": INPUT_BUCKET}, "object": {"key": key}}}]}
+
+        response = fused_handler(event, None)
+        self.assertEqual(response["status"], "OK")
+
+        body = s3.get_object(Bucket=OUTPUT_BUCKET, Key=key)["Body"].read().decode("utf-8")
+        processed = [json.loads(line) for line in body.splitlines() if line.strip()]
+        self.assertEqual(len(processed), 2)
+        self.assertEqual(processed[0]["reviewText"], preprocess_text(reviews[0]["reviewText"]))
+        self.assertEqual([r["has_profanity"] for r in processed], [True, False])
+        self.assertEqual([r["sentiment"] for r in processed], ["negative", "positive"])
+
+        # Same DynamoDB updates as the staged lambdas
+        ban_table = dynamodb.Table(os.environ["BAN_TABLE"])
+        item = ban_table.get_item(Key={"reviewerID": "FUSEDUSER1"})["Item"]
+        self.assertEqual(int(item["profane_count"]), 1)
+        self.assertFalse(item["banned"])
+        self.assertEqual(get_totals(ban_table), (1, 0))
+
+        counts = json.loads(s3.get_object(Bucket=OUTPUT_BUCKET, Key="total_counts.json")["Body"].read())
+        self.assertEqual(counts["total_reviews_processed"], 2)
+        self.assertEqual(counts["sentiment_counts"]["negative"], 1)
+        self.assertEqual(counts["sentiment_counts"]["positive"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
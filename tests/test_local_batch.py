@@ -0,0 +1,67 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import nltk
+
+nltk.data.path.append("/tmp")
+try:
+    nltk.data.find("sentiment/vader_lexicon.zip")
+except LookupError:
+    nltk.download("vader_lexicon", download_dir="/tmp")
+
+from lambdas.local_batch import LocalStore, main
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+class TestLocalStore(unittest.TestCase):
+
+    def test_ban_rule(self):
+        """Tests that users are banned above the threshold, also over several files, and stay banned."""
+        store = LocalStore(":memory:", ban_threshold=3)
+        store.add_file({"A": 2, "B": 4}, {"positive": 2})
+        store.add_file({"A": 2, "C": 1}, {"negative": 1})
+        self.assertEqual([user["reviewerID"] for user in store.banned_users()], ["A", "B"])
+        self.assertEqual(store.totals(), (9, 2, {"positive": 2, "neutral": 0, "negative": 1}))
+
+
+class TestLocalBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, name, workers):
+        out = os.path.join(self.tmp, name)
+        main([SAMPLE_FILE, "-o", out, "--workers", str(workers), "--chunk-lines", "50"])
+        return out
+
+    def test_outputs(self):
+        """Tests the three outputs, and that more workers give exactly the same files."""
+        one = self.run_batch("one", 1)
+        two = self.run_batch("two", 2)
+        for name in ("reviews_sample.json", "banned-users.json", "total_counts.json"):
+            with open(os.path.join(one, name), "rb") as a, open(os.path.join(two, name), "rb") as b:
+                self.assertEqual(a.read(), b.read())
+
+        with open(os.path.join(one, "reviews_sample.json"), encoding="utf-8") as f:
+            reviews = [json.loads(line) for line in f]
+        with open(SAMPLE_FILE, encoding="utf-8") as f:
+            self.assertEqual(len(reviews), sum(1 for line in f if line.strip()))
+        self.assertTrue(all(isinstance(review["reviewText"], list) for review in reviews))
+        self.assertTrue(all(review["sentiment"] in ("positive", "neutral", "negative") for review in reviews))
+
+        with open(os.path.join(one, "total_counts.json"), encoding="utf-8") as f:
+            counts = json.load(f)
+        self.assertEqual(counts["total_reviews_processed"], len(reviews))
+        self.assertEqual(counts["total_profane_reviews"], sum(review["has_profanity"] for review in reviews))
+        self.assertEqual(sum(counts["sentiment_counts"].values()), len(reviews))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import json
+import unittest
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from lambdas.common import dynamo
+from lambdas.common.memory_aws import MIN_PART_SIZE, Latency, MemoryAWS
+
+
+def error_code(call, *args, **kwargs):
+    try:
+        call(*args, **kwargs)
+    except ClientError as e:
+        return e.response["Error"]["Code"]
+    return None
+
+
+class TestMemoryS3(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = MemoryAWS()
+        self.s3 = self.aws.client("s3")
+        self.s3.create_bucket(Bucket="bucket")
+
+    def test_objects_and_ranges(self):
+        """Tests get/head/ranges and the errors of missing keys, buckets and bad ranges."""
+        self.s3.put_object(Bucket="bucket", Key="key", Body=b"0123456789", ContentEncoding="gzip")
+        self.assertEqual(self.s3.get_object(Bucket="bucket", Key="key", Range="bytes=2-4")["Body"].read(), b"234")
+        self.assertEqual(self.s3.get_object(Bucket="bucket", Key="key", Range="bytes=8-")["Body"].read(), b"89")
+        self.assertEqual(self.s3.head_object(Bucket="bucket", Key="key")["ContentEncoding"], "gzip")
+        self.assertEqual(error_code(self.s3.get_object, Bucket="bucket", Key="key", Range="bytes=10-"), "InvalidRange")
+        self.assertEqual(error_code(self.s3.get_object, Bucket="bucket", Key="nope"), "NoSuchKey")
+        self.assertEqual(error_code(self.s3.head_object, Bucket="bucket", Key="nope"), "404")
+        self.assertEqual(error_code(self.s3.put_object, Bucket="nope", Key="key", Body=b""), "NoSuchBucket")
+        with self.assertRaises(self.s3.exceptions.NoSuchKey):
+            self.s3.get_object(Bucket="bucket", Key="nope")
+
+    def test_multipart_part_size(self):
+        """Tests that only the last part may be smaller than 5 MiB, like in S3."""
+        for sizes, error in (([MIN_PART_SIZE, 10], None), ([10, 10], "EntityTooSmall")):
+            upload_id = self.s3.create_multipart_upload(Bucket="bucket", Key="big")["UploadId"]
+            parts = []
+            for number, size in enumerate(sizes, start=1):
+                etag = self.s3.upload_part(Bucket="bucket", Key="big", UploadId=upload_id, PartNumber=number,
+                                           Body=b"x" * size)["ETag"]
+                parts.append({"ETag": etag, "PartNumber": number})
+            code = error_code(self.s3.complete_multipart_upload, Bucket="bucket", Key="big", UploadId=upload_id,
+                              MultipartUpload={"Parts": parts})
+            self.assertEqual(code, error)
+        self.assertEqual(self.s3.head_object(Bucket="bucket", Key="big")["ContentLength"], MIN_PART_SIZE + 10)
+
+    def test_notification_invokes_function(self):
+        """Tests that an upload queues the S3 event for the function and drain() runs it."""
+        events = []
+        arn = self.aws.register_function("fn", lambda event, context: events.append(event) or {"ok": True})
+        self.s3.put_bucket_notification_configuration(Bucket="bucket", NotificationConfiguration={
+            "LambdaFunctionConfigurations": [{"LambdaFunctionArn": arn, "Events": ["s3:ObjectCreated:*"]}]})
+        self.s3.put_object(Bucket="bucket", Key="new file.json", Body=b"{}")
+        self.assertEqual(events, [])
+        self.assertEqual(self.aws.drain(), 1)
+        record = events[0]["Records"][0]
+        self.assertEqual(record["s3"]["bucket"]["name"], "bucket")
+        self.assertEqual(record["s3"]["object"]["key"], "new+file.json")
+
+        response = self.aws.client("lambda").invoke(FunctionName=arn, Payload=json.dumps({"a": 1}))
+        self.assertEqual(json.loads(response["Payload"].read()), {"ok": True})
+
+
+class TestMemoryDynamoDB(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = MemoryAWS()
+        self.client = self.aws.client("dynamodb")
+        self.table = self.aws.resource("dynamodb").create_table(
+            TableName="bans",
+            KeySchema=[{"AttributeName": "reviewerID", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "reviewerID", "AttributeType": "S"}],
+            GlobalSecondaryIndexes=[{
+                "IndexName": "banned-index",
+                "KeySchema": [{"AttributeName": "ban_status", "KeyType": "HASH"},
+                              {"AttributeName": "reviewerID", "KeyType": "RANGE"}],
+                "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["profane_count"]},
+            }],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+    def add(self, reviewer_id, n, limit):
+        return self.table.update_item(
+            Key={"reviewerID": reviewer_id},
+            UpdateExpression="ADD profane_count :n SET banned = if_not_exists(banned, :false)",
+            ConditionExpression="attribute_not_exists(profane_count) OR profane_count <= :limit",
+            ExpressionAttributeValues={":n": n, ":false": False, ":limit": limit},
+            ReturnValues="ALL_NEW",
+        )
+
+    def test_update_expressions(self):
+        """Tests ADD, SET with if_not_exists and a condition that fails."""
+        self.assertEqual(self.add("A", 2, 3)["Attributes"], {"reviewerID": "A", "profane_count": 2, "banned": False})
+        self.add("A", 1, 2)
+        self.assertEqual(self.table.get_item(Key={"reviewerID": "A"})["Item"]["profane_count"], Decimal(3))
+        self.assertEqual(error_code(self.add, "A", 1, 2), "ConditionalCheckFailedException")
+        # Values that are not used are refused like by DynamoDB
+        self.assertEqual(error_code(self.table.update_item, Key={"reviewerID": "A"}, UpdateExpression="ADD c :n",
+                                    ExpressionAttributeValues={":n": 1, ":x": 2}), "ValidationException")
+
+    def test_transaction_is_atomic(self):
+        """Tests that a failed condition cancels the whole transaction with its reasons."""
+        writer = dynamo.DynamoWriter(self.client, "bans", rate=None)
+        self.table.put_item(Item={"reviewerID": "A", "banned": True})
+        ban = {"Key": {"reviewerID": "A"}, "UpdateExpression": "SET banned = :true",
+               "ConditionExpression": "attribute_not_exists(banned) OR banned = :false",
+               "ExpressionAttributeValues": {":true": True, ":false": False}}
+        total = {"Key": {"reviewerID": "#totals"}, "UpdateExpression": "ADD banned_total :one",
+                 "ExpressionAttributeValues": {":one": 1}}
+        with self.assertRaises(ClientError) as cm:
+            writer.transact_update(ban, total).result()
+        self.assertTrue(dynamo.condition_failed(cm.exception))
+        self.assertEqual(dynamo.cancellation_reasons(cm.exception), ["ConditionalCheckFailed", "None"])
+        self.assertNotIn("Item", self.table.get_item(Key={"reviewerID": "#totals"}))
+
+    def test_sparse_index_and_pages(self):
+        """Tests that only items with the index key are in the index, in order and in pages."""
+        for i in range(25):
+            item = {"reviewerID": f"U{i:02d}", "profane_count": i, "other": "x"}
+            if i % 2:
+                item["ban_status"] = "banned"
+            self.table.put_item(Item=item)
+        kwargs = {"IndexName": "banned-index", "KeyConditionExpression": "ban_status = :s",
+                  "ExpressionAttributeValues": {":s": "banned"}, "Limit": 5}
+        items = []
+        while True:
+            resp = self.table.query(**kwargs)
+            items.extend(resp["Items"])
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+        self.assertEqual([item["reviewerID"] for item in items], [f"U{i:02d}" for i in range(1, 25, 2)])
+        self.assertNotIn("other", items[0])
+
+        resp = self.table.scan(ProjectionExpression="reviewerID", FilterExpression="profane_count BETWEEN :a AND :b",
+                               ExpressionAttributeValues={":a": 3, ":b": 5})
+        self.assertEqual(sorted(item["reviewerID"] for item in resp["Items"]), ["U03", "U04", "U05"])
+
+
+class TestMemorySSMAndLatency(unittest.TestCase):
+
+    def test_parameters_by_path(self):
+        """Tests that get_parameters_by_path pages by 10 and only goes deeper with Recursive."""
+        ssm = MemoryAWS().client("ssm")
+        for i in range(12):
+            ssm.put_parameter(Name=f"/dic/p{i:02d}", Value=str(i), Type="String")
+        ssm.put_parameter(Name="/dic/deeper/p", Value="x", Type="String")
+        pages = list(ssm.get_paginator("get_parameters_by_path").paginate(Path="/dic"))
+        self.assertEqual([len(page["Parameters"]) for page in pages], [10, 2])
+        names = [p["Name"] for page in ssm.get_paginator("get_parameters_by_path").paginate(Path="/dic", Recursive=True)
+                 for p in page["Parameters"]]
+        self.assertIn("/dic/deeper/p", names)
+        self.assertEqual(error_code(ssm.get_parameter, Name="/dic/nope"), "ParameterNotFound")
+
+    def test_latency_is_counted(self):
+        """Tests that every call costs the same fixed time plus the time of its bytes."""
+        aws = MemoryAWS(Latency(ms=10, ms_per_mb=100, operations={"s3.head_object": 1}, sleep=False))
+        s3 = aws.client("s3")
+        s3.create_bucket(Bucket="b")
+        s3.put_object(Bucket="b", Key="k", Body=b"x" * (1024 * 1024))
+        s3.head_object(Bucket="b", Key="k")
+        self.assertEqual(aws.stats["calls"]["s3.put_object"], 1)
+        self.assertEqual(aws.stats["bytes"]["s3.put_object"], 1024 * 1024)
+        self.assertAlmostEqual(aws.stats["seconds"], (10 + 110 + 1) / 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
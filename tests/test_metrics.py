@@ -0,0 +1,91 @@
+import io
+import json
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from lambdas.common import compression, metrics
+from lambdas.common.memory_aws import MemoryAWS
+from lambdas.common.streaming import iter_lines
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        while metrics.active() is not None:
+            metrics.end()
+
+    def test_timers_count_their_own_time(self):
+        """Tests that the time of an inner timer is not counted for the outer one as well."""
+        recorder = metrics.begin("fn")
+        with metrics.timer("outer"):
+            time.sleep(0.02)
+            with metrics.timer("inner"):
+                time.sleep(0.05)
+        values = recorder.values()
+        self.assertGreaterEqual(values["inner_ms"], 50)
+        self.assertGreaterEqual(values["outer_ms"], 20)
+        self.assertLess(values["outer_ms"], 50)
+        self.assertGreaterEqual(values["total_ms"], values["outer_ms"] + values["inner_ms"])
+
+    def test_emf_line(self):
+        """Tests the one EMF line of an invocation, with the counters that grew in it, also if it fails."""
+        cache = {"hits": 5}
+
+        @metrics.instrumented("fn", counters=lambda: dict(cache))
+        def handler(event, context):
+            metrics.count("lines_out", 3)
+            metrics.count("bytes_in", 100)
+            cache["hits"] += 2
+            raise ValueError("failed")
+
+        out = io.StringIO()
+        with redirect_stdout(out), self.assertRaises(ValueError):
+            handler({"Records": [{"s3": {"object": {"key": "file.json"}}}]}, None)
+        [line] = out.getvalue().splitlines()
+        record = json.loads(line)
+        self.assertEqual((record["function"], record["key"]), ("fn", "file.json"))
+        self.assertEqual((record["lines_out"], record["bytes_in"], record["hits"]), (3, 100, 2))
+        directive = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(directive["Dimensions"], [["function"]])
+        units = {m["Name"]: m["Unit"] for m in directive["Metrics"]}
+        self.assertEqual((units["total_ms"], units["bytes_in"], units["lines_out"]), ("Milliseconds", "Bytes", "Count"))
+        self.assertIsNone(metrics.active())
+
+    def test_nested_invocation_and_disabled(self):
+        """Tests that an invocation inside another one (in memory) gets its own line, and METRICS=0."""
+        outer = metrics.begin("outer")
+        with redirect_stdout(io.StringIO()):
+            metrics.begin("inner")
+            metrics.count("files")
+            self.assertEqual(metrics.end()["files"], 1)
+        self.assertIs(metrics.active(), outer)
+        self.assertNotIn("files", outer.values())
+        metrics.end()
+
+        with mock.patch.object(metrics, "ENABLED", False):
+            self.assertIsNone(metrics.begin("fn"))
+            self.assertIs(metrics.timer("x"), metrics.NULL_TIMER)
+            self.assertIsNone(metrics.end())
+
+    def test_s3_bytes_and_lines(self):
+        """Tests that the S3 reads and the written parts are timed and counted where they happen."""
+        s3 = MemoryAWS().client("s3")
+        s3.create_bucket(Bucket="b")
+        s3.put_object(Bucket="b", Key="in", Body=b"a\nb\nc")
+        recorder = metrics.begin("fn")
+        body, _ = compression.open_object(s3, "b", "in")
+        self.assertEqual(list(iter_lines(body)), ["a", "b", "c"])
+        with compression.open_writer(s3, "b", "out", "gzip") as writer:
+            for line in ("x", "y"):
+                writer.write_line(line)
+        values = recorder.values()
+        self.assertEqual((values["bytes_in"], values["lines_out"], values["bytes_out"]), (5, 2, writer.bytes_written))
+        self.assertIn("s3_read_ms", values)
+        self.assertIn("s3_write_ms", values)
+        self.assertIn("compress_ms", values)
+
+
+if __name__ == "__main__":
+    unittest.main()
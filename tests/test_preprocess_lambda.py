@@ -1,11 +1,15 @@
 import os
 import json
 import pytest
-import boto3
 
 import unittest
 import nltk
 from nltk.stem import WordNetLemmatizer
+
+# In-memory AWS unless AWS_BACKEND says otherwise (e.g. AWS_BACKEND=localstack), see lambdas/common/aws.py
+os.environ.setdefault("AWS_BACKEND", "memory")
+
+from lambdas.common import aws
 from lambdas.preprocessing import handler
 
 
@@ -27,9 +31,11 @@ os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 os.environ["AWS_ACCESS_KEY_ID"] = "test"
 os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
 
-lambda_client = boto3.client(
-    "lambda", endpoint_url="http://localhost.localstack.cloud:4566"
-)
+os.environ.setdefault("AWS_ENDPOINT_URL", "http://localhost.localstack.cloud:4566")
+lambda_client = aws.client("lambda")
+if aws.backend() is not None:
+    # Deployed by setup.ps1 on LocalStack
+    aws.backend().register_function("preprocessing", handler.handler)
 
 sample_data = (
     {
@@ -82,5 +88,27 @@ class TestPreprocessText(unittest.TestCase):
             self.assertEqual(processed_summary, review["expected_summary_tokens"],
                                   msg=f"Mismatch in summary from {review['reviewerID']} tokens\nProcessed: {processed_summary}\nExpected: {review['expected_summary_tokens']}")
 
+    def test_batch_preprocessing(self):
+        """ Tests that the batch version gives the same tokens as preprocess_text."""
+        texts = [review[field] for review in sample_data for field in ("reviewText", "summary")]
+        self.assertEqual(handler.preprocess_texts(texts), [handler.preprocess_text(text) for text in texts])
+
+    def test_lemma_cache_counters(self):
+        """ Tests that repeated words are served from the lemma cache."""
+        handler.lemmatize.cache_clear()
+        handler.preprocess_text("geese geese geese")
+        info = handler.lemmatize.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+
+    def test_lemma_table_matches_wordnet(self):
+        """ Tests that the precomputed lemma table gives the same lemmas as WordNet."""
+        self.assertIsNotNone(handler.LEMMA_TABLE)
+        lemmatizer = WordNetLemmatizer()
+        words = [word for review in sample_data for field in ("reviewText", "summary") for word in handler.tokenize(review[field])]
+        words += ["geese", "churches", "aardwolves", "abaci", "men", "hardrock"]
+        for word in words:
+            self.assertEqual(handler.LEMMA_TABLE.get(word, word), lemmatizer.lemmatize(word), msg=f"Mismatch for {word}")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -2,15 +2,14 @@ import os
 import json
 import time
 import unittest
-import boto3
 from decimal import Decimal
 import botocore
 import botocore.exceptions
 
-from lambdas.profanity_check.handler import (
-    contains_profanity,
-    handler as profanity_handler,
-)
+# In-memory AWS unless AWS_BACKEND says otherwise (e.g. AWS_BACKEND=localstack), see lambdas/common/aws.py
+os.environ.setdefault("AWS_BACKEND", "memory")
+
+from lambdas.common import aws
 
 # Load stopwords
 with open(
@@ -26,9 +25,17 @@ os.environ["BAN_TABLE"] = "ban_table"
 os.environ["AWS_ENDPOINT_URL"] = "http://localhost.localstack.cloud:4566"
 
 # Boto3 Clients
-s3 = boto3.client("s3", endpoint_url=os.environ["AWS_ENDPOINT_URL"])
-dynamodb = boto3.resource("dynamodb", endpoint_url=os.environ["AWS_ENDPOINT_URL"])
-ssm = boto3.client("ssm", endpoint_url=os.environ["AWS_ENDPOINT_URL"])
+s3 = aws.client("s3")
+dynamodb = aws.resource("dynamodb")
+ssm = aws.client("ssm")
+
+# The handlers read the bucket names when they are imported, the same in every test module
+for name, value in (("presentiment_bucket", "test-presentiment-bucket"), ("output_bucket", "test-output-bucket")):
+    ssm.put_parameter(Name=f"/dic/{name}", Value=value, Type="String", Overwrite=True)
+
+from lambdas.common.ban_totals import get_totals, scan_totals
+from lambdas.profanity_check.checks import contains_profanity
+from lambdas.profanity_check.handler import handler as profanity_handler
 
 # Sample Data
 sample_review = {
@@ -88,7 +95,18 @@ class TestProfanityHandler(unittest.TestCase):
             TableName=cls.ban_table,
             KeySchema=[{"AttributeName": "reviewerID", "KeyType": "HASH"}],
             AttributeDefinitions=[
-                {"AttributeName": "reviewerID", "AttributeType": "S"}
+                {"AttributeName": "reviewerID", "AttributeType": "S"},
+                {"AttributeName": "ban_status", "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    "IndexName": "banned-index",
+                    "KeySchema": [
+                        {"AttributeName": "ban_status", "KeyType": "HASH"},
+                        {"AttributeName": "reviewerID", "KeyType": "RANGE"},
+                    ],
+                    "Projection": {"ProjectionType": "INCLUDE", "NonKeyAttributes": ["profane_count", "banned"]},
+                }
             ],
             BillingMode="PAY_PER_REQUEST",
         )
@@ -143,6 +161,69 @@ class TestProfanityHandler(unittest.TestCase):
         self.assertGreaterEqual(user.get("profane_count", 0), 4)
         self.assertTrue(user.get("banned", False))
 
+    def test_handler_aggregates_counts_per_file(self):
+        """Tests that many profane reviews in one file are counted per user and ban only above 3."""
+        table = dynamodb.Table(self.ban_table)
+        key = "many-profane-reviews.json"
+        reviews = [dict(sample_review, reviewerID="MANYUSER1")] * 5
+        reviews += [dict(sample_review, reviewerID="MANYUSER2")] * 2 + [clean_review]
+        content = "\n".join(json.dumps(review) for review in reviews)
+        s3.put_object(Bucket=self.input_bucket, Key=key, Body=content)
+
+        event = {
+            "Records": [
+                {"s3": {"bucket": {"name": self.input_bucket}, "object": {"key": key}}}
+            ]
+        }
+
+        profanity_handler(event, None)
+
+        user1 = table.get_item(Key={"reviewerID": "MANYUSER1"}).get("Item", {})
+        user2 = table.get_item(Key={"reviewerID": "MANYUSER2"}).get("Item", {})
+        self.assertEqual(user1.get("profane_count"), 5)
+        self.assertTrue(user1.get("banned"))
+        self.assertEqual(user2.get("profane_count"), 2)
+        self.assertFalse(user2.get("banned"))
+
+        # The running totals match a scan of the table
+        self.assertEqual(get_totals(table), scan_totals(table))
+
+        # Only banned users are in the sparse index and in banned-users.json
+        banned = wait_for_s3_key(s3, self.output_bucket, "banned-users.json")["Body"].read().decode("utf-8")
+        banned_ids = [json.loads(line)["reviewerID"] for line in banned.splitlines() if line.strip()]
+        self.assertIn("MANYUSER1", banned_ids)
+        self.assertNotIn("MANYUSER2", banned_ids)
+
+    def test_retry_does_not_count_twice(self):
+        """Tests that a retry of a file whose counts were already applied (crash before the end) changes nothing."""
+        table = dynamodb.Table(self.ban_table)
+        key = "retried-reviews.json"
+        reviews = [dict(sample_review, reviewerID="RETRYUSER1")] * 5 + [dict(sample_review, reviewerID="RETRYUSER2")]
+        s3.put_object(Bucket=self.input_bucket, Key=key, Body="\n".join(json.dumps(review) for review in reviews))
+        event = {
+            "Records": [
+                {"s3": {"bucket": {"name": self.input_bucket}, "object": {"key": key, "eTag": "retry1"}}}
+            ]
+        }
+
+        profanity_handler(event, None)
+        totals = get_totals(table)
+        profanity_handler(event, None)
+
+        user1 = table.get_item(Key={"reviewerID": "RETRYUSER1"}).get("Item", {})
+        user2 = table.get_item(Key={"reviewerID": "RETRYUSER2"}).get("Item", {})
+        self.assertEqual((user1.get("profane_count"), user1.get("banned")), (5, True))
+        self.assertEqual((user2.get("profane_count"), user2.get("banned")), (1, False))
+        self.assertEqual(get_totals(table), totals)
+        self.assertEqual(get_totals(table), scan_totals(table))
+
+        # A new upload of the same key is counted again
+        event["Records"][0]["s3"]["object"]["eTag"] = "retry2"
+        profanity_handler(event, None)
+        user2 = table.get_item(Key={"reviewerID": "RETRYUSER2"}).get("Item", {})
+        self.assertEqual(user2.get("profane_count"), 2)
+        self.assertEqual(get_totals(table), scan_totals(table))
+
     def test_handler_does_not_flag_clean_reviews(self):
         """Checks that clean reviews should not be flagged."""
         key = "clean-review.json"
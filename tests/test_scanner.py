@@ -0,0 +1,88 @@
+import os
+import json
+import unittest
+from collections import Counter
+from types import SimpleNamespace
+
+from lambdas.profanity_check.checks import check_line
+from lambdas.profanity_check.scanner import PhraseMatcher, load_patterns, load_words
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+
+class TestPhraseMatcher(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.matcher = PhraseMatcher(load_patterns())
+
+    def test_words(self):
+        """Tests that single bad words are found like before."""
+        self.assertTrue(self.matcher.search(["this", "product", "is", "total", "crap"]))
+        self.assertFalse(self.matcher.search(["this", "product", "is", "amazing"]))
+
+    def test_phrases(self):
+        """Tests that phrases only match as adjacent tokens."""
+        self.assertTrue(self.matcher.search(["alabama", "hot", "pocket", "recipe"]))
+        self.assertFalse(self.matcher.search(["alabama", "pocket", "hot"]))
+        self.assertFalse(self.matcher.search(["hot", "pocket"]))
+
+    def test_phrases_without_stopwords(self):
+        """Tests that stopwords are removed from phrases like from the reviews."""
+        patterns = load_patterns()
+        self.assertIn(("eat", "ass"), patterns)
+        # Only a normal word would be left, so these are not used
+        self.assertNotIn(("style",), patterns)
+        self.assertNotIn(("kill",), patterns)
+
+    def test_failure_links(self):
+        """Tests a match that starts inside a longer, unfinished pattern."""
+        matcher = PhraseMatcher([("a", "b", "c"), ("b", "d")])
+        self.assertTrue(matcher.search(["a", "b", "d"]))
+        self.assertTrue(matcher.search(["x", "a", "b", "c"]))
+        self.assertFalse(matcher.search(["a", "b", "x", "d"]))
+
+    def test_mark_clean_output(self):
+        """Tests that a clean line gets exactly what json.dumps would write."""
+        review = {"reviewerID": "A", "reviewText": ["great", "café"], "summary": ["fine"], "overall": 5.0}
+        line = json.dumps(review).encode("utf-8")
+        review["has_profanity"] = False
+        self.assertEqual(self.matcher.mark_clean(line), json.dumps(review).encode("utf-8"))
+
+    def test_mark_clean_needs_parse(self):
+        """Tests the lines that have to be parsed."""
+        profane = {"reviewerID": "A", "reviewText": ["total", "crap"]}
+        self.assertIsNone(self.matcher.mark_clean(json.dumps(profane).encode("utf-8")))
+        escaped = {"reviewText": ["\U0001f595"]}  # Written as 🖕 by json.dumps
+        self.assertIsNone(self.matcher.mark_clean(json.dumps(escaped).encode("utf-8")))
+        flagged = {"reviewText": ["fine"], "has_profanity": True}
+        self.assertIsNone(self.matcher.mark_clean(json.dumps(flagged).encode("utf-8")))
+
+    def test_malformed_line_is_skipped(self):
+        """Tests that a malformed line is not marked clean but skipped, like the parse path always did."""
+        self.assertIsNone(self.matcher.mark_clean(b"{bad}"))
+        written = []
+        output = SimpleNamespace(write_raw=written.append, write_row=written.append)
+        for line in (b"{bad}", b'{"reviewText": ["fine"]} {"x": 1}', b'{"reviewText": ["fine"]}'):
+            check_line(line, output, Counter(), skip_parse=True)
+        self.assertEqual(written, [b'{"reviewText": ["fine"], "has_profanity": false}'])
+
+    def test_never_skips_a_match(self):
+        """Tests on the sample that no line with a match is marked clean from its bytes."""
+        with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+            reviews = [json.loads(line) for line in f if line.strip()]
+        words = load_words()
+        for review in reviews:
+            for field in ("reviewText", "summary"):
+                review[field] = review.get(field, "").lower().split()
+            line = json.dumps(review).encode("utf-8")
+            found = any(self.matcher.search(review[f]) for f in ("reviewText", "summary"))
+            if found:
+                self.assertIsNone(self.matcher.mark_clean(line))
+            # Everything the old check found is still found
+            if any(w in words for f in ("reviewText", "summary") for w in review[f]):
+                self.assertTrue(found)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,6 @@ import os
 import json
 import time
 import unittest
-import boto3
 from decimal import Decimal
 from botocore.config import Config
 import botocore
@@ -19,12 +18,15 @@ try:
 except LookupError:
     nltk.download("wordnet", download_dir="/tmp")
     nltk.download("omw-1.4", download_dir="/tmp")
+try:
+    nltk.data.find("sentiment/vader_lexicon.zip")
+except LookupError:
+    nltk.download("vader_lexicon", download_dir="/tmp")
 
-from lambdas.sentiment_analysis.handler import (
-    get_total_profane_and_banned,
-    classify_sentiment,
-    handler as sentiment_handler,
-)
+# In-memory AWS unless AWS_BACKEND says otherwise (e.g. AWS_BACKEND=localstack), see lambdas/common/aws.py
+os.environ.setdefault("AWS_BACKEND", "memory")
+
+from lambdas.common import aws
 
 # Load stopwords
 with open(
@@ -41,11 +43,21 @@ os.environ["SENTIMENT_TABLE"] = "sentiment_table"
 os.environ["AWS_ENDPOINT_URL"] = "http://localhost.localstack.cloud:4566"
 
 # Boto3 Clients
-s3 = boto3.client("s3", endpoint_url=os.environ["AWS_ENDPOINT_URL"], config=Config(connect_timeout=10, read_timeout=20))
-dynamodb = boto3.resource("dynamodb", endpoint_url=os.environ["AWS_ENDPOINT_URL"])
-ssm = boto3.client("ssm", endpoint_url=os.environ["AWS_ENDPOINT_URL"])
-lambda_client = boto3.client(
-    "lambda", endpoint_url="http://localhost.localstack.cloud:4566"
+s3 = aws.client("s3", config=Config(connect_timeout=10, read_timeout=20))
+dynamodb = aws.resource("dynamodb")
+ssm = aws.client("ssm")
+lambda_client = aws.client("lambda")
+
+# The handlers read the bucket names when they are imported, the same in every test module
+for name, value in (("presentiment_bucket", "test-presentiment-bucket"), ("output_bucket", "test-output-bucket")):
+    ssm.put_parameter(Name=f"/dic/{name}", Value=value, Type="String", Overwrite=True)
+
+from lambdas.common.ban_totals import reconcile
+from lambdas.sentiment_analysis.classify import classify_sentiment
+from lambdas.sentiment_analysis.handler import (
+    get_total_profane_and_banned,
+    handler as sentiment_handler,
+    sentiment_counter,
 )
 
 
@@ -56,7 +68,7 @@ class TestSentimentAnalysis(unittest.TestCase):
         cls.ban_table_name = os.environ["BAN_TABLE"]
         cls.sentiment_table_name = os.environ["SENTIMENT_TABLE"]
         cls.input_bucket = "test-sentiment-input"
-        cls.output_bucket = "test-sentiment-output"
+        cls.output_bucket = "test-output-bucket"
 
         # Create buckets
         for bucket in [cls.input_bucket, cls.output_bucket]:
@@ -128,6 +140,8 @@ class TestSentimentAnalysis(unittest.TestCase):
             Item={"reviewerID": "user3", "profane_count": Decimal(2), "banned": True}
         )
 
+        # The totals are only recomputed from the table by the reconciliation
+        reconcile(table)
         profane, banned = get_total_profane_and_banned()
         self.assertEqual(profane, 10)
         self.assertEqual(banned, 2)
@@ -171,6 +185,30 @@ class TestSentimentAnalysis(unittest.TestCase):
         self.assertEqual(counts["total_reviews_processed"], 1)
         self.assertEqual(counts["sentiment_counts"]["positive"], 1)
 
+    def test_handler_with_several_records(self):
+        """Tests that the sentiments and lines of all files of one event are counted, not only of the last one."""
+        positive = {"reviewerID": "usery", "reviewText": ["the", "product", "is", "awesome"],
+                    "summary": ["loved", "it"], "overall": 5}
+        negative = {"reviewerID": "userz", "reviewText": ["terrible", "awful", "broken"],
+                    "summary": ["hate", "it"], "overall": 1}
+        s3.put_object(Bucket=self.input_bucket, Key="first.json", Body=json.dumps(positive) + "\n" + json.dumps(positive))
+        s3.put_object(Bucket=self.input_bucket, Key="second.json", Body=json.dumps(negative))
+        event = {
+            "Records": [
+                {"s3": {"bucket": {"name": self.input_bucket}, "object": {"key": key}}}
+                for key in ("first.json", "second.json")
+            ]
+        }
+        before = sentiment_counter.totals()
+
+        self.assertEqual(sentiment_handler(event, None)["status"], "OK")
+
+        counts_obj = s3.get_object(Bucket=self.output_bucket, Key="total_counts.json")
+        counts = json.loads(counts_obj["Body"].read().decode("utf-8"))
+        self.assertEqual(counts["total_reviews_processed"], 3)
+        self.assertEqual(counts["sentiment_counts"]["positive"] - before["positive"], 2)
+        self.assertEqual(counts["sentiment_counts"]["negative"] - before["negative"], 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,154 @@
+import io
+import json
+import unittest
+
+from lambdas.common import columnar, compression, formats, shards
+from lambdas.common.streaming import MIN_PART_SIZE
+from test_checkpoint import FakeContext, record
+from test_streaming import RecordingS3
+
+
+def copy_shard(s3, shard_record, encoding):
+    """A shard invocation of a stage that copies the reviews (like the handlers do)"""
+    kind, records = formats.open_input(shards.open_input(s3, shard_record), kind="jsonl",
+                                       start=shard_record["shard"]["start"])
+    count = 0
+    with shards.open_part_writer(s3, shard_record, encoding) as writer:
+        output = formats.open_output(writer)
+        for reviews in formats.iter_review_groups(kind, records):
+            for review in reviews:
+                output.write_row(review)
+                count += 1
+    return shards.part_result(shard_record, writer, count=count)
+
+
+class FakeLambda:
+    """Runs the shard invocations in this process, the first one fails once"""
+
+    def __init__(self, s3, encoding):
+        self.s3 = s3
+        self.encoding = encoding
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        (shard_record,) = json.loads(Payload)["Records"]
+        self.invocations.append(shard_record["shard"]["index"])
+        if self.invocations.count(0) == 1 and shard_record["shard"]["index"] == 0:
+            return {"FunctionError": "Unhandled", "Payload": io.BytesIO(b'{"errorMessage": "boom"}')}
+        result = copy_shard(self.s3, shard_record, self.encoding)
+        return {"Payload": io.BytesIO(json.dumps(result).encode("utf-8"))}
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.old_bucket = shards.SHARD_BUCKET
+        shards.SHARD_BUCKET = "shards"
+
+    def tearDown(self):
+        shards.SHARD_BUCKET = self.old_bucket
+
+    def upload(self, s3, n=3000):
+        lines = [json.dumps({"reviewerID": f"U{i}", "reviewText": "x" * (i % 300)}) for i in range(n)]
+        s3.put_object(Bucket="input", Key="big.json", Body="\n".join(lines).encode("utf-8"))
+        return lines
+
+    def test_plan_is_line_aligned(self):
+        """Tests that the ranges cover the whole object and every one starts at a line."""
+        s3 = RecordingS3()
+        self.upload(s3)
+        data = s3.objects[("input", "big.json")]
+        ranges = shards.plan(s3, record("big.json"), shard_size=100000)
+        self.assertGreater(len(ranges), 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b"\n")
+        # Small, compressed or already split files are not split
+        self.assertIsNone(shards.plan(s3, record("big.json"), shard_size=len(data)))
+        self.assertIsNone(shards.plan(s3, dict(record("big.json"), shard={"index": 0}), shard_size=100000))
+        s3.put_object(Bucket="input", Key="big.json.gz", Body=compression.compress(data, "gzip"))
+        self.assertIsNone(shards.plan(s3, record("big.json.gz"), shard_size=1000))
+
+    def test_plan_with_index(self):
+        """Tests that a compressed or columnar output is split at the frames / blocks its writer marked."""
+        reviews = [{"reviewerID": f"U{i}", "reviewText": ["x"] * (i % 50), "summary": ["s"]} for i in range(3000)]
+        for fmt in ("jsonl", "columnar"):
+            for encoding in compression.ENCODINGS:
+                s3 = RecordingS3()
+                with compression.open_writer(s3, "input", "big.json", encoding, split_size=20000) as writer:
+                    # Small blocks, so there is more than one per split
+                    output = columnar.ColumnarWriter(writer, 200) if fmt == "columnar" else formats.open_output(writer)
+                    for review in reviews:
+                        output.write_row(review)
+                    output.flush()
+                    shards.save_index(s3, "input", "big.json", writer.splits)
+                ranges = shards.plan(s3, record("big.json"))
+                self.assertGreater(len(ranges), 3, (fmt, encoding))
+                read = []
+                for index, (start, end) in enumerate(ranges):
+                    shard_record = dict(record("big.json"),
+                                        shard={"index": index, "start": start, "end": end})
+                    read.extend(formats.iter_reviews(shards.open_input(s3, shard_record)))
+                self.assertEqual(read, reviews)
+
+                # An index of another object with the same key is not used
+                if encoding != "none" or fmt == "columnar":
+                    data = s3.objects[("input", "big.json")]
+                    s3.put_object(Bucket="input", Key="big.json", Body=data[:1] + data[2:])
+                    self.assertIsNone(shards.plan(s3, record("big.json")))
+
+    def test_fan_out_and_merge(self):
+        """Tests that the merged shard outputs are the same as the output of one invocation."""
+        for encoding in compression.ENCODINGS:
+            s3 = RecordingS3()
+            lines = self.upload(s3)
+            ranges = shards.plan(s3, record("big.json"), shard_size=100000)
+            client = FakeLambda(s3, encoding)
+            results = shards.fan_out(FakeContext(60000, 0), record("big.json"), ranges, "test", client=client)
+            # The failed shard was invoked again
+            self.assertEqual(sorted(client.invocations), [0] + list(range(len(ranges))))
+            self.assertEqual(sum(result["count"] for result in results), len(lines))
+
+            shards.merge(s3, results, "output", "big.json", **compression.put_kwargs(encoding))
+            body = compression.open_body({"Body": io.BytesIO(s3.objects[("output", "big.json")])})
+            expected = b"\n".join(json.dumps(json.loads(line)).encode("utf-8") for line in lines)
+            self.assertEqual(body.read(), expected)
+            self.assertEqual([key for key in s3.objects if key[0] == "shards"], [])
+
+    def test_shard_without_lines(self):
+        """Tests that shards without valid lines (also the first ones) add nothing to the merged output."""
+        good = [json.dumps({"reviewerID": f"U{i}", "reviewText": "x" * 100}) for i in range(400)]
+        bad = ["{bad" + "x" * 100] * 400
+        for lines in (good[:200] + bad + good[200:], bad + good):
+            for encoding in compression.ENCODINGS:
+                s3 = RecordingS3()
+                s3.put_object(Bucket="input", Key="big.json", Body="\n".join(lines).encode("utf-8"))
+                ranges = shards.plan(s3, record("big.json"), shard_size=20000)
+                client = FakeLambda(s3, encoding)
+                results = shards.fan_out(FakeContext(60000, 0), record("big.json"), ranges, "test", client=client)
+                self.assertIn(0, [result["count"] for result in results])
+
+                shards.merge(s3, results, "output", "big.json", **compression.put_kwargs(encoding))
+                body = compression.open_body({"Body": io.BytesIO(s3.objects[("output", "big.json")])})
+                expected = b"\n".join(json.dumps(json.loads(line)).encode("utf-8") for line in good)
+                self.assertEqual(body.read(), expected)
+                self.assertEqual([key for key in s3.objects if key[0] == "shards"], [])
+
+    def test_merge_with_part_copy(self):
+        """Tests that big shard outputs are put together with a server-side copy."""
+        s3 = RecordingS3()
+        parts = [b"a" * MIN_PART_SIZE, b"\nb" * 10]
+        results = []
+        for i, data in enumerate(parts):
+            s3.put_object(Bucket="shards", Key=f"part{i}", Body=data)
+            results.append({"part": f"part{i}", "bytes": len(data)})
+        results.append({"part": "empty", "bytes": 0})
+        shards.merge(s3, results, "output", "key")
+        self.assertEqual(s3.calls.count("upload_part_copy"), 2)
+        self.assertEqual(s3.objects[("output", "key")], b"".join(parts))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from lambdas import stage_benchmark
+
+
+class TestStageBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_corpus(self):
+        """Tests that the corpus has the size, is the same for the same seed and has different texts."""
+        paths = [os.path.join(self.tmp, name) for name in ("a.json", "b.json", "c.json")]
+        for path, seed in zip(paths, (0, 0, 1)):
+            stage_benchmark.make_corpus(path, 300, seed)
+        with open(paths[0], "rb") as a, open(paths[1], "rb") as b, open(paths[2], "rb") as c:
+            first = a.read()
+            self.assertEqual(first, b.read())
+            self.assertNotEqual(first, c.read())
+        reviews = [json.loads(line) for line in first.splitlines()]
+        self.assertEqual(len(reviews), 300)
+        # The sample only has 264 reviews
+        self.assertGreater(len({review["reviewText"] for review in reviews}), 264)
+        self.assertTrue(all({"reviewerID", "reviewText", "summary", "overall"} <= set(review) for review in reviews))
+
+    def test_function_stages(self):
+        """Tests that the function stages go through every review of the corpus."""
+        path, tokens_path = stage_benchmark.ensure_corpus(200, directory=self.tmp)
+        with open(tokens_path, encoding="utf-8") as f:
+            self.assertTrue(all(isinstance(json.loads(line)["reviewText"], list) for line in f))
+        for stage in ("contains_profanity", "json_roundtrip"):
+            [result] = stage_benchmark.run_group(stage, 200, path, tokens_path)
+            self.assertEqual((result["stage"], result["lines"]), (stage, 200))
+            self.assertGreater(result["lines_per_s"], 0)
+            self.assertGreaterEqual(result["peak_rss_mb"], result["peak_delta_mb"])
+        # Only tokenize counts tokens
+        self.assertNotIn("tokens_per_s", result)
+        [result] = stage_benchmark.run_group("tokenize", 200, path, tokens_path)
+        self.assertGreater(result["tokens"], result["lines"])
+        self.assertGreater(result["tokens_per_s"], result["lines_per_s"])
+
+    def test_regression_gate(self):
+        """Tests that only stages more than the tolerance below the baseline fail, and new ones are skipped."""
+        baseline = [{"stage": "a", "size": 10, "lines_per_s": 1000.0},
+                    {"stage": "b", "size": 10, "lines_per_s": 1000.0}]
+        results = [{"stage": "a", "size": 10, "lines_per_s": 800.0},
+                   {"stage": "b", "size": 10, "lines_per_s": 700.0},
+                   {"stage": "c", "size": 10, "lines_per_s": 1.0}]
+        report, regressions = stage_benchmark.compare(results, baseline, tolerance=0.25)
+        self.assertEqual(len(report), 2)
+        self.assertEqual(regressions, [("b", 10, 700.0, 1000.0)])
+
+    def test_main_fails_on_regression(self):
+        """Tests the results file and the exit code of a run against a baseline it can't reach."""
+        output = os.path.join(self.tmp, "results.json")
+        baseline = os.path.join(self.tmp, "baseline.json")
+        argv = ["--sizes", "100", "--stages", "json_roundtrip", "--corpus-dir", self.tmp, "-o", output,
+                "--baseline", baseline]
+        self.assertEqual(stage_benchmark.main(argv + ["--update-baseline"]), 0)
+        with open(output, encoding="utf-8") as f:
+            [result] = json.load(f)["results"]
+        self.assertEqual((result["stage"], result["size"]), ("json_roundtrip", 100))
+
+        result["lines_per_s"] *= 1000
+        with open(baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": stage_benchmark.machine(), "results": [result]}, f)
+        self.assertEqual(stage_benchmark.main(argv), 1)
+
+        # The baseline of another machine is not a gate
+        with open(baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": dict(stage_benchmark.machine(), cpus=-1), "results": [result]}, f)
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(stage_benchmark.main(argv), 0)
+        self.assertIn("another machine", out.getvalue())
+        self.assertEqual(stage_benchmark.main(argv + ["--any-machine"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import io
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from lambdas.common import compression
+from lambdas.common.memory_aws import MemoryAWS
+from lambdas.common.streaming import MIN_PART_SIZE, MultipartWriter, RangeReader, iter_lines, peak_rss_mb
+
+
+class RecordingS3:
+    """Keeps the S3 calls of MultipartWriter in memory so we can check them"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append("put_object")
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append("create_multipart_upload")
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        self.uploads.pop(UploadId)
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        data = bytes(self.objects[(Bucket, Key)])
+        if Range:
+            start, _, last = Range[len("bytes="):].partition("-")
+            start = int(start)
+            if start >= len(data):
+                raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+            size = len(data)
+            data = data[start:int(last) + 1] if last else data[start:]
+            return {"Body": io.BytesIO(data), "ContentRange": f"bytes {start}-{start + len(data) - 1}/{size}"}
+        return {"Body": io.BytesIO(data)}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource):
+        self.calls.append("upload_part_copy")
+        self.uploads[UploadId][PartNumber] = bytes(self.objects[(CopySource["Bucket"], CopySource["Key"])])
+        return {"CopyPartResult": {"ETag": f"etag-{PartNumber}"}}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class TestIterLines(unittest.TestCase):
+
+    def test_lines_split_across_chunks(self):
+        """Tests that lines cut between two chunks are put back together."""
+        data = "first line\nsecond ünïcode line\n\nlast line".encode("utf-8")
+        lines = list(iter_lines(io.BytesIO(data), chunk_size=4))
+        self.assertEqual(lines, ["first line", "second ünïcode line", "", "last line"])
+
+    def test_trailing_newline(self):
+        """Tests that a trailing newline does not produce an extra line."""
+        self.assertEqual(list(iter_lines(io.BytesIO(b"a\nb\n"))), ["a", "b"])
+
+
+class TestMultipartWriter(unittest.TestCase):
+
+    def test_small_output_uses_put_object(self):
+        """Tests that small files are written with a single put_object, joined like before."""
+        s3 = RecordingS3()
+        with MultipartWriter(s3, "bucket", "key") as writer:
+            writer.write_line('{"a": 1}')
+            writer.write_line('{"b": 2}')
+        self.assertEqual(s3.calls, ["put_object"])
+        self.assertEqual(s3.objects[("bucket", "key")], b'{"a": 1}\n{"b": 2}')
+        self.assertEqual(writer.lines_written, 2)
+
+    def test_large_output_uses_parts(self):
+        """Tests that the output is uploaded in parts and that it is the same as one joined body."""
+        s3 = RecordingS3()
+        lines = [("x" * 1000) + str(i) for i in range(12000)]
+        with MultipartWriter(s3, "bucket", "key", part_size=MIN_PART_SIZE) as writer:
+            for line in lines:
+                writer.write_line(line)
+        self.assertEqual(s3.calls[0], "create_multipart_upload")
+        self.assertEqual(s3.calls[-1], "complete_multipart_upload")
+        self.assertEqual(s3.calls.count("upload_part"), 3)
+        self.assertEqual(s3.objects[("bucket", "key")], "\n".join(lines).encode("utf-8"))
+
+    def test_abort_on_error(self):
+        """Tests that the multipart upload is aborted when processing fails."""
+        s3 = RecordingS3()
+        with self.assertRaises(RuntimeError):
+            with MultipartWriter(s3, "bucket", "key", part_size=MIN_PART_SIZE) as writer:
+                writer.write_line("x" * MIN_PART_SIZE)
+                raise RuntimeError("processing failed")
+        self.assertIn("abort_multipart_upload", s3.calls)
+        self.assertNotIn(("bucket", "key"), s3.objects)
+
+    def test_parallel_parts(self):
+        """Tests that parts uploaded in the background are completed in order, and a failed part aborts."""
+        s3 = RecordingS3()
+        lines = [("x" * 1000) + str(i) for i in range(30000)]
+        with MultipartWriter(s3, "bucket", "key", part_size=MIN_PART_SIZE, upload_concurrency=3) as writer:
+            for line in lines:
+                writer.write_line(line)
+        self.assertEqual(s3.calls.count("upload_part"), 6)
+        self.assertEqual([part["PartNumber"] for part in writer.parts], list(range(1, 7)))
+        self.assertEqual(s3.objects[("bucket", "key")], "\n".join(lines).encode("utf-8"))
+
+        with mock.patch.object(s3, "upload_part", side_effect=RuntimeError("part failed")):
+            with self.assertRaises(RuntimeError):
+                with MultipartWriter(s3, "bucket", "key2", part_size=MIN_PART_SIZE, upload_concurrency=2) as writer:
+                    for line in lines:
+                        writer.write_line(line)
+        self.assertEqual(s3.calls[-1], "abort_multipart_upload")
+        self.assertNotIn(("bucket", "key2"), s3.objects)
+
+    def test_peak_rss(self):
+        """Tests that the peak memory can be read (only on Unix)."""
+        rss = peak_rss_mb()
+        if rss is not None:
+            self.assertGreater(rss, 0)
+
+
+class TestRangeReader(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryAWS()
+        self.s3 = self.backend.client("s3")
+        self.s3.create_bucket(Bucket="b")
+        self.data = "\n".join(f'{{"reviewerID": "R{i}", "reviewText": "text {i}"}}' for i in range(5000)).encode()
+        self.s3.put_object(Bucket="b", Key="in", Body=self.data)
+
+    def test_reads_ahead_with_backpressure(self):
+        """Tests that only `concurrency` ranges are requested ahead of the reader, and the bytes come in order."""
+        reader = RangeReader(self.s3, "b", "in", io.BytesIO(self.data[:1000]), 1000, len(self.data),
+                             range_size=1000, concurrency=2)
+        for future in list(reader._pending):
+            future.result()
+        self.assertEqual(self.backend.stats["calls"]["s3.get_object"], 2)
+        self.assertEqual(reader.read(), self.data)
+        self.assertEqual(self.backend.stats["calls"]["s3.get_object"], -(-len(self.data) // 1000) - 1)
+
+    def test_open_object_in_ranges(self):
+        """Tests open_object with ranges for plain and compressed objects, from an offset and for a shard."""
+        self.s3.put_object(Bucket="b", Key="gz", Body=compression.compress(self.data, "gzip"), ContentEncoding="gzip")
+        offset = self.data.index(b"\n", 100000) + 1
+        with mock.patch.object(compression, "RANGE_SIZE", 4096):
+            for key, encoding in (("in", "none"), ("gz", "gzip")):
+                body, found = compression.open_object(self.s3, "b", key)
+                self.assertEqual((b"\n".join(iter_lines(body, decode=False)), found), (self.data, encoding))
+                body, _ = compression.open_object(self.s3, "b", key, offset, encoding)
+                self.assertEqual(body.read(), self.data[offset:])
+            body, _ = compression.open_object(self.s3, "b", "in", 10, "none", end=50000)
+            self.assertEqual(body.read(), self.data[10:50000])
+            body, _ = compression.open_object(self.s3, "b", "in", len(self.data), "none")
+            self.assertEqual(body.read(), b"")
+            self.s3.put_object(Bucket="b", Key="empty", Body=b"")
+            body, _ = compression.open_object(self.s3, "b", "empty")
+            self.assertEqual(body.read(), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import json
+import string
+import unittest
+
+from lambdas.preprocessing import handler
+
+SAMPLE_FILE = os.path.join(os.path.dirname(__file__), "..", "reviews_sample.json")
+
+with open(os.path.join(os.path.dirname(__file__), "stopwords.txt"), "r", encoding="utf-8") as f:
+    STOPWORDS = set(word.strip().lower() for word in f if word.strip())
+
+
+def reference_tokenize(text):
+    """The tokenizing part of preprocess_text as it was before, to compare against"""
+    text = text.lower().translate(str.maketrans("", "", string.punctuation))
+    tokens = text.split()
+    return [word for word in tokens if word not in STOPWORDS and word.isascii()]
+
+
+def load_sample_texts():
+    texts = []
+    with open(SAMPLE_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                review = json.loads(line)
+                texts += [review.get("reviewText", ""), review.get("summary", "")]
+    return texts
+
+
+class TestTokenizer(unittest.TestCase):
+
+    def test_same_tokens_as_before(self):
+        """Tests that tokenize gives exactly the old tokens for every text of the sample file."""
+        for text in load_sample_texts():
+            self.assertEqual(handler.tokenize(text), reference_tokenize(text), msg=text)
+
+    def test_batch_same_tokens_as_before(self):
+        """Tests that tokenize_texts gives exactly the old tokens for the whole sample file at once."""
+        texts = load_sample_texts()
+        self.assertEqual(handler.tokenize_texts(texts), [reference_tokenize(text) for text in texts])
+
+    def test_special_characters(self):
+        """Tests texts with non-ASCII characters, including ones that become ASCII when lowercased."""
+        texts = [
+            "Cáfé AND Crème brûlée — GREAT!!",
+            "King-size bed (K is the Kelvin sign)",
+            "İstanbul was n'ice",
+            "tabs\tand\nnewlines and wide spaces",
+            "",
+            "!!!",
+        ]
+        for text in texts:
+            self.assertEqual(handler.tokenize(text), reference_tokenize(text), msg=text)
+
+
+if __name__ == "__main__":
+    unittest.main()